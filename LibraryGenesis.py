@@ -1,17 +1,47 @@
-import concurrent.futures
+import contextlib
 import pandas as pd
 import numpy as np
 import re
 import sys
-from os.path import abspath
-from dewey_category_check import get_dewey_decimal, format_isbn, format_title
+import os
+from os.path import abspath, exists, getsize
+from dewey_category_check import get_dewey_decimal_batch, lookup_pairs
+from json_stream import iter_json_array
+from book_register import BookRegister
+from record_schema import compact_dataframe, md5_hex, now, to_small_int, DDC_DTYPE
+from transfer_journal import TransferJournal
+from high_water_marks import HighWaterMarks
+from work_queue import WorkQueue, PRIORITIES, LeaseLostError, lease_owner
+from page_cache import PageCache, PageNotCachedError, DEFAULT_MAX_AGE
+from bounded_executor import BoundedExecutor
+from content_store import ContentStore, ContentMismatchError, link_local_file, check_md5, BUCKET, LOCAL
+from ranged_download import download_segments, segmentable_size, new_segment_map, load_segment_map, bytes_done, \
+    discard_segments, segments_path, RangesNotSupportedError, BUFFER_SIZE
+import hashlib
+import json
+import threading
 from aws_interface import upload_to_bucket, download_from_bucket, clean_file_name
-import requests
+import async_fetch
+from connection_pool import get_http_session, connection_reuse_report
+from rate_limiter import limited_get, permanent_failure
+from metrics import METRICS
 from datetime import datetime
 import time
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
 from urllib.request import urlretrieve, urlopen
 
+# How often a download in progress writes its byte offset to the transfer journal
+JOURNAL_EVERY_BYTES = 4 * 1024 * 1024
+# The only json.php fields the pipeline uses, asking for just these keeps the pages small
+JSON_FIELDS = ['id', 'author', 'title', 'year', 'Language', 'md5', 'coverurl', 'identifier', 'extension']
+
+
+def url_text(values):
+    """
+    A column as the strings url_maker made of each row's value, missing values (which reach it as NaN) as 'nan'.
+    astype(str) leaves missing values as NaN on pandas 3 string columns, which quote can't take
+    """
+    return values.astype(str).where(values.notna(), 'nan')
 
 
 class LibraryGenesisScraper:
@@ -20,6 +50,112 @@ class LibraryGenesisScraper:
     getting data from library genesis' database,
     a download link is put together and then the pdf documents are uploaded directly to an s3 bucket.
     """
+    def __init__(self, register_path='Book-Register.sqlite', journal_path='Transfer-Journal.sqlite',
+                 marks_path='High-Water-Marks.sqlite', queue_path='Work-Queue.sqlite',
+                 page_cache_path='Page-Cache.sqlite', page_cache_mode='off', page_max_age=DEFAULT_MAX_AGE,
+                 main_register_path=None):
+        self.register_path = register_path
+        # The register a shard's partition (register_path) is merged into, only read to skip books it already has
+        self.main_register_path = main_register_path
+        self.journal_path = journal_path
+        self.marks_path = marks_path
+        self.queue_path = queue_path
+        self.page_cache_path = page_cache_path
+        self.page_cache_mode = page_cache_mode
+        self.page_max_age = page_max_age
+        self._register = None
+        self._main_register = None
+        self._journal = None
+        self._marks = None
+        self._queue = None
+        self._page_cache = None
+        self._content_store = None
+        # One lock per md5 so two rows for the same book don't transfer it at the same time
+        self.md5_locks = {}
+        self.md5_locks_lock = threading.Lock()
+        # (location, owner) of the queue lease each running transfer holds, by book id
+        self.leases = {}
+        self.leases_lock = threading.Lock()
+        # Ids of rows classify couldn't answer (throttled or down), so they have no category yet.
+        # Only kept while keyset paging, which is the only reader
+        self.track_unclassified = False
+        self.unclassified_ids = set()
+
+    @property
+    def register(self):
+        """The book register, opened (and migrated from Book-Register.csv if needed) on first use"""
+        if self._register is None:
+            self._register = BookRegister(self.register_path)
+        return self._register
+
+    @property
+    def main_register(self):
+        """The main register when parsing into a shard's partition, None otherwise or if there isn't one yet"""
+        if self._main_register is None and self.main_register_path and exists(self.main_register_path) \
+                and abspath(self.main_register_path) != abspath(self.register_path):
+            self._main_register = BookRegister(self.main_register_path, csv_path=None)
+        return self._main_register
+
+    @property
+    def journal(self):
+        """Journal of finished and partial transfers used to resume the download_library command"""
+        if self._journal is None:
+            self._journal = TransferJournal(self.journal_path)
+        return self._journal
+
+    @property
+    def marks(self):
+        """Where keyset paging got to in each json.php time window"""
+        if self._marks is None:
+            self._marks = HighWaterMarks(self.marks_path)
+        return self._marks
+
+    @property
+    def queue(self):
+        """Leased work queue the download_library workers take their transfers from"""
+        if self._queue is None:
+            self._queue = WorkQueue(self.queue_path)
+        return self._queue
+
+    @property
+    def page_cache(self):
+        """Cache of json.php responses, None when page_cache_mode is 'off'"""
+        if self._page_cache is None and self.page_cache_mode != 'off':
+            self._page_cache = PageCache(self.page_cache_path, mode=self.page_cache_mode, max_age=self.page_max_age)
+        return self._page_cache
+
+    def page_cache_report(self):
+        """Prints how many pages the page cache holds and how well they compressed"""
+        if self.page_cache is None:
+            return
+        pages, size, stored = self.page_cache.stats()
+        ratio = size / stored if stored else 0
+        print(f'page cache holds {pages} page(s), {size} byte(s) compressed to {stored} byte(s) ({ratio:.1f}x)')
+
+    @property
+    def content_store(self):
+        """md5 keyed index of books already in the bucket or on this machine"""
+        if self._content_store is None:
+            self._content_store = ContentStore()
+        return self._content_store
+
+    def renew_lease(self, book_id):
+        """
+        Called at a transfer's progress points, so its queue lease doesn't run out while bytes are still moving.
+        Raises LeaseLostError if another worker has taken the book, so it isn't transferred twice at once.
+        """
+        with self.leases_lock:
+            lease = self.leases.get(str(book_id))
+        if lease is not None and not self.queue.renew(book_id, *lease):
+            raise LeaseLostError(f'lease on {book_id} was taken by another worker')
+
+    def md5_lock(self, md5):
+        if not md5:
+            # Rows without an md5 can't be deduplicated so they don't need to wait on each other
+            return threading.Lock()
+        with self.md5_locks_lock:
+            return self.md5_locks.setdefault(md5, threading.Lock())
+
     def url_maker(self, base_url, **kwargs):
         """Creates the download link that is later used by the 'upload_files' function"""
 
@@ -44,9 +180,8 @@ class LibraryGenesisScraper:
         download_url = f'{base_url}{id_group}/{md5.lower()}/{book_link_utf8}.pdf'
         return download_url
 
-    def JSON_response(self, limit1, limit2, start_year, last_year):
-        """grabs data matching the fields required."""
-        fields = ','.join(['id', 'author', 'title', 'year', 'Language', 'md5', 'coverurl', 'identifier'])
+    def JSON_url(self, limit1, limit2, start_year, last_year):
+        fields = ','.join(JSON_FIELDS)
 
         # limit1 controls the start point
         # limit2 controls the max number of responses
@@ -54,93 +189,279 @@ class LibraryGenesisScraper:
         time_first = f'{start_year}-01-01'
         time_last = f'{last_year}-10-14'
 
-        url = f'https://libgen.rs/json.php?fields={fields}&limit1={limit1}&limit2={limit2}&mode=last&timefirst={time_first}&timelast={time_last}'
+        return f'https://libgen.rs/json.php?fields={fields}&limit1={limit1}&limit2={limit2}&mode=last&timefirst={time_first}&timelast={time_last}'
 
-        response = requests.get(url)
-        # Sometimes it takes a few tries to connect hence the loop
-        while response.status_code != 200:
-            print(f'no connection --status code:{response.status_code}')
-            time.sleep(1)
-            response = requests.get(url)
-        else:
-            self.json_parse = response.json()
-            return int(len(self.json_parse))
+    def JSON_keyset_url(self, after_time, after_id, limit2):
+        """Url for the limit2 records modified after (after_time, after_id), oldest first"""
+        fields = ','.join(JSON_FIELDS + ['timelastmodified'])
+        query = urlencode({'timenewer': after_time, 'idnewer': after_id, 'limit2': limit2})
+        return f'https://libgen.rs/json.php?fields={fields}&mode=newer&{query}'
 
+    def JSON_response(self, limit1, limit2, start_year, last_year):
+        """grabs data matching the fields required."""
+        self.json_parse = self.fetch_JSON_page(limit1, limit2, start_year, last_year)
+        return int(len(self.json_parse))
+
+    def fetch_JSON_page(self, limit1, limit2, start_year, last_year):
+        """Returns the records of one json.php page without touching the scraper's state, so it is safe to run on threads"""
+        return self.fetch_JSON_records(self.JSON_url(limit1, limit2, start_year, last_year))
+
+    def open_JSON_response(self, url, stream=False):
+        """
+        Returns (body, response) for a json.php url. body is the page cache's copy when it can be used, because it
+        is still fresh or the server said it hasn't changed, otherwise body is None and response is an open 200.
+        Requests are tried again until the host answers, replay mode raises PageNotCachedError instead of fetching.
+        """
+        page = None
+        if self.page_cache is not None:
+            with METRICS.stage('page cache'):
+                page = self.page_cache.get(url)
+            if page is not None and self.page_cache.is_fresh(page):
+                METRICS.add_bytes('page cache', len(page.body))
+                return page.body, None
+            if self.page_cache.mode == 'replay':
+                raise PageNotCachedError(f'{url} is not in {self.page_cache.path}')
+        headers = page.validators() if page is not None else {}
+        with METRICS.stage('fetch'):
+            response = limited_get(get_http_session(), url, stream=stream, headers=headers)
+            # Sometimes it takes a few tries to connect hence the loop, the host limiter backs off between tries
+            while response.status_code != 200 and not (response.status_code == 304 and headers):
+                print(f'no connection --status code:{response.status_code}')
+                if permanent_failure(response.status_code):
+                    # The limiter only backs off for throttling and 5xx, asking again would hammer the host
+                    response.close()
+                    response.raise_for_status()
+                response.close()
+                response = limited_get(get_http_session(), url, stream=stream, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            self.page_cache.revalidated(url)
+            METRICS.add_bytes('page cache', len(page.body))
+            return page.body, None
+        return None, response
+
+    def fetch_JSON_records(self, url):
+        """Fetches (or reads from the page cache) and decodes one json.php response"""
+        body, response = self.open_JSON_response(url)
+        if response is not None:
+            body = response.content
+            METRICS.add_bytes('fetch', len(body))
+            if self.page_cache is not None:
+                self.page_cache.put(url, body, response.headers)
+        with METRICS.stage('parse') as stage:
+            records = json.loads(body)
+            stage['rows'] = len(records)
+        return records
+
+    def keyset_JSON_pages(self, start_year, last_year, limit2, reset_mark=False):
+        """
+        Keyset version of paging through JSON_url with limit1 offsets. Each page asks for the records after
+        the last (timelastmodified, id) seen, so deep pages cost the same as the first and rows can't be skipped
+        or repeated when the catalogue changes mid run. Yields lists of records in the same time window as JSON_url.
+        The window's high-water mark is saved once the caller asks for the next page, so a page that was not
+        processed is fetched again next run, and a repeat run only fetches records added since the last one.
+        The mark never passes a record classify couldn't answer (see get_ddc), paging carries on past it but the
+        next run starts again from there, the records after it that were registered are then filtered out cheaply.
+        reset_mark forgets the window's mark first, so it is rescanned from the start.
+        """
+        window = f'{start_year}-01-01/{last_year}-10-14'
+        window_end = f'{last_year}-10-14 00:00:00'
+        if reset_mark:
+            self.marks.clear(window)
+        self.track_unclassified = True
+        after_time, after_id = self.marks.get(window) or (f'{start_year}-01-01 00:00:00', 0)
+        if after_id:
+            print(f'Resuming {window} after id {after_id} ({after_time})')
+        mark_held = False
+        while True:
+            records = self.fetch_JSON_records(self.JSON_keyset_url(after_time, after_id, limit2))
+            in_window = [record for record in records if record['timelastmodified'] <= window_end]
+            if in_window:
+                self.unclassified_ids = set()
+                yield in_window
+                if not mark_held:
+                    mark = (after_time, after_id)
+                    for record in in_window:
+                        if str(record['id']) in self.unclassified_ids:
+                            print(f'Keeping the mark for {window} before id {record["id"]}, '
+                                  f'it could not be classified this run')
+                            mark_held = True
+                            break
+                        mark = (record['timelastmodified'], record['id'])
+                    self.marks.set(window, *mark)
+                after_time, after_id = in_window[-1]['timelastmodified'], in_window[-1]['id']
+            if len(records) < limit2 or len(in_window) < len(records):
+                break
+
+    def stream_JSON_response(self, limit1, limit2, start_year, last_year, year_from, year_to, language, batch_size=1000):
+        """
+        Streaming version of JSON_response + initialise_dataframe + the year and language filters.
+        Records are parsed one at a time and filtered as they arrive, then yielded as dataframes of at most
+        batch_size rows, so memory stays flat however large limit2 is.
+        self.records_read holds how many records the page had (before filtering) once the generator is exhausted.
+        """
+        url = self.JSON_url(limit1, limit2, start_year, last_year)
+        language = language.lower()
+        self.records_read = 0
+
+        body, response = self.open_JSON_response(url, stream=True)
+        # A page read from the network is compressed into the page cache as it streams past
+        page_writer = self.page_cache.writer(url, response.headers) \
+            if response is not None and self.page_cache is not None else None
+
+        def counted_chunks():
+            if response is None:
+                for start in range(0, len(body), 65536):
+                    yield body[start:start + 65536]
+                return
+            for chunk in response.iter_content(chunk_size=65536):
+                METRICS.add_bytes('fetch', len(chunk))
+                if page_writer is not None:
+                    page_writer.write(chunk)
+                yield chunk
+        chunks = counted_chunks()
+
+        batch = []
+        # Streaming interleaves reading, parsing and filtering, so they are timed together as 'parse',
+        # leaving out the time the caller spends on each batch
+        batch_start = time.perf_counter()
+        with response if response is not None else contextlib.nullcontext():
+            for record in iter_json_array(chunks):
+                self.records_read += 1
+                if self.record_matches(record, year_from, year_to, language):
+                    batch.append(record)
+                if len(batch) >= batch_size:
+                    batch_df = self.make_dataframe(batch)
+                    METRICS.observe('parse', time.perf_counter() - batch_start, rows=len(batch))
+                    yield batch_df
+                    batch = []
+                    batch_start = time.perf_counter()
+            if page_writer is not None:
+                # The closing bracket can arrive before the end of the body, the page is only stored whole
+                for _ in chunks:
+                    pass
+                page_writer.commit()
+        if batch:
+            batch_df = self.make_dataframe(batch)
+            METRICS.observe('parse', time.perf_counter() - batch_start, rows=len(batch))
+            yield batch_df
+
+    @staticmethod
+    def record_matches(record, year_from, year_to, language):
+        """Per record version of filter_dataframe_year and filter_dataframe_language"""
+        if str(record.get('language', '')).lower() != language:
+            return False
+        try:
+            year = int(np.floor(float(record.get('year'))))
+        except (TypeError, ValueError):
+            return False
+        return year_from <= year <= year_to
+
+    @staticmethod
+    def make_dataframe(records):
+        return compact_dataframe(pd.DataFrame(records))
 
     def initialise_dataframe(self):
-        self.initial_df = pd.DataFrame(self.json_parse)
+        with METRICS.stage('parse', rows=len(self.json_parse)):
+            self.initial_df = self.make_dataframe(self.json_parse)
         self.df = self.initial_df
-        self.df['year'] = np.floor(pd.to_numeric(self.df['year'], errors='coerce')).astype('Int64')
-        self.df['language'] = self.df['language'].str.lower()
 
 
     def filter_dataframe_year(self, year_from, year_to):
-        self.df = self.df[self.df['year'].between(year_from, year_to)]
+        with METRICS.stage('filter', rows=self.df.shape[0]):
+            self.df = self.df[self.df['year'].between(year_from, year_to)]
 
     def filter_dataframe_language(self, language):
-        self.df = self.df.loc[self.df['language'] == language.lower()]
+        with METRICS.stage('filter', rows=self.df.shape[0]):
+            self.df = self.df.loc[self.df['language'] == language.lower()]
 
-    def get_download_urls(self):
-        time_now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        base_download_url = f'http://31.42.184.140/main/'
-        download_links = []
-        files_uploaded = []
-
-        for index, row in self.df.iterrows():
-            download_url = self.url_maker(base_url=base_download_url,
-                                          author=row['author'],
-                                          title=row['title'],
-                                          year=row['year'],
-                                          md5=row['md5'],
-                                          coverurl=row['coverurl'])
-            download_links.append(download_url)
-            files_uploaded.append([False, f'initial link creation [{time_now}]'])
-
-        self.df['download link'] = download_links
-        self.df['file uploaded'] = files_uploaded
-
-    def get_ddc(self):
-        """This setup the dataframe column for the dewey decimal category column"""
-
-        def get_dcc_via_threading(df_row):
-            row = df_row[1]
-            try:
-                isbn = format_isbn(row['identifier'])
+    def filter_dataframe_extension(self, extensions):
+        """Keeps the file types in extensions. Pages from before the extension field was requested are left alone"""
+        if 'extension' not in self.df.columns:
+            return
+        with METRICS.stage('filter', rows=self.df.shape[0]):
+            self.df = self.df[self.df['extension'].astype(str).str.lower().isin(extensions)]
+
+    def filter_registered(self):
+        """
+        Drops rows whose id or md5 is already in the register, they would be ignored when the page is added anyway.
+        A shard checks the main register as well as its own partition, so books from earlier runs aren't looked up again
+        """
+        with METRICS.stage('filter', rows=self.df.shape[0]):
+            if self.df.empty:
+                return
+            ids = self.df['id'].astype(str)
+            md5s = self.df['md5'].map(md5_hex)
+            known_ids = set()
+            known_md5s = set()
+            for register in (self.register, self.main_register):
+                if register is None:
+                    continue
+                known_ids |= register.existing('id', ids.tolist())
+                known_md5s |= register.existing('md5', [md5 for md5 in md5s if md5])
+            self.df = self.df[~(ids.isin(known_ids) | md5s.isin(known_md5s))]
+
+    @staticmethod
+    def make_download_urls(df, base_url):
+        """Column-wise version of url_maker, builds the download link for every row of df at once"""
+        book_link = (url_text(df['author']) + ' - ' + url_text(df['title']) + ' (' + url_text(df['year']) + ')')
+        # URL end point has a hard limit on the number of characters(200)
+        clean_endpoint = book_link.str.replace(';', '_', regex=False).str[:200]
+        book_link_utf8 = [quote(endpoint) for endpoint in clean_endpoint]
 
-                return get_dewey_decimal(isbn=isbn)
-            except Exception as e:
+        id_group = url_text(df['coverurl']).str.extract(r'([0-9]{1,7})', expand=False)
+        missing_id = id_group.isna()
+        if missing_id.any():
+            print(f'issue with Book cover_url for {missing_id.sum()} row(s): {df.loc[missing_id, "coverurl"].tolist()[:10]}')
+        id_group = id_group.fillna('FIXISSUE')
 
-                title = format_title(row['title'])
+        return base_url + id_group + '/' + df['md5'].map(md5_hex) + '/' + pd.Series(book_link_utf8, index=df.index) + '.pdf'
 
-                return get_dewey_decimal(title=title)
-        print('problem')
+    def get_download_urls(self):
+        base_download_url = f'http://31.42.184.140/main/'
 
-        # Edit max workers if your pc can candle it. The Higher it it the more parallel tasks will be active. Will affect performance
-        df_iterable = self.df.iterrows()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            results = executor.map(get_dcc_via_threading, df_iterable)
-            ddc = [result for result in results]
-        self.df['dewey decimal category'] = ddc
+        with METRICS.stage('url build', rows=self.df.shape[0]):
+            self.df['download link'] = self.make_download_urls(self.df, base_download_url)
+            self.df['uploaded'] = False
+            self.df['upload message'] = 'initial link creation'
+            self.df['status time'] = now()
+
+    def get_ddc(self, engine='threads'):
+        """This setup the dataframe column for the dewey decimal category column.
+        The page is classified as a batch, so each isbn/title is looked up once and the local dewey index
+        and cache are checked before classify. engine='async' runs the remaining lookups on one shared
+        connection pool instead of the thread pool"""
+        with METRICS.stage('dewey', rows=self.df.shape[0]):
+            lookups = self.get_ddc_lookups()
+            network_lookup = async_fetch.run_dewey_lookups if engine == 'async' else None
+            unanswered = set()
+            # Rows with neither a valid isbn nor a usable title are left without a category
+            ddc_by_lookup = get_dewey_decimal_batch([lookup for lookup in lookups if lookup is not None],
+                                                    network_lookup=network_lookup, unanswered=unanswered)
+            self.df['dewey decimal category'] = [ddc_by_lookup.get(lookup) for lookup in lookups]
+            # Dropped by the category filter for now, keyset paging keeps its mark before them so they are retried
+            if self.track_unclassified:
+                self.unclassified_ids.update(str(book_id) for book_id, lookup in zip(self.df['id'], lookups)
+                                             if lookup in unanswered)
+
+    def get_ddc_lookups(self):
+        """Picks the isbn for each row, falling back to the title when the identifier has no valid isbn"""
+        return lookup_pairs(self.df['identifier'], self.df['title'])
 
     def filter_categories(self, category_list):
-        self.df = self.df.dropna()
-        self.df['dewey decimal category'] = np.floor(pd.to_numeric(self.df['dewey decimal category'], errors='coerce')).astype('Int64')
-        self.df = self.df[self.df['dewey decimal category'].isin(category_list)]
+        with METRICS.stage('filter', rows=self.df.shape[0]):
+            self.df = self.df.dropna()
+            self.df['dewey decimal category'] = to_small_int(self.df['dewey decimal category'], DDC_DTYPE, 999)
+            self.df = self.df[self.df['dewey decimal category'].isin(category_list)]
 
     def add_dataframe_to_register(self):
-        try:
-            current_data = pd.read_csv('Book-Register.csv', index_col=[0], dtype={'id': object})
-            new_data = pd.concat([current_data, self.df]).drop_duplicates(subset=['id', 'title'], keep='first')
-            new_data.to_csv('Book-Register.csv')
-            print('file_updated')
-        except:
-            self.df.to_csv('Book-Register.csv')
-            print('file created')
+        with METRICS.stage('register write', rows=self.df.shape[0]):
+            added = self.register.add_rows(self.df)
+        print(f'register updated with {added} rows')
 
     def update_register(self, dataframe):
-        current_data = pd.read_csv('Book-Register.csv', index_col=[0])
-        new_data = pd.concat([current_data, dataframe]).drop_duplicates(subset=['id', 'title'], keep='last')
-        new_data.to_csv('Book-Register.csv')
+        with METRICS.stage('register write', rows=dataframe.shape[0]):
+            self.register.add_rows(dataframe, overwrite=True)
         print('file_updated')
 
     def upload_document_via_threading(self, dataframe_row):
@@ -151,24 +472,38 @@ class LibraryGenesisScraper:
         title = dataframe_row['title']
         year = dataframe_row['year']
         url = dataframe_row['download link']
+        md5 = md5_hex(dataframe_row['md5'])
         document_name = clean_file_name(f'{str(author)[:100]} - {str(title)[:100]} ({year})')
-
-
-        # TODO setup environmental variables for bucket access
-        upload_result = upload_to_bucket(bucket_name='BUCKET',
-                                     key='KEY',
-                                     password='PASS',
-                                     document_url=url,
-                                     document_name=document_name,
-                                     document_id=book_id)
+        object_key = f'ScrapedBooks/{document_name}.pdf'
+
+        with self.md5_lock(md5):
+            stored_key = self.content_store.get_object(md5, BUCKET)
+            if stored_key is not None:
+                time_now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+                print(f'Already in bucket as {stored_key}, skipping upload: {book_id}')
+                upload_result = [True, f'document already in bucket as {stored_key} [{time_now}] {book_id}']
+            else:
+                with METRICS.stage('transfer', rows=1):
+                    # TODO setup environmental variables for bucket access
+                    upload_result = upload_to_bucket(bucket_name='BUCKET',
+                                                     key='KEY',
+                                                     password='PASS',
+                                                     document_url=url,
+                                                     document_name=document_name,
+                                                     document_id=book_id,
+                                                     expected_md5=md5,
+                                                     progress=lambda: self.renew_lease(book_id))
+                if upload_result[0]:
+                    self.content_store.add_object(md5, BUCKET, object_key)
+        # Written straight away so an interrupted run doesn't upload this document again
+        self.register.set_upload_status(book_id, upload_result)
+        self.journal.record(book_id, 0, 'done' if upload_result[0] else 'failed', message=upload_result[1])
 
         return upload_result
 
     def download_files_to_pc_via_threading(self, dataframe_row):
         start_time = time.perf_counter()
 
-        retries = 0
-
         dataframe_row = dataframe_row[1]
         book_id = dataframe_row['id']
         author = dataframe_row['author']
@@ -178,52 +513,191 @@ class LibraryGenesisScraper:
 
 
         document_name = clean_file_name(f'{str(author)[:100]} - {str(title)[:100]} ({year})')
+        file_path = f'./downloads/{document_name}.pdf'
+        # Downloads go to a .part file that is only renamed once complete, so a crash leaves something to resume
+        part_path = f'{file_path}.part'
+        md5 = md5_hex(dataframe_row['md5'])
+        journal_entry = self.journal.get(book_id, 1)
+        if journal_entry is not None and journal_entry[0] == 'done' and exists(file_path):
+            print(f'Already downloaded: {document_name}')
+            return 1
+        with self.md5_lock(md5), METRICS.stage('transfer', rows=1):
+            return self.download_file_to_pc(book_id, md5, url, document_name, file_path, part_path, start_time)
+
+    def finish_complete_part(self, book_id, md5, document_name, file_path, part_path, size):
+        """
+        The mirror answered a resumed download with 416, so part_path is already the whole file.
+        It is kept if its md5 is right, otherwise it is thrown away and the next try starts from scratch
+        """
+        hasher = hashlib.md5()
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        try:
+            check_md5(hasher, md5, book_id)
+        except ContentMismatchError as err:
+            print(f"==> Couldn't save : {document_name}\ \n Error : {err}", file=sys.stderr)
+            os.remove(part_path)
+            self.journal.record(book_id, 1, 'failed', 0, part_path, str(err))
+            return None
+        os.replace(part_path, file_path)
+        self.content_store.add_object(md5, LOCAL, file_path, size)
+        self.journal.record(book_id, 1, 'done', size, file_path)
+        print(f'PDF Saved : \n \"{document_name}\"')
+        return 1
+
+    def download_file_to_pc(self, book_id, md5, url, document_name, file_path, part_path, start_time,
+                            segmented=True):
+        """
+        Does the download for download_files_to_pc_via_threading, unless the same md5 is already on disk.
+        Large files from a mirror that takes Range requests are handed to download_file_segmented.
+        """
+        retries = 0
+        stored_path = self.content_store.get_object(md5, LOCAL)
+        if stored_path is not None:
+            print(f'Already downloaded as {stored_path}, linking: {document_name}')
+            link_local_file(stored_path, file_path)
+            self.journal.record(book_id, 1, 'done', getsize(file_path), file_path, f'same content as {stored_path}')
+            return 1
+        segment_map = load_segment_map(part_path)
+        if segment_map is not None:
+            if segmented:
+                print(f'Resuming {len(segment_map["done"])} segment(s) in: {document_name}')
+                return self.download_file_segmented(book_id, md5, url, document_name, file_path, part_path,
+                                                    segment_map)
+            discard_segments(part_path)
+        offset = getsize(part_path) if exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
         max_retries = 20
         # creating a connection to the pdf
         print(f"Creating the connection ...{book_id}")
-        with requests.get(url, stream=True) as r:
-            while r.status_code != 200:
-                retries += 1
-                sleep_time = 1.2 ** retries
+        r = limited_get(get_http_session(), url, stream=True, headers=headers)
+        while r.status_code not in (200, 206):
+            r.close()
+            if r.status_code == 416 and offset:
+                # The .part file already has every byte the mirror has
+                return self.finish_complete_part(book_id, md5, document_name, file_path, part_path, offset)
+            if permanent_failure(r.status_code):
+                # Not a throttle the limiter backs off for, the queue tries the book again after its backoff instead
                 print(f"Could not download the file '{url}'\n"
                       f"File Name : {document_name}\n"
                       f"Error Code : {r.status_code}\n"
-                      f"Reason : {r.reason}\n"
-                      f"Retries : {retries}/{max_retries}\n"
-                      f"Sleep time in seconds : {sleep_time}\n\n")
-                #time.sleep(sleep_time)
-                time.sleep(sleep_time)
-                if r.status_code != 200 and retries == max_retries:
-                    print(f"Could not download the file '{url}'\n"
-                          f"File Name : {document_name}\n"
-                          f"Error Code : {r.status_code}\n"
-                          f"Reason : {r.reason}\n\n Download attempted cancelled",
-                          file=sys.stderr)
-                    #r.close()
-                    break
-            else:
-                request_time = time.perf_counter()
-                print(f'request took {request_time - start_time} second(s) to finish')
-                # Storing the file as a pdf
-                print(f"Saving the pdf file  :\n\"{document_name}\" ...")
-                with open(f'./downloads/{document_name}.pdf', 'wb') as f:
-                    try:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                        print(f'PDF Saved : \n \"{document_name}\"')
-                        return 1
-                        #print(end='\n\n')
-                    except Exception as err:
-                        print(f"==> Couldn't save : {document_name}\\ \n Error : {err}")
-                        #f.flush()
-                        #r.close()
-                #r.close()
-                retries = 0
+                      f"Reason : {r.reason}\n\n Download attempted cancelled",
+                      file=sys.stderr)
+                self.journal.record(book_id, 1, 'failed', offset, part_path, f'status code {r.status_code}')
+                return None
+            retries += 1
+            print(f"Could not download the file '{url}'\n"
+                  f"File Name : {document_name}\n"
+                  f"Error Code : {r.status_code}\n"
+                  f"Reason : {r.reason}\n"
+                  f"Retries : {retries}/{max_retries}\n\n")
+            if retries == max_retries:
+                print(f"Could not download the file '{url}'\n"
+                      f"File Name : {document_name}\n"
+                      f"Error Code : {r.status_code}\n"
+                      f"Reason : {r.reason}\n\n Download attempted cancelled",
+                      file=sys.stderr)
+                self.journal.record(book_id, 1, 'failed', offset, part_path, f'status code {r.status_code}')
+                return None
+            r = limited_get(get_http_session(), url, stream=True, headers=headers)
+
+        size = segmentable_size(r) if segmented and not offset else None
+        if size is not None:
+            return self.download_file_segmented(book_id, md5, url, document_name, file_path, part_path,
+                                                new_segment_map(size), first_response=r)
+
+        with r:
+            hasher = hashlib.md5()
+            if r.status_code == 200 and offset:
+                print(f'Mirror ignored the range request, starting again: {document_name}')
+                offset = 0
+            elif offset:
+                print(f'Resuming from byte {offset}: {document_name}')
+                # The bytes already on disk are part of the md5 too
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        hasher.update(chunk)
+            request_time = time.perf_counter()
+            print(f'request took {request_time - start_time} second(s) to finish')
+            # Storing the file as a pdf
+            print(f"Saving the pdf file  :\n\"{document_name}\" ...")
+            bytes_since_journal = 0
+            try:
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=BUFFER_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            offset += len(chunk)
+                            bytes_since_journal += len(chunk)
+                            METRICS.add_bytes('transfer', len(chunk))
+                            if bytes_since_journal >= JOURNAL_EVERY_BYTES:
+                                f.flush()
+                                self.journal.record(book_id, 1, 'partial', offset, part_path)
+                                bytes_since_journal = 0
+                                self.renew_lease(book_id)
+                check_md5(hasher, md5, book_id)
+                os.replace(part_path, file_path)
+                self.content_store.add_object(md5, LOCAL, file_path, offset)
+                self.journal.record(book_id, 1, 'done', offset, file_path)
+                print(f'PDF Saved : \n \"{document_name}\"')
+                return 1
+            except LeaseLostError as err:
+                # The worker that has the book now carries on from the .part file
+                print(f'Stopped downloading: {document_name} -- {err}')
+                return None
+            except ContentMismatchError as err:
+                # Resuming a corrupt file would never succeed, so it is thrown away
+                print(f"==> Couldn't save : {document_name}\\ \n Error : {err}", file=sys.stderr)
+                os.remove(part_path)
+                self.journal.record(book_id, 1, 'failed', 0, part_path, str(err))
+                return None
+            except Exception as err:
+                print(f"==> Couldn't save : {document_name}\\ \n Error : {err}")
+                self.journal.record(book_id, 1, 'partial', offset, part_path, str(err))
         end_time = time.perf_counter()
         print(f'download took {end_time - start_time} second(s) to finish')
+
+    def download_file_segmented(self, book_id, md5, url, document_name, file_path, part_path, segment_map,
+                                first_response=None):
+        """download_file_to_pc for a large file, several byte ranges at once into a preallocated .part file"""
+        print(f'Downloading {segment_map["size"]} bytes in segments: {document_name}')
+        try:
+            download_segments(url, part_path, segment_map, first_response,
+                              progress=lambda: self.renew_lease(book_id))
+            # The segments arrive out of order, so the md5 is taken from the finished file
+            hasher = hashlib.md5()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+                    hasher.update(chunk)
+            check_md5(hasher, md5, book_id)
+        except RangesNotSupportedError:
+            print(f'Mirror stopped taking range requests, downloading as one stream: {document_name}')
+            discard_segments(part_path)
+            return self.download_file_to_pc(book_id, md5, url, document_name, file_path, part_path,
+                                            time.perf_counter(), segmented=False)
+        except LeaseLostError as err:
+            print(f'Stopped downloading: {document_name} -- {err}')
+            return None
+        except ContentMismatchError as err:
+            print(f"==> Couldn't save : {document_name}\\ \n Error : {err}", file=sys.stderr)
+            discard_segments(part_path)
+            self.journal.record(book_id, 1, 'failed', 0, part_path, str(err))
+            return None
+        except Exception as err:
+            print(f"==> Couldn't save : {document_name}\\ \n Error : {err}")
+            self.journal.record(book_id, 1, 'partial', bytes_done(segment_map), part_path, str(err))
+            return None
+        os.replace(part_path, file_path)
+        os.remove(segments_path(part_path))
+        self.content_store.add_object(md5, LOCAL, file_path, segment_map['size'])
+        self.journal.record(book_id, 1, 'done', segment_map['size'], file_path)
+        print(f'PDF Saved : \n \"{document_name}\"')
+        return 1
+
     def download_to_pc(self):
-        dataframe = pd.read_csv('Book-Register.csv', index_col=[0], converters={'file uploaded': pd.eval})
+        dataframe = self.register.get_all()
 
         for index, row in dataframe.iterrows():
             author = row['author']
@@ -232,7 +706,7 @@ class LibraryGenesisScraper:
             url = row['download link']
             print(url)
             document_name = f'{author} - {title} ({year})'
-            r = requests.get(url=url, allow_redirects=True)
+            r = get_http_session().get(url=url, allow_redirects=True)
             open(f'./downloads/{document_name}.pdf', 'wb').write(r.content)
 
             # # creating a connection to the pdf
@@ -277,21 +751,77 @@ class LibraryGenesisScraper:
             #         retries = 0
 
 
-    def get_files_from_site(self, download_location):
+    def leased_books(self, download_location, owner):
+        """Leases book ids one at a time for as long as the queue has any ready"""
+        while True:
+            leased = self.queue.lease(download_location, owner)
+            if not leased:
+                return
+            yield leased[0]
+
+    def transfer_leased(self, book_id, download_location, download_function, owner):
+        """Runs one leased transfer and records its result on the queue. Returns True if it succeeded"""
+        rows = self.register.get_by_id(book_id)
+        if rows.empty:
+            self.queue.fail(book_id, download_location, owner, 'not in the register')
+            return False
+        with self.leases_lock:
+            self.leases[str(book_id)] = (download_location, owner)
+        try:
+            result = download_function((book_id, rows.iloc[0]))
+        except Exception as err:
+            result = [False, f'{type(err).__name__}: {err}']
+        finally:
+            with self.leases_lock:
+                self.leases.pop(str(book_id), None)
+        if download_location == 0:
+            ok, message = result
+        else:
+            ok, message = result == 1, 'download failed'
+        if ok:
+            self.queue.complete(book_id, download_location, owner)
+        else:
+            self.queue.fail(book_id, download_location, owner, message)
+        return ok
+
+    def work_from_queue(self, download_location, download_function, window):
+        """
+        Runs transfers from the queue, at most window at once, until it has nothing ready. Returns (succeeded, failed).
+        A book is only leased once there is room for it, so no lease runs down waiting behind other transfers.
+        """
+        owner = lease_owner()
+        succeeded = failed = 0
+        with BoundedExecutor(window=window, name=f'transfer {download_location}') as executor:
+            for book_id, ok in executor.map_as_completed(
+                    lambda book_id: self.transfer_leased(book_id, download_location, download_function, owner),
+                    self.leased_books(download_location, owner)):
+                if ok:
+                    succeeded += 1
+                else:
+                    failed += 1
+        return succeeded, failed
+
+    def get_files_from_site(self, download_location, engine='threads', priority='fifo', window=0):
+        """
+        Uploads (0) or downloads (1) the registered books, or downloads the bucket (2).
+        window is how many transfers the threads engine runs at once, 0 for the location's default.
+        """
         start_time = time.perf_counter()
-        dataframe = pd.read_csv('Book-Register.csv', index_col=[0], converters={'file uploaded': pd.eval})
-
 
         if download_location == 0:
             print('Uploading from library to bucket')
             download_function = self.upload_document_via_threading
-            download_df = dataframe[dataframe['file uploaded'].str[0] == False]
+            download_df = self.register.get_by_upload_status(uploaded=False)
             max_worker = 20
 
         elif download_location == 1:
             print('Downloading from library to local pc')
             download_function = self.download_files_to_pc_via_threading
-            download_df = dataframe
+            download_df = self.register.get_all()
+            # Skip anything the transfer journal says finished in an earlier run
+            completed_ids = self.journal.completed_ids(1)
+            download_df = download_df[~download_df['id'].astype(str).isin(completed_ids)]
+            print(f'Skipping {len(completed_ids)} book(s) already downloaded')
             max_worker = 3
             # self.download_to_pc()
             # return
@@ -302,26 +832,25 @@ class LibraryGenesisScraper:
         else:
             print('Invalid command argument, please use either 0, 1, 2')
         print(f'Number of books that can potentially be downloaded: {download_df.shape[0]}')
-        if download_df.shape[0] > 0:
-            non_uploaded_df_iter = download_df.iterrows()
-            # Edit max workers if your pc can candle it. The Higher it it the more parallel tasks will be active. Will affect performance
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_worker) as executor:
-                results = executor.map(download_function, non_uploaded_df_iter)
-                if download_location == 0:
-                    files_uploaded_list = [result for result in results]
-                    download_df['file uploaded'] = files_uploaded_list
-                    print(f'Total number uploaded: {len([item for item in files_uploaded_list if item[0] == True])}')
-                    self.update_register(download_df)
-                elif download_location == 1:
-                    files_downloaded = [result for result in results]
-                    print(f'Total number downloaded: {len([item for item in files_downloaded if item == 1])}')
-                else:
-                    print('Files downloading to PC.')
-        else:
-            print('no new books added to register')
+        if engine == 'async':
+            # Transfers need the md5 checks, content store, .part resume and queue leases of the threaded functions.
+            # A few big streamed files gain nothing from asyncio, the async engine is only for the dewey lookups
+            print('The async engine only runs the dewey lookups, transfers run on the threads engine')
+        added = self.queue.enqueue_many(download_location, zip(download_df['id'], PRIORITIES[priority](download_df)))
+        print(f'{added} new book(s) queued, queue: {self.queue.stats(download_location)}')
+        # The next book is leased as soon as a transfer finishes, and each one writes its result straight
+        # to the register/journal and the queue, so other processes sharing the queue never get the same book
+        # Edit max workers if your pc can candle it. The Higher it it the more parallel tasks will be active. Will affect performance
+        succeeded, failed = self.work_from_queue(download_location, download_function, window or max_worker)
+        action = 'uploaded' if download_location == 0 else 'downloaded'
+        print(f'Total number {action}: {succeeded} --failed: {failed}')
+        dead_letters = self.queue.dead_letters(download_location)
+        if dead_letters:
+            print(f'{len(dead_letters)} book(s) on the dead letter list, e.g. {dead_letters[:5]}')
 
         end_time = time.perf_counter()
         print(f'Total upload time took {end_time - start_time} second(s) to finish')
+        connection_reuse_report()
 
 
 
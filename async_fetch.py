@@ -0,0 +1,121 @@
+import asyncio
+import concurrent.futures
+from urllib.parse import quote, urlsplit
+
+from dewey_cache import get_dewey_cache
+from dewey_category_check import ddc_from_classify, owi_from_classify
+from rate_limiter import get_limiter, THROTTLE_STATUSES
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def async_engine_available():
+    return aiohttp is not None
+
+
+class AsyncFetcher:
+    """
+    Shares one aiohttp connection pool between every dewey lookup.
+    Requests are paced by the same per host limiters as the threaded requests (rate_limiter.py), so the async
+    lookups get the adaptive rate, concurrency limit and circuit breaker too. HostLimiter.acquire blocks, so it
+    runs on a small thread pool, and each host's semaphore keeps no more waiting there than it can have in flight.
+    Use as an async context manager so the pool is closed at the end of the run.
+    """
+    def __init__(self, total_limit=200, retries=5):
+        if aiohttp is None:
+            raise ImportError('The async engine needs aiohttp, install it with "pip install aiohttp"')
+        self.total_limit = total_limit
+        self.retries = retries
+        self.semaphores = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.total_limit, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None, sock_read=120))
+        self.acquire_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.total_limit)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.acquire_pool.shutdown(wait=False)
+
+    def host_semaphore(self, limiter):
+        if limiter.host not in self.semaphores:
+            self.semaphores[limiter.host] = asyncio.Semaphore(limiter.max_concurrency)
+        return self.semaphores[limiter.host]
+
+    async def get_bytes(self, url):
+        """
+        Returns the body of url, or None once the retries have run out. Throttling, 5xx and connection errors
+        are tried again once the host's limiter allows, any other status is final
+        """
+        limiter = get_limiter(urlsplit(url).hostname)
+        loop = asyncio.get_running_loop()
+        async with self.host_semaphore(limiter):
+            for retry in range(self.retries):
+                start = await loop.run_in_executor(self.acquire_pool, limiter.acquire)
+                try:
+                    async with self.session.get(url) as response:
+                        status = response.status
+                        body = await response.read() if status == 200 else None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    limiter.release(start, throttled=True)
+                    print(f'request failed --url: {url} --error: {err}')
+                    continue
+                throttled = status in THROTTLE_STATUSES or status >= 500
+                limiter.release(start, throttled=throttled)
+                if status == 200:
+                    return body
+                print(f'no connection --status code:{status} --url: {url}')
+                if not throttled:
+                    return None
+        return None
+
+
+async def get_dewey_decimal_async(fetcher, endpoint_key, endpoint_val, use_cache=True):
+    """Async version of dewey_category_check.get_dewey_decimal sharing the same on-disk cache"""
+    dewey_cache = get_dewey_cache() if use_cache else None
+    if dewey_cache is not None:
+        cache_hit, ddc = dewey_cache.get(endpoint_key, endpoint_val)
+        if cache_hit:
+            return ddc
+
+    url_value = endpoint_val if endpoint_key == 'isbn' else quote(endpoint_val)
+    content = await fetcher.get_bytes(f'http://classify.oclc.org/classify2/Classify?{endpoint_key}={url_value}')
+    if content is None:
+        return None
+    import xmltodict
+    try:
+        xml_parse = xmltodict.parse(content)
+        response_code = xml_parse['classify']['response']['@code']
+        owi = owi_from_classify(xml_parse) if response_code == '4' else None
+    except Exception as err:
+        # Like the threaded lookups, an answer that can't be read isn't cached and is tried again next run
+        print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n--Error: {type(err).__name__}: {err}')
+        return None
+
+    if response_code == '2':
+        ddc = ddc_from_classify(xml_parse)
+    elif response_code == '4':
+        ddc = await get_dewey_decimal_async(fetcher, 'owi', owi, use_cache=use_cache)
+    elif response_code in ('101', '102'):
+        ddc = None
+    else:
+        # Unexpected errors aren't cached so they are tried again next run
+        print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n--response code: {response_code}')
+        return None
+
+    if dewey_cache is not None:
+        dewey_cache.set(endpoint_key, endpoint_val, ddc)
+    return ddc
+
+
+def run_dewey_lookups(lookups):
+    """Takes a list of (endpoint_key, endpoint_val) pairs and returns their dewey decimal categories in order"""
+    async def run():
+        async with AsyncFetcher() as fetcher:
+            return await asyncio.gather(*[get_dewey_decimal_async(fetcher, endpoint_key, endpoint_val)
+                                          for endpoint_key, endpoint_val in lookups])
+    return asyncio.run(run())
@@ -1,96 +1,176 @@
-import boto3
-from botocore.exceptions import ClientError
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from connection_pool import get_retry_session, get_s3_client
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from content_store import ContentMismatchError, check_md5
+from s3_inventory import S3Inventory
+from rate_limiter import limited_get, get_limiter
+from metrics import METRICS
+from bounded_executor import BoundedExecutor
+import hashlib
 
-from os.path import abspath
-from io import BytesIO
+from os.path import abspath, exists, getsize
 import time
 from datetime import datetime
 from urllib.parse import quote_plus
 
+# s3 needs every multipart part apart from the last to be at least 5MB
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+S3_RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
+                       'ThrottlingException',
+                       'SlowDown')
+# Errors from the mirror dropping the connection part way through a download
+SOURCE_STREAM_EXCEPTIONS = (requests.exceptions.RequestException, Urllib3HTTPError, ConnectionError)
 
 
-def print_s3_inventory(bucket_name, key, password):
-    session = boto3.Session(aws_access_key_id=key, aws_secret_access_key=password)
-    s3 = session.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    book_list = []
-    for item in bucket.objects.all():
-        if 'ScrapedBooks' in item.key:
-            book_location = item.key
-            book_list.append(book_location.split('/'))
-
-    book_list_clean = []
-    for list in book_list:
-        book_list_clean.append(list[1])
+def print_s3_inventory(bucket_name, key, password, max_age=0):
+    """Prints and returns the names of the books in the bucket, from the local inventory index"""
+    inventory = S3Inventory()
+    inventory.refresh(get_s3_client(key, password), bucket_name, prefix='ScrapedBooks/', max_age=max_age)
+    book_list_clean = [book_location.split('/', 1)[1] for book_location in inventory.keys(bucket_name, 'ScrapedBooks/')]
     print(len(book_list_clean))
     #print(book_list_clean)
     return book_list_clean
 
 
-def requests_retry_session(retries=25, backoff_factor=0.3, status_forcelist=(500, 502, 504, 503), session=None):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-
-def upload_to_bucket(bucket_name, key, password, document_url, document_name, document_id):
+def upload_to_bucket(bucket_name, key, password, document_url, document_name, document_id, expected_md5=None,
+                     progress=None):
+    """Streams the document from the mirror straight into the bucket, only holding one multipart part in memory.
+    If expected_md5 is given the upload is only completed when the bytes match it.
+    progress() is called after each uploaded part, anything it raises aborts the upload and is raised here."""
     time_now = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    RETRY_EXCEPTIONS = ('ProvisionedThroughputExceededException',
-                        'ThrottlingException')
     start_time = time.perf_counter()
     print(f'requesting document from register: {document_id}')
-    #response = requests.get(document_url)
+    from botocore.exceptions import ClientError
     try:
-        response = requests_retry_session().get(document_url)
-    except Exception as err:
-        print(err)
-        response = None
-    request_time = time.perf_counter()
-    print(f'request took {request_time - start_time} second(s) to finish')
-    retries = 0
-    retry = True
-    while retry and retries <= 3:
-        try:
-            print(f'Connecting to bucket...{document_id}')
-            session = boto3.Session(aws_access_key_id=key, aws_secret_access_key=password)
-            s3 = session.resource('s3')
-            bytesIO = BytesIO(response.content)
+        s3_client = get_s3_client(key, password)
+        stream_to_bucket(s3_client=s3_client,
+                         bucket_name=bucket_name,
+                         object_key=f'ScrapedBooks/{document_name}.pdf',
+                         document_url=document_url,
+                         document_id=document_id,
+                         expected_md5=expected_md5,
+                         progress=progress)
+        print(f'Upload complete: {document_id}')
+        result = [True, f'document successfully uploaded [{time_now}] {document_id}']
+    except (ClientError, ContentMismatchError) + SOURCE_STREAM_EXCEPTIONS as err:
+        print(f'Upload failed: {document_id} -- {err}')
+        result = [False, f'document failed to upload [{time_now}] - Error - {err}']
+    end_time = time.perf_counter()
+    print(f'upload took {end_time - start_time} second(s) to finish {document_id}')
+    return result
 
-            print(f'uploading: {document_id}')
-            s3.Object(bucket_name, f'ScrapedBooks/{document_name}.pdf').put(Body=bytesIO)
 
-            print(f'Upload complete: {document_id}')
-            result = [True, f'document successfully uploaded [{time_now}] {document_id}']
-            retries = 0
+def open_document_stream(document_url, offset=0):
+    """Opens a streamed request for the document, starting at byte offset when resuming"""
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    response = limited_get(get_retry_session(), document_url, stream=True, headers=headers)
+    expected_status = 206 if offset else 200
+    if response.status_code != expected_status:
+        response.close()
+        raise ConnectionError(f'could not open {document_url} at byte {offset} --status code: {response.status_code}')
+    return response
 
+
+def read_part(response, part_size):
+    """Reads up to part_size bytes from the response. Anything shorter than part_size means the download has finished"""
+    part = bytearray()
+    while len(part) < part_size:
+        data = response.raw.read(part_size - len(part), decode_content=True)
+        if not data:
             break
+        part += data
+    return part
+
+
+def call_s3_with_retries(s3_function, max_retries=3, **kwargs):
+    """Calls s3_function through the s3 host limiter, which slows down and tries again when s3 is throttling"""
+    from botocore.exceptions import ClientError
+    limiter = get_limiter('s3')
+    for retries in range(max_retries + 1):
+        start = limiter.acquire()
+        try:
+            result = s3_function(**kwargs)
         except ClientError as cerr:
-            if cerr.response['Error']['Code'] not in RETRY_EXCEPTIONS:
+            throttled = cerr.response['Error']['Code'] in S3_RETRY_EXCEPTIONS
+            limiter.release(start, throttled=throttled)
+            if not throttled or retries == max_retries:
                 raise
-            print(f'(Error:{response.status_code} --  -- {document_id})  Slowdown! Maybe try using fewer workers. Retries = {retries}')
-            result = [False, f'document failed to upload [{time_now}] - Error - {cerr}']
-            time.sleep(2 ** retries)
-            retries += 1
-        except AttributeError as aerr:
-            print(aerr)
-            result = [False, f'document failed to upload [{time_now}] - Error - {aerr}']
-            time.sleep(2 ** retries)
-            retries += 1
-    end_time = time.perf_counter()
-    print(f'upload took {end_time - start_time} second(s) to finish {document_id}')
-    return result
+            print(f'(Error:{cerr.response["Error"]["Code"]})  Slowdown! Maybe try using fewer workers. Retries = {retries}')
+            continue
+        except Exception:
+            limiter.release(start, throttled=True)
+            raise
+        limiter.release(start)
+        return result
+
+
+def stream_to_bucket(s3_client, bucket_name, object_key, document_url, document_id,
+                     part_size=MULTIPART_PART_SIZE, max_source_retries=5, expected_md5=None, progress=None):
+    """
+    Pipes the document at document_url into an s3 multipart upload one part at a time and returns its size.
+    If the mirror drops the connection the download is resumed with a Range request from the end of the
+    last uploaded part, so parts already in s3 aren't sent again. Documents smaller than one part use a single put.
+    The bytes are hashed on the way through and the upload is aborted if they don't match expected_md5.
+    """
+    hasher = hashlib.md5()
+    response = open_document_stream(document_url)
+    upload_id = None
+    parts = []
+    offset = 0
+    source_retries = 0
+    try:
+        while True:
+            try:
+                part = read_part(response, part_size)
+            except SOURCE_STREAM_EXCEPTIONS as err:
+                source_retries += 1
+                if source_retries > max_source_retries:
+                    raise
+                print(f'Connection dropped at byte {offset}, resuming: {document_id} -- {err}')
+                response.close()
+                response = open_document_stream(document_url, offset)
+                continue
+
+            hasher.update(part)
+            METRICS.add_bytes('transfer', len(part))
+            if upload_id is None and len(part) < part_size:
+                check_md5(hasher, expected_md5, document_id)
+                print(f'uploading: {document_id}')
+                call_s3_with_retries(s3_client.put_object, Bucket=bucket_name, Key=object_key, Body=bytes(part))
+                return len(part)
+            if upload_id is None:
+                print(f'uploading in parts: {document_id}')
+                upload_id = call_s3_with_retries(s3_client.create_multipart_upload,
+                                                 Bucket=bucket_name, Key=object_key)['UploadId']
+            if part:
+                part_number = len(parts) + 1
+                uploaded_part = call_s3_with_retries(s3_client.upload_part,
+                                                     Bucket=bucket_name,
+                                                     Key=object_key,
+                                                     UploadId=upload_id,
+                                                     PartNumber=part_number,
+                                                     Body=bytes(part))
+                parts.append({'PartNumber': part_number, 'ETag': uploaded_part['ETag']})
+                offset += len(part)
+                if progress is not None:
+                    progress()
+            if len(part) < part_size:
+                break
+
+        check_md5(hasher, expected_md5, document_id)
+        call_s3_with_retries(s3_client.complete_multipart_upload,
+                             Bucket=bucket_name,
+                             Key=object_key,
+                             UploadId=upload_id,
+                             MultipartUpload={'Parts': parts})
+        return offset
+    except Exception:
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+    finally:
+        response.close()
+
 
 def clean_file_name(file_name):
     file_name = file_name.replace('(None) - ', '')
@@ -104,38 +184,55 @@ def clean_file_name(file_name):
             file_name = file_name.replace(c, '_')
     return file_name
 
-def download_from_bucket():
+def download_book_from_bucket(bucket_name, book_location, file_path):
+    """Streams one object from the bucket's public url to file_path. Returns True once saved"""
+    location_string = 'ScrapedBooks/'
+    base_url = f'https://{bucket_name}.s3.eu-west-2.amazonaws.com/'
+    book = str(book_location.split(location_string, 1)[1])
+    download_url = f'{base_url}{location_string}{quote_plus(book)}'
+    print(f'Requesting PDF... {book}')
+    try:
+        with METRICS.stage('transfer', rows=1), \
+                limited_get(get_retry_session(), download_url, allow_redirects=True, stream=True) as response:
+            response.raise_for_status()
+            with open(file_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    f.write(chunk)
+                    METRICS.add_bytes('transfer', len(chunk))
+        print(f'Downloaded: {book}')
+        return True
+    except Exception as err:
+        print(f'Unable to download: {book}\n{err}')
+        return False
+
+
+def download_from_bucket(max_workers=8, max_age=0):
+    """Downloads the books in the bucket that are missing or have changed on this machine"""
     start_time = time.perf_counter()
     bucket_name = 'BUCKET'
     print('Connecting to bucket....')
-    session = boto3.Session(aws_access_key_id='KEY', aws_secret_access_key='PASS')
-    s3 = session.resource('s3')
-    bucket = s3.Bucket(bucket_name)
     location_string = 'ScrapedBooks/'
-    bucket_book_count = len([book_item for book_item in bucket.objects.all() if location_string in book_item.key])
-    print(f'Number of books that can potentially be downloaded: {bucket_book_count}')
+    inventory = S3Inventory()
+    inventory.refresh(get_s3_client('KEY', 'PASS'), bucket_name, prefix=location_string, max_age=max_age)
+    bucket_objects = inventory.objects(bucket_name, location_string)
+    print(f'Number of books that can potentially be downloaded: {len(bucket_objects)}')
+
+    to_download = []
+    for book_location, size, etag, local_etag in bucket_objects:
+        book = str(book_location.split(location_string, 1)[1])
+        file_path = f'./downloads/{book[:200]}.pdf'
+        if local_etag == etag and exists(file_path) and getsize(file_path) == size:
+            continue
+        to_download.append((book_location, etag, file_path))
+    print(f'Number of books missing or changed on this machine: {len(to_download)}')
 
-    base_url = f'https://{bucket_name}.s3.eu-west-2.amazonaws.com/'
     count = 0
-    for item in bucket.objects.all():
-        if 'ScrapedBooks' in item.key:
-            book_location = item.key
-            book = str(book_location.split(location_string, 1)[1])
-            download_url = f'{base_url}{location_string}{quote_plus(book)}'
-            print('Requesting PDF...')
-            try:
-                with requests_retry_session(retries=5).get(url=download_url, allow_redirects=True) as response:
-                    print(f'Request Success! Downloading: {book}')
-                    request_time = time.perf_counter()
-                    print(f'request took {request_time - start_time} second(s) to finish')
-                    with open(f'./downloads/{book[:200]}.pdf', 'wb') as f:
-                        f.write(response.content)
-                        f.close()
-                    response.close()
-                print(f'Downloaded: {book}')
+    with BoundedExecutor(window=max_workers, name='bucket') as executor:
+        for (book_location, etag, file_path), downloaded in executor.map_as_completed(
+                lambda book: download_book_from_bucket(bucket_name, book[0], book[2]), to_download):
+            if downloaded:
+                inventory.mark_downloaded(bucket_name, book_location, etag)
                 count += 1
-            except Exception as err:
-                print(f'Unable to download: {response.status_code}\n{err}')
     end_time = time.perf_counter()
     print(f'download took {end_time - start_time} second(s) to finish')
     print(f'Total number of books downloaded to your local machine: {count}\nDownload Location: {abspath("./downloads")}')
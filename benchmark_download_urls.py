@@ -0,0 +1,79 @@
+"""
+Compares the per-row url_maker loop get_download_urls used to run with the column-wise make_download_urls.
+Run with: python3 benchmark_download_urls.py --rows 100000
+"""
+import argparse
+import random
+import string
+import time
+import pandas as pd
+from LibraryGenesis import LibraryGenesisScraper
+
+BASE_URL = 'http://31.42.184.140/main/'
+
+
+def make_fixture(rows, seed=0):
+    """Builds a dataframe shaped like a filtered json.php page"""
+    rng = random.Random(seed)
+
+    def words(count):
+        return ' '.join(''.join(rng.choices(string.ascii_letters, k=rng.randint(3, 10))) for _ in range(count))
+
+    records = []
+    for book_id in range(rows):
+        records.append({'id': str(book_id),
+                        'author': f'{words(2)}; {words(2)}' if rng.random() < 0.3 else words(2),
+                        'title': words(rng.randint(2, 30)),
+                        'year': rng.randint(1990, 2021),
+                        'md5': ''.join(rng.choices('0123456789ABCDEF', k=32)),
+                        # A few broken cover urls so the FIXISSUE path is exercised too
+                        'coverurl': '' if rng.random() < 0.01 else f'{rng.randint(0, 2999999)}/{book_id}.jpg'})
+    df = pd.DataFrame(records)
+    # Some missing authors, titles and years, which the register can have
+    for column in ('author', 'title', 'year'):
+        df.loc[df.sample(frac=0.01, random_state=seed).index, column] = None
+    df['year'] = df['year'].astype('Int64')
+    return df
+
+
+def iterrows_urls(scraper, df):
+    """The per-row loop get_download_urls used before make_download_urls"""
+    download_links = []
+    for index, row in df.iterrows():
+        download_links.append(scraper.url_maker(base_url=BASE_URL,
+                                                author=row['author'],
+                                                title=row['title'],
+                                                year=row['year'],
+                                                md5=row['md5'],
+                                                coverurl=row['coverurl']))
+    return download_links
+
+
+def time_it(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks download url construction')
+    parser.add_argument('--rows', default=100000, type=int, help='Number of rows in the fixture-(default: 100,000)')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs of each implementation, the best is kept-(default: 3)')
+    args = parser.parse_args()
+
+    scraper = LibraryGenesisScraper()
+    fixture = make_fixture(args.rows)
+
+    iterrows_time, iterrows_result = time_it(lambda: iterrows_urls(scraper, fixture), args.repeat)
+    vectorized_time, vectorized_result = time_it(lambda: scraper.make_download_urls(fixture, BASE_URL), args.repeat)
+
+    if list(vectorized_result) != iterrows_result:
+        raise SystemExit('make_download_urls output differs from url_maker')
+    print(f'rows: {args.rows}')
+    print(f'iterrows + url_maker: {iterrows_time:.3f}s ({args.rows / iterrows_time:,.0f} rows/s)')
+    print(f'make_download_urls:   {vectorized_time:.3f}s ({args.rows / vectorized_time:,.0f} rows/s)')
+    print(f'speed up: {iterrows_time / vectorized_time:.1f}x')
@@ -0,0 +1,109 @@
+"""
+Compares the per-row format_isbn/format_title loop get_ddc_lookups used to run with the column-wise lookup_pairs.
+Exits with an error if lookup_pairs doesn't find the isbn each fixture row was made with.
+Run with: python3 benchmark_lookup_keys.py --rows 10000
+"""
+import argparse
+import random
+import re
+import pandas as pd
+from benchmark_download_urls import time_it
+from dewey_category_check import lookup_pairs
+from offline_services import isbn_check_digit
+
+
+def isbn_10_check_digit(first_nine):
+    check = (11 - sum((10 - position) * int(digit) for position, digit in enumerate(first_nine)) % 11) % 11
+    return 'X' if check == 10 else str(check)
+
+
+def make_fixture(rows, seed=0):
+    """
+    identifier and title columns shaped like a json.php page: isbn-13s, isbn-10s, lists, junk and blanks.
+    expected is the isbn-13 lookup_pairs should find for each row, None when there isn't a valid isbn
+    """
+    rng = random.Random(seed)
+    words = ('data', 'systems', "author's", 'theory', 'introduction', 'advanced', 'practical', 'history', 'guide')
+    identifiers = []
+    expected = []
+    for _ in range(rows):
+        first_twelve = '978' + ''.join(rng.choices('0123456789', k=9))
+        isbn_13 = f'{first_twelve}{isbn_check_digit(first_twelve)}'
+        isbn_10 = f'{first_twelve[3:]}{isbn_10_check_digit(first_twelve[3:])}'
+        hyphenated_10 = f'{isbn_10[0]}-{isbn_10[1:4]}-{isbn_10[4:9]}-{isbn_10[9]}'
+        kind = rng.random()
+        expected.append(isbn_13)
+        if kind < 0.3:
+            identifiers.append(isbn_13)
+        elif kind < 0.45:
+            identifiers.append(f'{isbn_13},{isbn_10}')
+        elif kind < 0.55:
+            # Lists separated by spaces, their separators mustn't join the isbns into one long number
+            identifiers.append(rng.choice([f'{isbn_10} {isbn_13}', f'{hyphenated_10} {isbn_13}', f'{isbn_10}; {isbn_13}']))
+        elif kind < 0.65:
+            identifiers.append(rng.choice([f'{isbn_13[:3]}-{isbn_13[3]}-{isbn_13[4:7]}-{isbn_13[7:12]}-{isbn_13[12]}',
+                                           f'{isbn_13[:3]} {isbn_13[3]} {isbn_13[4:7]} {isbn_13[7:12]} {isbn_13[12]}',
+                                           hyphenated_10]))
+        elif kind < 0.75:
+            # Right length, wrong check digit
+            identifiers.append(f'{first_twelve}{(int(isbn_13[-1]) + 1) % 10}')
+            expected[-1] = None
+        else:
+            identifiers.append('')
+            expected[-1] = None
+    titles = [' '.join(rng.choices(words, k=rng.randint(1, 8))).title() for _ in range(rows)]
+    return pd.DataFrame({'identifier': identifiers, 'title': titles, 'expected': expected})
+
+
+def per_row_lookups(df):
+    """The loop get_ddc_lookups used before lookup_pairs, with IndexError as the fall back to the title"""
+    def format_isbn(num):
+        matches = [x.group() for x in re.finditer(r"\d{10}(\d{3})?|(\d{3}-\d{1}-\d{3}-\d{5}-\d{1})", num)]
+        regex = re.sub(r"[^a-zA-Z0-9]+", ' ', matches[0])
+        return ''.join(regex.split(' '))
+
+    def format_title(string):
+        title_no_special = re.sub(r"[^a-zA-Z0-9]+", ' ', string)
+        try:
+            title_no_s = title_no_special.split(' s ')
+            title = title_no_s[0] if len(title_no_s[0]) > len(title_no_s[1]) else title_no_s[1]
+            return ' '.join(title.split(' ')[0:-1])
+        except IndexError:
+            return title_no_special
+
+    lookups = []
+    for index, row in df.iterrows():
+        try:
+            lookups.append(('isbn', format_isbn(row['identifier'])))
+        except Exception:
+            lookups.append(('title', format_title(row['title'])))
+    return lookups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks building the classify lookups for a page')
+    parser.add_argument('--rows', default=10000, type=int, help='Number of rows in the fixture-(default: 10,000)')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs of each implementation, the best is kept-(default: 5)')
+    args = parser.parse_args()
+
+    fixture = make_fixture(args.rows)
+    per_row_time, per_row_result = time_it(lambda: per_row_lookups(fixture), args.repeat)
+    batch_time, batch_result = time_it(lambda: lookup_pairs(fixture['identifier'], fixture['title']), args.repeat)
+
+    invalid_sent = sum(1 for old, new in zip(per_row_result, batch_result) if old[0] == 'isbn' and new != old
+                       and (new is None or new[0] == 'title'))
+    print(f'rows: {args.rows}')
+    print(f'per row format_isbn/format_title: {per_row_time * 1000:.1f}ms ({args.rows / per_row_time:,.0f} rows/s)')
+    print(f'lookup_pairs:                     {batch_time * 1000:.1f}ms ({args.rows / batch_time:,.0f} rows/s)')
+    print(f'speed up: {per_row_time / batch_time:.1f}x')
+    print(f'invalid isbns no longer sent to classify: {invalid_sent}')
+    print(f'rows with nothing to look up: {sum(1 for lookup in batch_result if lookup is None)}')
+    # expected comes back from pandas with NaN for the rows without an isbn
+    found = [lookup[1] if lookup is not None and lookup[0] == 'isbn' else None for lookup in batch_result]
+    wrong = [(identifier, isbn, found_isbn) for identifier, isbn, found_isbn
+             in zip(fixture['identifier'], fixture['expected'], found)
+             if (isbn if isinstance(isbn, str) else None) != found_isbn]
+    if wrong:
+        raise SystemExit(f'{len(wrong)} row(s) got the wrong isbn, e.g. ' +
+                         ', '.join(f'{identifier!r} -> {found_isbn} (expected {isbn})'
+                                   for identifier, isbn, found_isbn in wrong[:3]))
@@ -0,0 +1,172 @@
+"""
+Runs the whole pipeline against the local stand-ins in offline_services.py, so performance can be measured
+(and regressions caught) without network access. parse_library and the three download_library locations are
+driven through the same functions main.py calls, in a throwaway working directory.
+Run with: python3 benchmark_pipeline.py --records_per_year 2000 --pdf_size 131072
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import connection_pool
+import rate_limiter
+from connection_pool import get_http_session, get_retry_session, HTTP_POOL_SIZE
+from main import run_library_parse
+from LibraryGenesis import LibraryGenesisScraper
+from metrics import METRICS
+from offline_services import ServiceConfig, serve, service_targets, RedirectAdapter
+
+PHASES = ('parse', 'upload', 'download', 'bucket')
+DOWNLOAD_LOCATIONS = {'upload': 0, 'download': 1, 'bucket': 2}
+
+
+def start_services(config):
+    """Starts the stand-ins in their own process, so their memory isn't counted in the pipeline's peak RSS"""
+    counters = {name: multiprocessing.Value('q', 0) for name in ('records', 'pdf_bytes', 's3_bytes')}
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(config, port_queue, counters), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=30), counters
+
+
+def point_pipeline_at(base_url, real_limits):
+    """Routes the shared sessions and the s3 client to the stand-ins"""
+    connection_pool.S3_ENDPOINT_URL = base_url
+    targets = service_targets(base_url)
+    for session in (get_http_session(), get_retry_session()):
+        adapter = RedirectAdapter(targets, max_retries=session.get_adapter('https://').max_retries,
+                                  pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    if not real_limits:
+        # The stand-ins don't need politeness pacing, so only the concurrency limits are kept
+        for limits in list(rate_limiter.HOST_LIMITS.values()) + [rate_limiter.DEFAULT_LIMITS]:
+            limits['rate'] = 100000
+            limits['burst'] = 100000
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_phase(phase, args):
+    if phase == 'parse':
+        run_library_parse(start_year=args.start_year,
+                          end_year=args.start_year + args.years,
+                          language='english',
+                          starting_limit=0,
+                          max_limit=args.max_limit,
+                          batch_size=args.batch_size,
+                          in_flight=args.in_flight,
+                          paging=args.paging,
+                          page_cache=args.page_cache,
+                          page_max_age=args.page_max_age)
+    else:
+        LibraryGenesisScraper().get_files_from_site(DOWNLOAD_LOCATIONS[phase])
+
+
+def measure_phase(phase, args, counters):
+    before = METRICS.snapshot().get('transfer', {}).get('bytes', 0)
+    records_before = counters['records'].value
+    start_time = time.perf_counter()
+    with open(os.devnull, 'w') if not args.verbose else contextlib.nullcontext(sys.stdout) as output:
+        with contextlib.redirect_stdout(output):
+            run_phase(phase, args)
+    seconds = time.perf_counter() - start_time
+    transferred = METRICS.snapshot().get('transfer', {}).get('bytes', 0) - before
+    records = counters['records'].value - records_before
+    return {'phase': phase,
+            'seconds': round(seconds, 3),
+            'records': records,
+            'records_per_second': round(records / seconds, 1) if seconds else 0,
+            'mb': round(transferred / (1024 * 1024), 2),
+            'mb_per_second': round(transferred / (1024 * 1024) / seconds, 2) if seconds else 0,
+            'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the scraper end to end against local stand-ins for '
+                                                 'libgen, classify and s3')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help=f'Comma separated phases to run, in order-(default: {",".join(PHASES)})')
+    parser.add_argument('--start_year', default=2018, type=int, help='First year parsed-(default: 2018)')
+    parser.add_argument('--years', default=1, type=int, help='Number of years parsed-(default: 1)')
+    parser.add_argument('--records_per_year', default=2000, type=int,
+                        help='Books json.php has for each year-(default: 2,000)')
+    parser.add_argument('--max_limit', default=1000, type=int, help='json.php page size-(default: 1,000)')
+    parser.add_argument('--batch_size', default=0, type=int, help='Passed to run_library_parse-(default: 0)')
+    parser.add_argument('--in_flight', default=0, type=int, help='Passed to run_library_parse-(default: 0)')
+    parser.add_argument('--paging', default='offset', choices=['offset', 'keyset'],
+                        help='Passed to run_library_parse-(default: offset)')
+    parser.add_argument('--page_cache', default='off', choices=['off', 'revalidate', 'replay'],
+                        help='Passed to run_library_parse, run parse twice to time the cached pages-(default: off)')
+    parser.add_argument('--page_max_age', default=86400, type=float,
+                        help='Passed to run_library_parse, 0 revalidates every page-(default: 86,400)')
+    parser.add_argument('--no_etags', action='store_true',
+                        help="Stand-in json.php pages don't send an ETag, so stale pages are fetched again")
+    parser.add_argument('--pdf_size', default=128 * 1024, type=int,
+                        help='Size of every pdf in bytes, above 8MB uploads go multipart-(default: 131,072)')
+    parser.add_argument('--latency', default=0.0, type=float, help='Seconds added to every response-(default: 0)')
+    parser.add_argument('--error_rate', default=0.0, type=float,
+                        help='Share of requests answered with a 503-(default: 0)')
+    parser.add_argument('--bandwidth', default=0, type=int,
+                        help='Bytes per second each pdf connection is limited to, 0 for no limit-(default: 0)')
+    parser.add_argument('--real_limits', action='store_true',
+                        help='Keep the per host request rates from rate_limiter.py instead of lifting them')
+    parser.add_argument('--min_records_per_second', default=0.0, type=float,
+                        help='Exit with an error if the parse phase is slower than this-(default: 0)')
+    parser.add_argument('--min_mb_per_second', default=0.0, type=float,
+                        help='Exit with an error if a transfer phase is slower than this-(default: 0)')
+    parser.add_argument('--output', default=None, help='Append the results to this file as json lines')
+    parser.add_argument('--keep_dir', action='store_true', help="Don't delete the working directory afterwards")
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    args = parser.parse_args()
+
+    phases = [phase for phase in args.phases.split(',') if phase]
+    unknown = set(phases) - set(PHASES)
+    if unknown:
+        raise SystemExit(f'unknown phase(s): {", ".join(sorted(unknown))}')
+
+    config = ServiceConfig(records_per_year=args.records_per_year, pdf_size=args.pdf_size,
+                           latency=args.latency, error_rate=args.error_rate, bandwidth=args.bandwidth,
+                           json_etags=not args.no_etags)
+    service_process, port, counters = start_services(config)
+    working_dir = tempfile.mkdtemp(prefix='book-scraper-benchmark-')
+    original_dir = os.getcwd()
+    results = []
+    try:
+        # The register, caches and downloads are all relative paths, so they end up in working_dir
+        os.chdir(working_dir)
+        os.makedirs('downloads')
+        point_pipeline_at(f'http://127.0.0.1:{port}', args.real_limits)
+        for phase in phases:
+            results.append(measure_phase(phase, args, counters))
+            print(json.dumps(results[-1]))
+    finally:
+        os.chdir(original_dir)
+        service_process.terminate()
+        if args.keep_dir:
+            print(f'working directory kept at {working_dir}')
+        else:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    METRICS.print_summary()
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps({'timestamp': time.time(), **result}) + '\n')
+
+    failures = [f'{result["phase"]}: {result["records_per_second"]} records/s' for result in results
+                if result['phase'] == 'parse' and result['records_per_second'] < args.min_records_per_second]
+    failures += [f'{result["phase"]}: {result["mb_per_second"]} MB/s' for result in results
+                 if result['phase'] != 'parse' and result['mb_per_second'] < args.min_mb_per_second]
+    if failures:
+        raise SystemExit(f'below the minimum throughput -- {"; ".join(failures)}')
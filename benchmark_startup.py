@@ -0,0 +1,72 @@
+"""
+Measures how long main.py takes to import with python's -X importtime, and fails when startup goes over budget
+or a heavy dependency is loaded by a command that doesn't use it.
+Run with: python3 benchmark_startup.py --budget_ms 150
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# (python arguments, modules that mustn't be imported) for each way the scraper is started.
+# bucket and parse import what download_library -dl 2 and parse_library load before they touch the network
+SCENARIOS = {'help': (['main.py', '-h'], ('pandas', 'numpy', 'boto3', 'botocore', 'xmltodict', 'requests')),
+             'bucket': (['-c', 'import main, aws_interface'], ('pandas', 'numpy', 'xmltodict')),
+             'parse': (['-c', 'import main, LibraryGenesis, register_shards'], ('boto3', 'botocore', 'xmltodict'))}
+
+
+def import_times(python_args):
+    """Runs python with -X importtime, returns ({top level module: cumulative ms}, every module imported)"""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', *python_args], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    if completed.returncode != 0:
+        raise SystemExit(f'{" ".join(python_args)} failed:\n{completed.stderr}')
+    top_level = {}
+    modules = set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Modules imported by another module are indented under it
+        if not name[1:].startswith(' '):
+            top_level[name.strip()] = int(cumulative) / 1000
+        modules.add(name.strip().split('.')[0])
+    return top_level, modules
+
+
+def measure_scenario(name, repeat):
+    """Best of repeat runs, returns (total ms, {top level module: cumulative ms}, modules imported)"""
+    python_args, _ = SCENARIOS[name]
+    runs = [import_times(python_args) for _ in range(repeat)]
+    top_level, modules = min(runs, key=lambda run: sum(run[0].values()))
+    return sum(top_level.values()), top_level, modules
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the scraper's startup time")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Comma separated scenarios to run-(default: {",".join(SCENARIOS)})')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs of each scenario, the fastest is kept-(default: 5)')
+    parser.add_argument('--budget_ms', default=150.0, type=float,
+                        help='Exit with an error if "main.py -h" spends longer than this importing-(default: 150)')
+    parser.add_argument('--top', default=5, type=int, help='Slowest top level imports listed-(default: 5)')
+    args = parser.parse_args()
+
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'unknown scenario(s): {", ".join(sorted(unknown))}')
+
+    failures = []
+    for scenario in scenarios:
+        total, top_level, modules = measure_scenario(scenario, args.repeat)
+        print(f'{scenario}: {total:.1f}ms importing {len(modules)} package(s)')
+        for module, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {cumulative:8.1f}ms  {module}')
+        unwanted = sorted(set(SCENARIOS[scenario][1]) & modules)
+        if unwanted:
+            failures.append(f'{scenario} imports {", ".join(unwanted)}')
+        if scenario == 'help' and total > args.budget_ms:
+            failures.append(f'{scenario} took {total:.1f}ms, the budget is {args.budget_ms:.0f}ms')
+    if failures:
+        raise SystemExit(f'startup regressed -- {"; ".join(failures)}')
@@ -0,0 +1,201 @@
+import ast
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from record_schema import compact_dataframe, md5_hex, now, read_header, read_columns, write_columns
+
+
+# dataframe column -> register column
+REGISTER_COLUMNS = {'id': 'id',
+                    'author': 'author',
+                    'title': 'title',
+                    'year': 'year',
+                    'language': 'language',
+                    'md5': 'md5',
+                    'coverurl': 'coverurl',
+                    'identifier': 'identifier',
+                    'download link': 'download_link',
+                    'dewey decimal category': 'ddc',
+                    'uploaded': 'uploaded',
+                    'upload message': 'upload_message',
+                    'status time': 'status_time'}
+
+
+class BookRegister:
+    """
+    sqlite backed replacement for Book-Register.csv, keyed by the libgen id.
+    Adding or updating a batch only touches the rows in that batch, and there are indexes on md5 and
+    upload status so the download_library command doesn't have to read the whole register to find work.
+    Rows are read back in the compact layout from record_schema.py. get_all() is served from a columnar copy of
+    the register (columns_path), which is only rebuilt after the register has changed.
+    """
+    def __init__(self, path='Book-Register.sqlite', csv_path='Book-Register.csv', columns_path=None):
+        self.path = path
+        self.columns_path = columns_path or f'{os.path.splitext(path)[0]}.columns.npz'
+        self.lock = threading.Lock()
+        is_new = not os.path.exists(path)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS register ('
+                                    'id TEXT PRIMARY KEY, '
+                                    'author TEXT, '
+                                    'title TEXT, '
+                                    'year INTEGER, '
+                                    'language TEXT, '
+                                    'md5 TEXT, '
+                                    'coverurl TEXT, '
+                                    'identifier TEXT, '
+                                    'download_link TEXT, '
+                                    'ddc INTEGER, '
+                                    'uploaded INTEGER NOT NULL DEFAULT 0, '
+                                    'upload_message TEXT, '
+                                    'status_time REAL)')
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(register)')]
+            if 'status_time' not in columns:
+                self.connection.execute('ALTER TABLE register ADD COLUMN status_time REAL')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS register_md5 ON register (md5)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS register_uploaded ON register (uploaded)')
+            # Bumped by every write, so the columnar copy knows when it is out of date
+            self.connection.execute('CREATE TABLE IF NOT EXISTS register_version (version INTEGER NOT NULL)')
+            if self.connection.execute('SELECT COUNT(*) FROM register_version').fetchone()[0] == 0:
+                self.connection.execute('INSERT INTO register_version (version) VALUES (0)')
+        if is_new and csv_path and os.path.exists(csv_path):
+            self.migrate_from_csv(csv_path)
+
+    def migrate_from_csv(self, csv_path):
+        """One-shot import of an existing Book-Register.csv. Rows already in the register are kept."""
+        print(f'Migrating {csv_path} into {self.path}...')
+        dataframe = pd.read_csv(csv_path, index_col=[0], dtype={'id': object},
+                                converters={'file uploaded': ast.literal_eval})
+        self.add_rows(dataframe)
+        print(f'Migrated {dataframe.shape[0]} rows from {csv_path}')
+
+    @staticmethod
+    def to_records(dataframe):
+        dataframe = compact_dataframe(dataframe.copy())
+        if 'uploaded' not in dataframe.columns:
+            dataframe['uploaded'] = False
+            dataframe['upload message'] = None
+        if 'status time' not in dataframe.columns:
+            dataframe['status time'] = now()
+        columns = [column for column in REGISTER_COLUMNS if column in dataframe.columns]
+        clean_df = dataframe[columns].astype(object).where(pd.notna(dataframe[columns]), None)
+        records = []
+        for values in clean_df.itertuples(index=False, name=None):
+            # sqlite can't bind numpy scalars so they are turned back into python ints/strings
+            values = [value.item() if hasattr(value, 'item') else value for value in values]
+            record = dict(zip([REGISTER_COLUMNS[column] for column in columns], values))
+            record['id'] = str(record['id'])
+            # The register keeps the md5 as hex text so it can be looked up and read by hand
+            record['md5'] = md5_hex(record.get('md5')) or None
+            record['uploaded'] = int(bool(record['uploaded']))
+            if record['status_time'] is not None:
+                record['status_time'] = pd.Timestamp(record['status_time']).timestamp()
+            records.append(record)
+        return records
+
+    def bump_version(self):
+        """Called inside the write's transaction, with the lock held"""
+        self.connection.execute('UPDATE register_version SET version = version + 1')
+
+    def version(self):
+        with self.lock:
+            return self.connection.execute('SELECT version FROM register_version').fetchone()[0]
+
+    def add_rows(self, dataframe, overwrite=False):
+        """
+        Adds the rows of dataframe to the register.
+        overwrite=False keeps rows already in the register (like drop_duplicates keep='first'),
+        overwrite=True replaces them (like keep='last').
+        """
+        records = self.to_records(dataframe)
+        if not records:
+            return 0
+        columns = list(records[0].keys())
+        placeholders = ', '.join(f':{column}' for column in columns)
+        if overwrite:
+            updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column != 'id')
+            sql = (f'INSERT INTO register ({", ".join(columns)}) VALUES ({placeholders}) '
+                   f'ON CONFLICT(id) DO UPDATE SET {updates}')
+        else:
+            sql = f'INSERT OR IGNORE INTO register ({", ".join(columns)}) VALUES ({placeholders})'
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(sql, records)
+                self.bump_version()
+        return len(records)
+
+    def merge_from(self, path):
+        """Copies the rows of another register file in, keeping rows already here. Returns how many were added"""
+        columns = ', '.join(REGISTER_COLUMNS.values())
+        with self.lock:
+            self.connection.execute('ATTACH DATABASE ? AS shard', (path,))
+            try:
+                with self.connection:
+                    added = self.connection.execute(f'INSERT OR IGNORE INTO register ({columns}) '
+                                                    f'SELECT {columns} FROM shard.register').rowcount
+                    self.bump_version()
+            finally:
+                self.connection.execute('DETACH DATABASE shard')
+        return added
+
+    def set_upload_status(self, book_id, file_uploaded):
+        """Records the [status, message] result of a single transfer"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE register SET uploaded = ?, upload_message = ?, status_time = ? '
+                                        'WHERE id = ?',
+                                        (int(bool(file_uploaded[0])), file_uploaded[1], time.time(), str(book_id)))
+                self.bump_version()
+
+    def read_dataframe(self, where='', params=()):
+        """Reads rows back in the compact layout"""
+        with self.lock:
+            dataframe = pd.read_sql_query(f'SELECT * FROM register {where}', self.connection, params=params)
+        dataframe = dataframe.rename(columns={value: key for key, value in REGISTER_COLUMNS.items()})
+        return compact_dataframe(dataframe)
+
+    def export_columns(self, path=None):
+        """Writes the whole register to a columnar file (see record_schema.write_columns) and returns it"""
+        # The version is read first, so rows written meanwhile can only make the copy newer than it says
+        version = self.version()
+        dataframe = self.read_dataframe()
+        write_columns(dataframe, path or self.columns_path, {'version': version, 'register': self.path})
+        return dataframe
+
+    def get_all(self):
+        """The whole register, loaded from the columnar copy unless something has been written since it was made"""
+        if os.path.exists(self.columns_path):
+            try:
+                if read_header(self.columns_path)['metadata'].get('version') == self.version():
+                    return read_columns(self.columns_path)[0]
+            except (OSError, ValueError, KeyError) as err:
+                print(f'Ignoring unreadable {self.columns_path}: {err}')
+        return self.export_columns()
+
+    def get_by_upload_status(self, uploaded):
+        return self.read_dataframe('WHERE uploaded = ?', (int(bool(uploaded)),))
+
+    def get_by_id(self, book_id):
+        return self.read_dataframe('WHERE id = ?', (str(book_id),))
+
+    def existing(self, column, values):
+        """The subset of values that some row of the register has in column (id or md5)"""
+        if column not in ('id', 'md5'):
+            raise ValueError(f'{column} is not an indexed register column')
+        values = list(dict.fromkeys(values))
+        found = set()
+        with self.lock:
+            # Batched under sqlite's default limit of 999 bound parameters
+            for start in range(0, len(values), 900):
+                batch = values[start:start + 900]
+                placeholders = ', '.join('?' * len(batch))
+                found.update(row[0] for row in self.connection.execute(
+                    f'SELECT {column} FROM register WHERE {column} IN ({placeholders})', batch))
+        return found
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
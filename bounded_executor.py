@@ -0,0 +1,130 @@
+"""
+Thread pool with a bounded submission window, used for the dewey lookups and the download_library transfers so a
+large page or register never turns into one future per row held in memory at once.
+"""
+import concurrent.futures
+import queue
+import signal
+import threading
+import weakref
+
+# Window sizes changed with resize_windows, by executor name, so the next executor of that name starts at them too
+WINDOW_OVERRIDES = {}
+_active = weakref.WeakSet()
+_active_lock = threading.Lock()
+# Set by the resize signals and applied by the next executor to hand back a result, printing from
+# a signal handler could interrupt another print
+_requested_factor = None
+
+
+class BoundedExecutor:
+    """
+    Runs tasks on a thread pool but holds at most window tasks at once, running or waiting for a thread.
+    submit blocks while the window is full, so whatever is feeding it can't get more than window tasks ahead of the
+    workers. map_as_completed hands back each result as soon as its task finishes instead of collecting them all.
+    The window can be resized while tasks are running. Threads are only started as the window needs them,
+    up to max_workers (4 x window by default), past that a bigger window only queues more tasks.
+    """
+    def __init__(self, window, max_workers=None, name=None):
+        self.name = name
+        self.window = max(1, WINDOW_OVERRIDES.get(name, window))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or 4 * max(1, window))
+        self.condition = threading.Condition()
+        self.pending = 0
+        with _active_lock:
+            _active.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def resize(self, window):
+        with self.condition:
+            self.window = max(1, window)
+            self.condition.notify_all()
+
+    def task_done(self, future):
+        with self.condition:
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def submit(self, fn, *args, **kwargs):
+        """executor.submit that waits for room in the window first"""
+        with self.condition:
+            while self.pending >= self.window:
+                self.condition.wait()
+            self.pending += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.task_done(None)
+            raise
+        future.add_done_callback(self.task_done)
+        return future
+
+    def map_as_completed(self, fn, items):
+        """
+        Yields (item, fn(item)) for each item as soon as it finishes, in whatever order they finish.
+        Items are only taken from the iterable when the window has room, so it can be a generator over a register
+        much bigger than the window. An exception raised by fn is raised here when its item comes up.
+        """
+        completed = queue.Queue()
+        items = iter(items)
+        outstanding = 0
+        exhausted = False
+        while True:
+            # Results waiting to be handed back count against the window too, so they can't pile up either
+            while not exhausted and outstanding < self.window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = self.submit(fn, item)
+                future.add_done_callback(lambda done, item=item: completed.put((item, done)))
+                outstanding += 1
+            if not outstanding:
+                return
+            item, future = completed.get()
+            outstanding -= 1
+            apply_requested_resize()
+            yield item, future.result()
+
+    def shutdown(self, wait=True):
+        with _active_lock:
+            _active.discard(self)
+        self.executor.shutdown(wait=wait)
+
+
+def resize_windows(factor):
+    """Multiplies the window of every open executor, named ones keep the new size for the rest of the run"""
+    with _active_lock:
+        executors = list(_active)
+    for executor in executors:
+        window = max(1, round(executor.window * factor))
+        executor.resize(window)
+        if executor.name is not None:
+            WINDOW_OVERRIDES[executor.name] = window
+        print(f'{executor.name or "executor"} window resized to {window}')
+
+
+def request_resize(factor):
+    global _requested_factor
+    _requested_factor = factor * (_requested_factor or 1)
+
+
+def apply_requested_resize():
+    global _requested_factor
+    factor, _requested_factor = _requested_factor, None
+    if factor is not None:
+        resize_windows(factor)
+
+
+def handle_resize_signals():
+    """SIGUSR1 doubles the windows of a running command and SIGUSR2 halves them (not available on windows)"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: request_resize(2))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: request_resize(0.5))
@@ -0,0 +1,126 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Size these to at least the number of workers hitting the same host, otherwise connections are thrown away
+HTTP_POOL_SIZE = 32
+S3_POOL_SIZE = 32
+# Set to send s3 api calls somewhere other than aws, e.g. a local s3 compatible server
+S3_ENDPOINT_URL = None
+
+_lock = threading.Lock()
+_http_sessions = {}
+_s3_clients = {}
+
+
+def _reset_after_fork():
+    """A forked worker process opens its own connections, reading from the parent's sockets would mix up responses"""
+    global _lock
+    _lock = threading.Lock()
+    for session in _http_sessions.values():
+        for adapter in session.adapters.values():
+            adapter.poolmanager.clear()
+    _s3_clients.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def requests_retry_session(retries=25, backoff_factor=0.3, status_forcelist=(500, 502, 504, 503), session=None,
+                           pool_size=HTTP_POOL_SIZE):
+    session = session or requests.Session()
+    retry = Retry(
+        total=retries,
+        read=retries,
+        connect=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_http_session():
+    """Shared requests session for libgen and classify, reused by every worker thread"""
+    with _lock:
+        if 'plain' not in _http_sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_sessions['plain'] = session
+        return _http_sessions['plain']
+
+
+def get_retry_session():
+    """Shared requests session that retries 5xx responses, used for pdf downloads from the mirror and bucket"""
+    with _lock:
+        if 'retry' not in _http_sessions:
+            _http_sessions['retry'] = requests_retry_session()
+        return _http_sessions['retry']
+
+
+def get_s3_client(key, password):
+    """
+    Shared s3 client for the given credentials. boto3 clients are thread safe once created,
+    but creating one isn't, so it is built once under the lock and reused by every upload worker.
+    """
+    # boto3 is slow to import, so it is only loaded by the commands that talk to s3
+    import boto3
+    from botocore.config import Config
+    with _lock:
+        if (key, password) not in _s3_clients:
+            session = boto3.session.Session(aws_access_key_id=key, aws_secret_access_key=password)
+            if S3_ENDPOINT_URL:
+                config = Config(max_pool_connections=S3_POOL_SIZE, s3={'addressing_style': 'path'})
+                _s3_clients[(key, password)] = session.client('s3', endpoint_url=S3_ENDPOINT_URL, config=config,
+                                                              region_name='eu-west-2')
+            else:
+                _s3_clients[(key, password)] = session.client('s3', config=Config(max_pool_connections=S3_POOL_SIZE))
+        return _s3_clients[(key, password)]
+
+
+def pool_manager_stats(pool_manager):
+    """Returns (requests made, connections opened) across every host pool of a urllib3 PoolManager"""
+    requests_made = 0
+    connections_opened = 0
+    for pool_key in list(pool_manager.pools.keys()):
+        pool = pool_manager.pools.get(pool_key)
+        if pool is not None:
+            requests_made += pool.num_requests
+            connections_opened += pool.num_connections
+    return requests_made, connections_opened
+
+
+def connection_reuse_report():
+    """Prints and returns how many requests each shared pool served compared to the connections it had to open"""
+    report = {}
+    with _lock:
+        for name, session in _http_sessions.items():
+            requests_made = connections_opened = 0
+            for adapter in set(session.adapters.values()):
+                adapter_requests, adapter_connections = pool_manager_stats(adapter.poolmanager)
+                requests_made += adapter_requests
+                connections_opened += adapter_connections
+            report[f'http-{name}'] = (requests_made, connections_opened)
+        requests_made = connections_opened = 0
+        for s3_client in _s3_clients.values():
+            try:
+                # botocore doesn't expose its pool manager publicly
+                client_requests, client_connections = pool_manager_stats(s3_client._endpoint.http_session._manager)
+            except AttributeError:
+                continue
+            requests_made += client_requests
+            connections_opened += client_connections
+        if _s3_clients:
+            report['s3'] = (requests_made, connections_opened)
+
+    for name, (requests_made, connections_opened) in report.items():
+        reuse = 1 - connections_opened / requests_made if requests_made else 0
+        print(f'{name}: {requests_made} request(s) over {connections_opened} connection(s) --reuse: {reuse:.0%}')
+    return report
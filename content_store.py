@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Locations match the download_location argument of get_files_from_site
+BUCKET = 0
+LOCAL = 1
+
+
+class ContentMismatchError(Exception):
+    """Raised when the bytes of a transfer don't hash to the md5 libgen gave for the book"""
+
+
+class ContentStore:
+    """
+    Content addressed index of what has already been transferred, keyed by the libgen md5.
+    Every md5 has one stored object per location (a bucket key or a local file), so the same book listed under a
+    different author/title isn't fetched twice. The check is only serialised within a process (md5_lock in
+    LibraryGenesis.py), two worker processes that lease the same md5 at once can both transfer it.
+    """
+    def __init__(self, path='Content-Store.sqlite'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS objects ('
+                                    'md5 TEXT NOT NULL, '
+                                    'location INTEGER NOT NULL, '
+                                    'object_path TEXT NOT NULL, '
+                                    'size INTEGER, '
+                                    'created REAL NOT NULL, '
+                                    'PRIMARY KEY (md5, location))')
+
+    def get_object(self, md5, location):
+        """Returns the bucket key/local path already holding this md5, or None"""
+        if not md5:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT object_path FROM objects WHERE md5 = ? AND location = ?',
+                                          (md5.lower(), location)).fetchone()
+        if row is None:
+            return None
+        if location == LOCAL and not os.path.exists(row[0]):
+            # The file was deleted since, so it has to be downloaded again
+            return None
+        return row[0]
+
+    def add_object(self, md5, location, object_path, size=None):
+        if not md5:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO objects (md5, location, object_path, size, created) '
+                                        'VALUES (?, ?, ?, ?, ?)', (md5.lower(), location, object_path, size, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def link_local_file(object_path, file_path):
+    """Makes file_path point at the stored local object, falling back to a copy where hard links aren't supported"""
+    if os.path.exists(file_path):
+        return
+    try:
+        os.link(object_path, file_path)
+    except OSError:
+        shutil.copyfile(object_path, file_path)
+
+
+def check_md5(hasher, expected_md5, document_id):
+    if expected_md5 and hasher.hexdigest() != expected_md5.lower():
+        raise ContentMismatchError(f'md5 mismatch for {document_id}: expected {expected_md5.lower()} '
+                                   f'got {hasher.hexdigest()}')
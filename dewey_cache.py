@@ -0,0 +1,206 @@
+import sqlite3
+import threading
+import time
+import re
+import csv
+
+
+def isbn_to_13(isbn):
+    """Returns the isbn-13 form of an isbn-10 or isbn-13 (digits only), so both spellings share an index entry"""
+    isbn = re.sub(r'[^0-9Xx]', '', str(isbn)).upper()
+    if len(isbn) == 10:
+        core = f'978{isbn[:9]}'
+        total = sum(int(digit) * (1 if position % 2 == 0 else 3) for position, digit in enumerate(core))
+        return f'{core}{(10 - total % 10) % 10}'
+    return isbn
+
+
+class DeweyCache:
+    """
+    Persistent sqlite cache for classify.oclc.org lookups.
+    Entries are keyed by a normalised isbn, title or owi. Found categories are kept until evicted,
+    negative results (no ddc found) expire after negative_ttl seconds so they are looked up again later.
+    Once the cache grows past max_entries the least recently used entries are evicted.
+
+    Alongside the cache is a local isbn-13 -> ddc index that is never evicted. It is filled from every isbn
+    classify has answered and from imported dumps, so batches can be resolved without any network lookups.
+    """
+    def __init__(self, path='Dewey-Cache.sqlite', negative_ttl=7 * 24 * 60 * 60, max_entries=500000):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.inserts_since_evict = 0
+        # get_ddc calls get_dewey_decimal from a thread pool, so one connection is shared behind a lock.
+        # Sharded parse runs have several processes writing to the file, so they wait for each other's locks
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS dewey_cache ('
+                                    'lookup_key TEXT PRIMARY KEY, '
+                                    'ddc TEXT, '
+                                    'created REAL NOT NULL, '
+                                    'last_used REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS dewey_cache_last_used ON dewey_cache (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS dewey_index ('
+                                    'isbn TEXT PRIMARY KEY, '
+                                    'ddc TEXT NOT NULL, '
+                                    'source TEXT)')
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] < 1:
+                self.migrate_isbn_10_keys()
+                self.connection.execute('PRAGMA user_version = 1')
+
+    def migrate_isbn_10_keys(self):
+        """
+        Caches from before isbns were looked up as isbn-13s have entries keyed by the isbn-10, rekeys them by the
+        isbn-13 so they are still found. An isbn-13 entry that is already there is kept. Caller holds a transaction.
+        """
+        rows = self.connection.execute("SELECT lookup_key, ddc, created, last_used FROM dewey_cache "
+                                       "WHERE lookup_key GLOB 'isbn:*' AND LENGTH(lookup_key) = 15").fetchall()
+        self.connection.executemany('INSERT OR IGNORE INTO dewey_cache (lookup_key, ddc, created, last_used) '
+                                    'VALUES (?, ?, ?, ?)',
+                                    [(self.make_key('isbn', lookup_key[5:]), ddc, created, last_used)
+                                     for lookup_key, ddc, created, last_used in rows])
+        self.connection.executemany('DELETE FROM dewey_cache WHERE lookup_key = ?',
+                                    [(lookup_key,) for lookup_key, *_ in rows])
+        if rows:
+            print(f'Rekeyed {len(rows)} isbn-10 dewey cache entries by their isbn-13')
+
+    @staticmethod
+    def make_key(endpoint_key, endpoint_val):
+        """Normalises the lookup so the same isbn/title always maps to the same cache entry, isbns by their isbn-13"""
+        value = str(endpoint_val).strip().lower()
+        if endpoint_key == 'isbn':
+            value = isbn_to_13(value).lower()
+        else:
+            value = ' '.join(re.sub(r'[^a-z0-9]+', ' ', value).split())
+        return f'{endpoint_key}:{value}'
+
+    def get(self, endpoint_key, endpoint_val):
+        """Returns (True, ddc) on a cache hit and (False, None) on a miss or an expired negative result"""
+        lookup_key = self.make_key(endpoint_key, endpoint_val)
+        time_now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT ddc, created FROM dewey_cache WHERE lookup_key = ?',
+                                          (lookup_key,)).fetchone()
+            if row is None:
+                return False, None
+            ddc, created = row
+            if ddc is None and time_now - created > self.negative_ttl:
+                with self.connection:
+                    self.connection.execute('DELETE FROM dewey_cache WHERE lookup_key = ?', (lookup_key,))
+                return False, None
+            with self.connection:
+                self.connection.execute('UPDATE dewey_cache SET last_used = ? WHERE lookup_key = ?',
+                                        (time_now, lookup_key))
+        return True, ddc
+
+    def set(self, endpoint_key, endpoint_val, ddc):
+        lookup_key = self.make_key(endpoint_key, endpoint_val)
+        time_now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO dewey_cache (lookup_key, ddc, created, last_used) '
+                                        'VALUES (?, ?, ?, ?)', (lookup_key, ddc, time_now, time_now))
+                self.evict()
+
+    def evict(self):
+        """Drops the least recently used entries once the cache is over max_entries. Caller holds the lock."""
+        # Counting rows is a full index scan, so only check the size every so often
+        self.inserts_since_evict += 1
+        if self.inserts_since_evict < 1000:
+            return
+        self.inserts_since_evict = 0
+        count = self.connection.execute('SELECT COUNT(*) FROM dewey_cache').fetchone()[0]
+        if count > self.max_entries:
+            # Evict an extra 10% so that eviction doesn't run on every insert once the cache is full
+            excess = count - self.max_entries + self.max_entries // 10
+            self.connection.execute('DELETE FROM dewey_cache WHERE lookup_key IN ('
+                                    'SELECT lookup_key FROM dewey_cache ORDER BY last_used ASC LIMIT ?)', (excess,))
+
+    def get_many(self, lookups):
+        """Batch version of get. Takes (endpoint_key, endpoint_val) pairs and returns {pair: ddc} for the cache hits"""
+        keys = {self.make_key(endpoint_key, endpoint_val): (endpoint_key, endpoint_val)
+                for endpoint_key, endpoint_val in lookups}
+        time_now = time.time()
+        hits = {}
+        key_list = list(keys)
+        with self.lock:
+            # sqlite limits the number of parameters in one statement
+            for start in range(0, len(key_list), 500):
+                chunk = key_list[start:start + 500]
+                rows = self.connection.execute(f'SELECT lookup_key, ddc, created FROM dewey_cache '
+                                               f'WHERE lookup_key IN ({", ".join("?" * len(chunk))})', chunk).fetchall()
+                for lookup_key, ddc, created in rows:
+                    if ddc is None and time_now - created > self.negative_ttl:
+                        continue
+                    hits[lookup_key] = ddc
+            with self.connection:
+                self.connection.executemany('UPDATE dewey_cache SET last_used = ? WHERE lookup_key = ?',
+                                            [(time_now, lookup_key) for lookup_key in hits])
+        return {keys[lookup_key]: ddc for lookup_key, ddc in hits.items()}
+
+    def index_get_many(self, isbns):
+        """Returns {isbn: ddc} for the isbns found in the local dewey index"""
+        isbn_13s = {}
+        for isbn in isbns:
+            isbn_13s.setdefault(isbn_to_13(isbn), []).append(isbn)
+        isbn_list = list(isbn_13s)
+        found = {}
+        with self.lock:
+            for start in range(0, len(isbn_list), 500):
+                chunk = isbn_list[start:start + 500]
+                rows = self.connection.execute(f'SELECT isbn, ddc FROM dewey_index '
+                                               f'WHERE isbn IN ({", ".join("?" * len(chunk))})', chunk).fetchall()
+                for isbn_13, ddc in rows:
+                    for isbn in isbn_13s[isbn_13]:
+                        found[isbn] = ddc
+        return found
+
+    def index_add_many(self, ddc_by_isbn, source):
+        rows = [(isbn_to_13(isbn), ddc, source) for isbn, ddc in ddc_by_isbn.items() if ddc is not None]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO dewey_index (isbn, ddc, source) VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def import_index(self, csv_path, isbn_column='isbn', ddc_column='ddc'):
+        """
+        Loads an isbn -> dewey decimal dump (csv with isbn and ddc columns) into the local index.
+        The ddc is rounded down to the tens like classify results are.
+        """
+        ddc_by_isbn = {}
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                isbn = row.get(isbn_column)
+                ddc = re.match(r'\d{2}', str(row.get(ddc_column) or ''))
+                if isbn and ddc:
+                    ddc_by_isbn[isbn] = f'{ddc.group()}0'
+        added = self.index_add_many(ddc_by_isbn, source=csv_path)
+        print(f'Imported {added} isbn(s) into the dewey index from {csv_path}')
+        return added
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_dewey_cache = None
+_dewey_cache_lock = threading.Lock()
+
+
+def get_dewey_cache():
+    """Returns the shared cache used by get_dewey_decimal, opening it on first use"""
+    global _dewey_cache
+    with _dewey_cache_lock:
+        if _dewey_cache is None:
+            _dewey_cache = DeweyCache()
+        return _dewey_cache
+
+
+def close_dewey_cache():
+    """Closes the shared cache, it is opened again on next use. Call before forking worker processes"""
+    global _dewey_cache
+    with _dewey_cache_lock:
+        if _dewey_cache is not None:
+            _dewey_cache.close()
+            _dewey_cache = None
@@ -1,32 +1,175 @@
-import requests
-import xmltodict
 from urllib.parse import quote
 import re
+import requests
+import numpy as np
+import pandas as pd
+from dewey_cache import get_dewey_cache
+from connection_pool import get_http_session
+from rate_limiter import limited_get, THROTTLE_STATUSES
+from bounded_executor import BoundedExecutor
+
+# Runs of digits joined by hyphens or spaces, e.g. 978-3-16-148410-0 or 0306406152 9780306406157
+ISBN_GROUP = re.compile(r'[0-9Xx]+(?:[- ][0-9Xx]+)+')
+# A 13 digit or 10 character isbn that isn't part of a longer number
+ISBN_CANDIDATE = re.compile(r'(?<![0-9Xx])[0-9]{9}(?:[0-9]{4}|[0-9Xx])(?![0-9Xx])')
+# Runs of anything but letters and digits, except a lone space which would only be replaced with itself.
+# Newlines are kept so a page of titles can be cleaned as one string and split back into rows
+NON_ALPHANUMERIC = re.compile(r'[^a-zA-Z0-9\n ][^a-zA-Z0-9\n]*| [^a-zA-Z0-9\n]+')
+ISBN_13_WEIGHTS = np.array([1, 3] * 6 + [1])
+ISBN_10_WEIGHTS = np.arange(10, 0, -1)
+# Tries for one classify request while it answers 429 or 5xx, the host limiter backs off (or opens its circuit) between them
+CLASSIFY_RETRIES = 5
+
+
+def digit_matrix(strings, width):
+    """Fixed width ascii strings -> one row of digit values per string, X counts as 10"""
+    digits = np.frombuffer(''.join(strings).encode('ascii'), dtype=np.uint8).reshape(-1, width).astype(np.int64) - 48
+    digits[digits == ord('X') - 48] = 10
+    return digits
+
+
+def join_isbn_group(match):
+    """
+    Takes the separators out of a hyphenated or spaced isbn. A group that is longer than one isbn is a list
+    separated by spaces, so only the hyphens inside each isbn shaped part of it are taken out.
+    """
+    group = match.group()
+    joined = group.replace('-', '').replace(' ', '')
+    if len(joined) in (10, 13):
+        return joined
+    parts = [(part, part.replace('-', '')) for part in group.split(' ')]
+    return ' '.join(joined if len(joined) in (10, 13) else part for part, joined in parts)
+
+
+def as_lines(values):
+    """Values as strings with no newlines in them, so they can be joined into one string a line each"""
+    values = ['' if value is None or value != value else str(value) for value in values]
+    if any('\n' in value for value in values):
+        values = [value.replace('\n', ' ') for value in values]
+    return values
+
+
+def normalize_isbns(identifiers):
+    """
+    The first valid isbn in each identifier, as an isbn-13, or None when there isn't one.
+    isbn-10s are checked mod 11 and isbn-13s mod 10 (and must start 978/979), so numbers that aren't isbns
+    never get sent to classify. The whole page is searched as one string, a line per identifier.
+    identifiers is anything pandas can turn into a Series, the result has its index.
+    """
+    identifiers = pd.Series(identifiers, dtype=object)
+    lines = as_lines(identifiers)
+    result = np.full(len(lines), None, dtype=object)
+    page = ISBN_GROUP.sub(join_isbn_group, '\n'.join(lines)).upper()
+    newlines = np.flatnonzero(np.frombuffer(page.encode('ascii', 'replace'), dtype=np.uint8) == ord('\n'))
+    matches = [(match.start(), match.group()) for match in ISBN_CANDIDATE.finditer(page)]
+    if matches:
+        positions, values = zip(*matches)
+        # The row a match is on is the number of newlines before it
+        rows = np.searchsorted(newlines, positions)
+        values = np.array(values)
+        lengths = np.char.str_len(values)
+        canonical = np.full(len(values), None, dtype=object)
+        is_13 = lengths == 13
+        if is_13.any():
+            digits = digit_matrix(values[is_13], 13)
+            ok = ((digits @ ISBN_13_WEIGHTS) % 10 == 0) & (digits[:, 0] == 9) & (digits[:, 1] == 7) & \
+                 np.isin(digits[:, 2], [8, 9])
+            canonical[np.flatnonzero(is_13)[ok]] = values[is_13][ok]
+        is_10 = lengths == 10
+        if is_10.any():
+            # X can only be the check digit, the pattern keeps it out of the other positions
+            digits = digit_matrix(values[is_10], 10)
+            ok = (digits @ ISBN_10_WEIGHTS) % 11 == 0
+            # isbn-10 -> isbn-13 is 978 + the first 9 digits + a new mod 10 check digit
+            core = np.concatenate([np.tile([9, 7, 8], (ok.sum(), 1)), digits[ok, :9]], axis=1)
+            check = (10 - (core @ ISBN_13_WEIGHTS[:12]) % 10) % 10
+            canonical[np.flatnonzero(is_10)[ok]] = [f'978{isbn[:9]}{digit}'
+                                                    for isbn, digit in zip(values[is_10][ok], check.tolist())]
+        found = np.array([value is not None for value in canonical], dtype=bool)
+        rows = rows[found]
+        # Matches come in order, so the first one for each row is its first valid isbn
+        first = np.unique(rows, return_index=True)[1]
+        result[rows[first]] = canonical[found][first]
+    return pd.Series(result, index=identifiers.index, dtype=object)
+
+
+def title_key(no_special):
+    """A title with a possessive 's is cut down to the longer side of it, less its last word"""
+    parts = no_special.split(' s ')
+    if len(parts) == 1:
+        return no_special
+    title = parts[0] if len(parts[0]) > len(parts[1]) else parts[1]
+    return title.rpartition(' ')[0]
+
+
+def normalize_titles(titles):
+    """
+    Title search keys for a page of titles, punctuation is cleaned out of the whole page in one pass.
+    These are the same keys the per row format_title made, so titles already in the dewey cache are still found.
+    """
+    titles = pd.Series(titles, dtype=object)
+    no_special = NON_ALPHANUMERIC.sub(' ', '\n'.join(as_lines(titles))).split('\n')
+    return pd.Series([title_key(title) for title in no_special], index=titles.index, dtype=object)
+
+
+def lookup_pairs(identifiers, titles):
+    """
+    The classify lookup for each row: ('isbn', isbn-13) if the identifier has a valid isbn, otherwise
+    ('title', key), or None when there is nothing worth looking up.
+    """
+    isbns = normalize_isbns(identifiers)
+    title_keys = normalize_titles(pd.Series(list(titles), index=isbns.index, dtype=object))
+    return [('isbn', isbn) if isbn is not None else (('title', title) if title.strip() else None)
+            for isbn, title in zip(isbns, title_keys)]
 
 
 def format_isbn(num):
-    matches = [x.group() for x in re.finditer(r"\d{10}(\d{3})?|(\d{3}-\d{1}-\d{3}-\d{5}-\d{1})", num)]
-    regex = re.sub(r"[^a-zA-Z0-9]+", ' ', matches[0])
-    isbn = ''.join(regex.split(' '))
-    return isbn
+    """Single identifier version of normalize_isbns, None if it has no valid isbn"""
+    return normalize_isbns([num]).iloc[0]
 
 
 def format_title(string):
-    title_no_special = re.sub(r"[^a-zA-Z0-9]+", ' ', string)
+    return normalize_titles([string]).iloc[0]
+
+
+def ddc_from_classify(xml_parse):
+    """Pulls the most popular dewey decimal category out of a parsed classify response, rounded down to the tens"""
     try:
-        title_no_s = title_no_special.split(' s ')
-        if len(title_no_s[0]) > len(title_no_s[1]):
-            title = title_no_s[0]
-        else:
-            title = title_no_s[1]
-        title_clean = ' '.join(title.split(' ')[0:-1])
+        ddc_parse = xml_parse['classify']['recommendations']['ddc']['mostPopular']['@sfa']
+        return f'{ddc_parse[0:2]}0'
     except:
-        title_clean = title_no_special
-    return title_clean
+        return None
+
+
+def owi_from_classify(xml_parse):
+    """
+    The owi of the first work in a code 4 (multiple works) classify response.
+    xmltodict gives a lone <work> as a dict rather than a list of one
+    """
+    works = xml_parse['classify']['works']['work']
+    if isinstance(works, dict):
+        works = [works]
+    return works[0]['@owi']
+
+
+def classify_unavailable(response):
+    return response.status_code in THROTTLE_STATUSES or response.status_code >= 500
 
 
-def get_dewey_decimal(**kwargs):
-    """scrapes http://classify.oclc.org/classify2/api_docs/classify.html to get the dewey decimal category"""
+def get_classify(url_endpoint):
+    """The classify response for url_endpoint, asking again through the host limiter while classify is throttling"""
+    url = f'http://classify.oclc.org/classify2/Classify?{url_endpoint}'
+    for attempt in range(CLASSIFY_RETRIES):
+        response = limited_get(get_http_session(), url)
+        if not classify_unavailable(response):
+            break
+        print(f'classify unavailable --status code: {response.status_code} --attempt: {attempt + 1}/{CLASSIFY_RETRIES}')
+    return response
+
+
+def get_dewey_decimal(use_cache=True, **kwargs):
+    """scrapes http://classify.oclc.org/classify2/api_docs/classify.html to get the dewey decimal category
+    Results are kept in the on-disk dewey cache so repeated isbns/titles skip the network."""
     # Creates endpoint for url
     for endpoint_key, endpoint_val in kwargs.items():
         if endpoint_key == 'isbn':
@@ -34,33 +177,52 @@ def get_dewey_decimal(**kwargs):
         else:
             title = quote(endpoint_val)
             url_endpoint = f'{endpoint_key}={title}'
+
+    if use_cache:
+        dewey_cache = get_dewey_cache()
+        cache_hit, ddc = dewey_cache.get(endpoint_key, endpoint_val)
+        if cache_hit:
+            return ddc
+    # Only definite answers from classify are cached, transient errors are looked up again next run
+    cacheable = False
+    ddc = None
+    # xmltodict pulls in the xml parsers, which only the lookups need
+    import xmltodict
+    from xml.parsers.expat import ExpatError
+    status_code = None
     try:
-        response = requests.get(f'http://classify.oclc.org/classify2/Classify?{url_endpoint}')
+        response = get_classify(url_endpoint)
         status_code = response.status_code
+        if classify_unavailable(response):
+            print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n'
+                  f'--HTTP status code: {status_code}, not classified this run')
+            return None
         xml_parse = xmltodict.parse(response.content)
         response_code = xml_parse['classify']['response']['@code']
         if response_code == '2':
             print(f'url_endpoint: {endpoint_key}= {endpoint_val}\n'
                   f'--response code: {response_code}')
-            try:
-                ddc_parse = xml_parse['classify']['recommendations']['ddc']['mostPopular']['@sfa']
-                ddc = f'{ddc_parse[0:2]}0'
-            except:
-                ddc = None
+            ddc = ddc_from_classify(xml_parse)
+            cacheable = True
         elif response_code == '4':
             print(f'url_endpoint: {endpoint_key}= {endpoint_val}\n '
                   f'--response code: {response_code}:\n'
                   f'Multple documents found, selecting and trying again.')
-            new_endpoint = xml_parse['classify']['works']['work'][0]['@owi']
-            second_response = requests.get(f'http://classify.oclc.org/classify2/Classify?owi={new_endpoint}')
-            second_xml_parse = xmltodict.parse(second_response.content)
-            try:
-                second_ddc_parse = second_xml_parse['classify']['recommendations']['ddc']['mostPopular']['@sfa']
+            new_endpoint = owi_from_classify(xml_parse)
+            owi_hit, ddc = get_dewey_cache().get('owi', new_endpoint) if use_cache else (False, None)
+            if not owi_hit:
+                second_response = get_classify(f'owi={new_endpoint}')
+                if classify_unavailable(second_response):
+                    print(f'url_endpoint issue: owi= {new_endpoint}\n'
+                          f'--HTTP status code: {second_response.status_code}, not classified this run')
+                    return None
+                second_xml_parse = xmltodict.parse(second_response.content)
+                ddc = ddc_from_classify(second_xml_parse)
                 print(f'url_endpoint: {endpoint_key}= {endpoint_val}\n '
                       f'--response code: {second_response}')
-                ddc = f'{second_ddc_parse[0:2]}0'
-            except:
-                ddc = None
+                if use_cache:
+                    get_dewey_cache().set('owi', new_endpoint, ddc)
+            cacheable = True
         elif response_code == '100':
             print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n'
                   f'--HTTP status code: {status_code}\n'
@@ -74,6 +236,7 @@ def get_dewey_decimal(**kwargs):
                   f'--response code: {response_code}:\n'
                   f'Invalid input. The standard number argument is invalid.')
             ddc = None
+            cacheable = True
 
         elif response_code == '102':
             print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n'
@@ -81,6 +244,7 @@ def get_dewey_decimal(**kwargs):
                   f'--response code: {response_code}:\n'
                   f'Not found. No data found for the input argument')
             ddc = None
+            cacheable = True
 
         elif response_code == '200':
             print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n'
@@ -89,15 +253,65 @@ def get_dewey_decimal(**kwargs):
                   f'Unexpected error.')
             ddc = None
 
-    except KeyError as key_err:
+    except (KeyError, IndexError, TypeError, ExpatError, requests.exceptions.RequestException) as err:
+        # A response that isn't a classify document, or no response at all, is treated as a transient failure
         print(f'url_endpoint issue: {endpoint_key}= {endpoint_val}\n'
-              f'--HTTP status code: {response.status_code}\n'
-              f'--Error: {key_err}')
+              f'--HTTP status code: {status_code}\n'
+              f'--Error: {type(err).__name__}: {err}')
         ddc = None
+        cacheable = False
+    if use_cache and cacheable:
+        dewey_cache.set(endpoint_key, endpoint_val, ddc)
     return ddc
 
 
 
+def get_dewey_decimal_batch(lookups, network_lookup=None, max_workers=10, unanswered=None):
+    """
+    Classifies a batch of (endpoint_key, endpoint_val) pairs and returns {pair: ddc}.
+    Repeated isbns/titles are only looked up once, isbns are resolved from the local dewey index first,
+    then anything already in the dewey cache, and only what is left goes to classify.
+    network_lookup(pairs) -> list of ddc can replace the default thread pool (e.g. the async engine).
+    If unanswered is a set, the lookups classify couldn't answer this run (throttled, down, garbled) are added to it.
+    """
+    dewey_cache = get_dewey_cache()
+    # Lookups that only differ by case/punctuation share a cache key, so only the first of them is looked up
+    first_lookup = {}
+    for lookup in lookups:
+        first_lookup.setdefault(dewey_cache.make_key(*lookup), lookup)
+    unique_lookups = list(first_lookup.values())
+
+    index_hits = dewey_cache.index_get_many([endpoint_val for endpoint_key, endpoint_val in unique_lookups
+                                             if endpoint_key == 'isbn'])
+    resolved = {('isbn', isbn): ddc for isbn, ddc in index_hits.items()}
+    cache_hits = dewey_cache.get_many([lookup for lookup in unique_lookups if lookup not in resolved])
+    resolved.update(cache_hits)
+    remaining = [lookup for lookup in unique_lookups if lookup not in resolved]
+    print(f'dewey lookups: {len(lookups)} row(s), {len(unique_lookups)} unique, {len(index_hits)} from the index, '
+          f'{len(cache_hits)} cached, {len(remaining)} sent to classify')
+
+    if network_lookup is not None:
+        network_results = dict(zip(remaining, network_lookup(remaining)))
+    else:
+        network_results = {}
+        # Edit max workers if your pc can candle it. The Higher it it the more parallel tasks will be active. Will affect performance
+        # Only max_workers lookups are submitted at a time, the rest wait in remaining rather than as futures
+        with BoundedExecutor(window=max_workers, name='dewey') as executor:
+            for lookup, ddc in executor.map_as_completed(lambda lookup: get_dewey_decimal(**{lookup[0]: lookup[1]}),
+                                                          remaining):
+                network_results[lookup] = ddc
+    resolved.update(network_results)
+    if unanswered is not None:
+        # Definite answers, found or not, are cached by the lookups, so a None that isn't cached was a transient failure
+        no_ddc = [lookup for lookup, ddc in network_results.items() if ddc is None]
+        cached = dewey_cache.get_many(no_ddc)
+        failed = {lookup for lookup in no_ddc if lookup not in cached}
+        unanswered.update(lookup for lookup in lookups if first_lookup[dewey_cache.make_key(*lookup)] in failed)
+    dewey_cache.index_add_many({endpoint_val: ddc for (endpoint_key, endpoint_val), ddc in network_results.items()
+                                if endpoint_key == 'isbn'}, source='classify')
+    return {lookup: resolved.get(first_lookup[dewey_cache.make_key(*lookup)]) for lookup in lookups}
+
+
 def make_list_of_ddc_categories(cat_list):
     """makes a list of categories every 10 steps between the start number and the nearest hundred"""
     cat_range = []
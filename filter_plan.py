@@ -0,0 +1,49 @@
+"""
+Runs the filters a parse_library page goes through cheapest first, so the expensive ones (the dewey lookups go out
+to classify) only see the rows every cheaper filter has kept. Counts how many rows each filter pruned over the run.
+"""
+import collections
+import threading
+
+# Rough cost of a filter per row, relative to each other. In memory comparisons are the cheapest, a register lookup
+# is a batched sqlite query and a dewey lookup can be a classify round trip
+COST_IN_MEMORY = 1
+COST_REGISTER = 10
+COST_NETWORK = 1000
+
+
+class FilterPlan:
+    """
+    Filters added with add(name, cost, function) are run in order of cost (then the order they were added).
+    function takes the LibraryGenesisScraper and narrows scraper.df, like the filter_dataframe_* methods do.
+    """
+    def __init__(self):
+        self.filters = []
+        self.lock = threading.Lock()
+        self.rows_in = collections.Counter()
+        self.pruned = collections.Counter()
+
+    def add(self, name, cost, function):
+        self.filters.append((cost, len(self.filters), name, function))
+        return self
+
+    def ordered(self):
+        return [(name, function) for cost, added, name, function in sorted(self.filters, key=lambda item: item[:2])]
+
+    def run(self, scraper):
+        """Filters scraper.df, stopping early once no rows are left"""
+        for name, function in self.ordered():
+            rows_in = scraper.df.shape[0]
+            if rows_in == 0:
+                return
+            function(scraper)
+            with self.lock:
+                self.rows_in[name] += rows_in
+                self.pruned[name] += rows_in - scraper.df.shape[0]
+
+    def print_report(self):
+        print('Rows pruned by each filter, in the order they run:')
+        for name, function in self.ordered():
+            rows_in = self.rows_in[name]
+            share = f' ({self.pruned[name] / rows_in:.0%})' if rows_in else ''
+            print(f'{name}: {self.pruned[name]} of {rows_in} row(s){share}')
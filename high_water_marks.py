@@ -0,0 +1,42 @@
+import sqlite3
+import threading
+import time
+
+
+class HighWaterMarks:
+    """
+    The last (timelastmodified, id) parsed for each json.php time window, used by keyset paging.
+    A repeat run of the same window carries on from its mark, so it only fetches records added or changed since.
+    """
+    def __init__(self, path='High-Water-Marks.sqlite'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS marks ('
+                                    'window TEXT PRIMARY KEY, '
+                                    'last_time TEXT NOT NULL, '
+                                    'last_id INTEGER NOT NULL, '
+                                    'updated REAL NOT NULL)')
+
+    def get(self, window):
+        """Returns (last_time, last_id) for the window, or None if it has never been parsed"""
+        with self.lock:
+            return self.connection.execute('SELECT last_time, last_id FROM marks WHERE window = ?',
+                                           (window,)).fetchone()
+
+    def set(self, window, last_time, last_id):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO marks (window, last_time, last_id, updated) '
+                                        'VALUES (?, ?, ?, ?)', (window, last_time, int(last_id), time.time()))
+
+    def clear(self, window):
+        """Forgets the window's mark so the next run rescans it from the start"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM marks WHERE window = ?', (window,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
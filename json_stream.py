@@ -0,0 +1,64 @@
+import codecs
+import json
+
+# What can follow an item in an array, anything else means the item carries on in the next chunk
+ITEM_ENDS = ' \t\r\n,]'
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of a top level json array one at a time from an iterable of byte chunks
+    (e.g. response.iter_content), so the whole response never has to be held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    started = False
+    chunks = iter(chunks)
+    finished_reading = False
+
+    def read_more():
+        nonlocal buffer, pos, finished_reading
+        try:
+            chunk = next(chunks)
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+        except StopIteration:
+            buffer = buffer[pos:] + text_decoder.decode(b'', final=True)
+            finished_reading = True
+        pos = 0
+
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+            pos += 1
+        if pos >= len(buffer):
+            if finished_reading:
+                raise ValueError('json array ended before its closing bracket')
+            read_more()
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError(f'expected a json array but got {buffer[pos:pos + 20]!r}')
+            started = True
+            pos += 1
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item is split across chunks, read more and try again
+            if finished_reading:
+                raise
+            read_more()
+            continue
+        if not finished_reading and (end == len(buffer) or buffer[end] not in ITEM_ENDS):
+            # A number cut off by the end of the chunk decodes as a shorter one ([12 then 34], [1. then 5]),
+            # so an item only counts once what follows it is in the buffer
+            read_more()
+            continue
+        pos = end
+        yield item
@@ -1,16 +1,147 @@
 #%%
 import time
 import argparse
-from LibraryGenesis import LibraryGenesisScraper
+import multiprocessing
+import os
+from metrics import METRICS
+from filter_plan import FilterPlan, COST_IN_MEMORY, COST_REGISTER, COST_NETWORK
+from page_cache import CACHE_MODES, DEFAULT_MAX_AGE
+# Everything else is imported inside the function that needs it. pandas, numpy and boto3 take most of a second
+# to load, and "main.py -h", merge_register or download_library -dl 2 shouldn't wait on the ones they don't use.
+# Run benchmark_startup.py after adding an import here
+
+# Only books in these dewey classes are registered
+DDC_CLASSES = [000, 500, 600]
+# Every book is saved and uploaded as a pdf, so other file types are dropped
+EXTENSIONS = ('pdf',)
 
-from dewey_category_check import make_list_of_ddc_categories
 
 #%%
-def run_library_parse(start_year, end_year, language, starting_limit, max_limit):
+def classify_and_filter(libgen_scraper, engine, category_list):
+    libgen_scraper.get_ddc(engine=engine)
+    libgen_scraper.filter_categories(category_list=category_list)
+
+
+def parse_filter_plan(year_from, year_to, language, engine):
+    """The filters each page goes through before it is registered, the dewey lookups run last"""
+    from dewey_category_check import make_list_of_ddc_categories
+    category_list = make_list_of_ddc_categories(DDC_CLASSES)
+    return (FilterPlan()
+            .add('language', COST_IN_MEMORY, lambda scraper: scraper.filter_dataframe_language(language))
+            .add('year', COST_IN_MEMORY, lambda scraper: scraper.filter_dataframe_year(year_from, year_to))
+            .add('extension', COST_IN_MEMORY, lambda scraper: scraper.filter_dataframe_extension(EXTENSIONS))
+            .add('already registered', COST_REGISTER, lambda scraper: scraper.filter_registered())
+            .add('dewey category', COST_NETWORK, lambda scraper: classify_and_filter(scraper, engine, category_list)))
+
+
+def enrich_and_register(libgen_scraper, plan):
+    """Runs the filter plan on libgen_scraper.df, then builds download links for the rows left and registers them"""
+    plan.run(libgen_scraper)
+    libgen_scraper.get_download_urls()
+    libgen_scraper.add_dataframe_to_register()
+
+
+def export_metrics(metrics_file):
+    """Writes the stage metrics so far to metrics_file, if one was given"""
+    if metrics_file:
+        METRICS.export(metrics_file)
+
+
+def run_library_parse_prefetched(start_year, end_year, language, starting_limit, max_limit, engine, in_flight,
+                                 metrics_file=None, years=None, register_path='Book-Register.sqlite',
+                                 page_cache='off', page_max_age=DEFAULT_MAX_AGE, main_register_path=None):
+    """Fetches pages for several years and offsets at once while the previous page is being enriched"""
+    from LibraryGenesis import LibraryGenesisScraper
+    from page_scheduler import iter_pages_prefetched
     start_time = time.perf_counter()
-    libgen_scraper = LibraryGenesisScraper()
+    libgen_scraper = LibraryGenesisScraper(register_path=register_path, page_cache_mode=page_cache,
+                                           page_max_age=page_max_age, main_register_path=main_register_path)
+    plan = parse_filter_plan(start_year, end_year, language, engine)
+
+    def fetch_page(year, limit1, limit2):
+        print(f'Fetching year: {year} --- limit1: {limit1} --- limit2: {limit2}')
+        return libgen_scraper.fetch_JSON_page(start_year=year, last_year=year + 1, limit1=limit1, limit2=limit2)
+
+    for year, limit1, records in iter_pages_prefetched(fetch_page,
+                                                       years=years or range(start_year, end_year),
+                                                       starting_limit=starting_limit,
+                                                       max_limit=max_limit,
+                                                       in_flight=in_flight):
+        print(f'Processing year: {year} --- limit1: {limit1} --- records: {len(records)}')
+        libgen_scraper.json_parse = records
+        libgen_scraper.initialise_dataframe()
+        enrich_and_register(libgen_scraper, plan)
+        export_metrics(metrics_file)
+        d_end_time = time.perf_counter()
+        print(f'script took {d_end_time - start_time} second(s) to load JSON data into the register')
+    plan.print_report()
+    libgen_scraper.page_cache_report()
+
+
+def run_library_parse_keyset(start_year, end_year, language, max_limit, engine, metrics_file=None, years=None,
+                             register_path='Book-Register.sqlite', page_cache='off', page_max_age=DEFAULT_MAX_AGE,
+                             main_register_path=None, reset_marks=False):
+    """
+    Pages each year window by the last id seen, carrying on from where the previous run stopped.
+    reset_marks rescans each window from the start
+    """
+    from LibraryGenesis import LibraryGenesisScraper
+    start_time = time.perf_counter()
+    libgen_scraper = LibraryGenesisScraper(register_path=register_path, page_cache_mode=page_cache,
+                                           page_max_age=page_max_age, main_register_path=main_register_path)
+    plan = parse_filter_plan(start_year, end_year, language, engine)
+    for year in years or range(start_year, end_year):
+        print(f'Start year: {year} --- End year: {year + 1}')
+        for records in libgen_scraper.keyset_JSON_pages(start_year=year, last_year=year + 1, limit2=max_limit,
+                                                        reset_mark=reset_marks):
+            print(f'Processing {len(records)} record(s) up to id {records[-1]["id"]}')
+            libgen_scraper.json_parse = records
+            libgen_scraper.initialise_dataframe()
+            enrich_and_register(libgen_scraper, plan)
+            export_metrics(metrics_file)
+            d_end_time = time.perf_counter()
+            print(f'script took {d_end_time - start_time} second(s) to load JSON data into the register')
+    plan.print_report()
+    libgen_scraper.page_cache_report()
+
+
+def run_library_parse(start_year, end_year, language, starting_limit, max_limit, engine='threads', batch_size=0,
+                      in_flight=0, metrics_file=None, paging='offset', years=None,
+                      register_path='Book-Register.sqlite', page_cache='off', page_max_age=DEFAULT_MAX_AGE,
+                      main_register_path=None, reset_marks=False):
+    """
+    Parses the json.php windows for years (every year from start_year to end_year by default) into the register.
+    Books are kept if their publication year is between start_year and end_year.
+    When register_path is a shard's partition, main_register_path is the register it is merged into, books already
+    in either are skipped.
+    """
+    from LibraryGenesis import LibraryGenesisScraper
+    from connection_pool import connection_reuse_report
+    if paging == 'keyset':
+        if batch_size > 0 or in_flight > 0:
+            print('--batch_size and --in_flight are ignored with keyset paging, each page follows on from the last')
+        run_library_parse_keyset(start_year, end_year, language, max_limit, engine, metrics_file, years,
+                                 register_path, page_cache, page_max_age, main_register_path, reset_marks)
+        connection_reuse_report()
+        METRICS.print_summary()
+        return
+    if reset_marks:
+        print('--reset_marks is ignored with offset paging, which always rescans the whole window')
+    if in_flight > 0:
+        if batch_size > 0:
+            print('--batch_size is ignored when --in_flight is set, prefetched pages are processed whole')
+        run_library_parse_prefetched(start_year, end_year, language, starting_limit, max_limit, engine, in_flight,
+                                     metrics_file, years, register_path, page_cache, page_max_age,
+                                     main_register_path)
+        connection_reuse_report()
+        METRICS.print_summary()
+        return
+    start_time = time.perf_counter()
+    libgen_scraper = LibraryGenesisScraper(register_path=register_path, page_cache_mode=page_cache,
+                                           page_max_age=page_max_age, main_register_path=main_register_path)
+    plan = parse_filter_plan(start_year, end_year, language, engine)
     #%%
-    for year in range(start_year, end_year):
+    for year in years or range(start_year, end_year):
         s_year = year
         l_year = year + 1
         limit1 = starting_limit
@@ -18,45 +149,155 @@ def run_library_parse(start_year, end_year, language, starting_limit, max_limit)
         print(f'Start year: {s_year} --- End year: {l_year}')
         while True:
             print(f'limit1: {limit1} --- limit2: {limit2}')
+            if batch_size > 0:
+                # Streaming mode, the page is filtered as it is read and handed on in batches of batch_size rows
+                for batch_df in libgen_scraper.stream_JSON_response(start_year=s_year,
+                                                                    last_year=l_year,
+                                                                    limit1=limit1,
+                                                                    limit2=limit2,
+                                                                    year_from=start_year,
+                                                                    year_to=end_year,
+                                                                    language=language,
+                                                                    batch_size=batch_size):
+                    libgen_scraper.df = batch_df
+                    enrich_and_register(libgen_scraper, plan)
+                export_metrics(metrics_file)
+                d_end_time = time.perf_counter()
+                print(f'script took {d_end_time - start_time} second(s) to load JSON data into csv')
+                if libgen_scraper.records_read == limit2:
+                    limit1 += max_limit
+                    continue
+                break
             max_callable = libgen_scraper.JSON_response(start_year=s_year,
                                                         last_year=l_year,
                                                         limit1=limit1,  # limit1 controls the start point
                                                         limit2=limit2)  # limit2 controls the max number of responses
             if max_callable == limit2:
                 libgen_scraper.initialise_dataframe()
-                libgen_scraper.filter_dataframe_year(start_year, end_year)
-                libgen_scraper.filter_dataframe_language(language)
-                libgen_scraper.get_download_urls()
-                libgen_scraper.get_ddc()
-                libgen_scraper.filter_categories(category_list=make_list_of_ddc_categories([000, 500, 600]))
-                libgen_scraper.add_dataframe_to_register()
+                enrich_and_register(libgen_scraper, plan)
+                export_metrics(metrics_file)
                 d_end_time = time.perf_counter()
                 print(f'script took {d_end_time - start_time} second(s) to load JSON data into csv')
                 limit1 += max_limit
             else:
                 break
+    plan.print_report()
+    libgen_scraper.page_cache_report()
+    connection_reuse_report()
+    METRICS.print_summary()
 
-def run_library_upload_download(download_location):
-    #%%
+
+def shard_metrics_file(metrics_file, shard_index):
+    """Each shard process exports its own metrics, a prometheus file would be overwritten by the others"""
+    if not metrics_file:
+        return None
+    stem, extension = os.path.splitext(metrics_file)
+    return f'{stem}.shard-{shard_index}{extension}'
+
+
+def run_parse_shard(shard_index, shard_count, shard_dir, years, parse_options):
+    from register_shards import open_partition
+    register_path = open_partition(shard_dir, shard_index, shard_count)
+    print(f'Shard {shard_index + 1}/{shard_count}: years {years} into {register_path}')
+    run_library_parse(**dict(parse_options, metrics_file=shard_metrics_file(parse_options.get('metrics_file'),
+                                                                           shard_index)),
+                      years=years, register_path=register_path, main_register_path='Book-Register.sqlite')
+
+
+def run_library_parse_sharded(shard_count, shard_index=None, shard_dir='shards', **parse_options):
+    """
+    Splits the year windows into shard_count shards, each parsed into its own register partition in shard_dir.
+    Without shard_index every shard runs in its own process here and the partitions are merged into the register
+    afterwards. With shard_index only that shard runs, so the shards can be spread over machines sharing shard_dir,
+    and merge_register is run once they have all finished.
+    """
+    from dewey_cache import close_dewey_cache
+    from register_shards import plan_shards, merge_partitions
     start_time = time.perf_counter()
+    shards = plan_shards(parse_options['start_year'], parse_options['end_year'], shard_count)
+    shard_count = len(shards)
+    if shard_index is not None:
+        if not 0 <= shard_index < shard_count:
+            raise SystemExit(f'--shard_index must be between 0 and {shard_count - 1}')
+        run_parse_shard(shard_index, shard_count, shard_dir, shards[shard_index], parse_options)
+        return
+    # The children open their own sqlite connections, none may be carried across the fork
+    close_dewey_cache()
+    processes = [multiprocessing.Process(target=run_parse_shard, args=(index, shard_count, shard_dir, years,
+                                                                        parse_options))
+                 for index, years in enumerate(shards)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        print(f'Shard(s) {failed} did not finish, run them again with --shard_index before merging')
+    merge_partitions(shard_dir)
+    end_time = time.perf_counter()
+    print(f'{shard_count} shard(s) took {end_time - start_time} second(s) to finish')
+
+
+def run_merge_register(shard_dir='shards'):
+    from register_shards import merge_partitions
+    merge_partitions(shard_dir)
+
+
+def drain_queue(download_location, engine, priority, window):
+    from LibraryGenesis import LibraryGenesisScraper
+    LibraryGenesisScraper().get_files_from_site(download_location, engine=engine, priority=priority, window=window)
+
+
+def transfer_from_register(download_location, engine, priority, worker_processes, requeue_dead, window):
+    """Uploads (0) or downloads (1) the registered books through the work queue"""
+    from LibraryGenesis import LibraryGenesisScraper
     libgen_scraper = LibraryGenesisScraper()
-    libgen_scraper.get_files_from_site(download_location)
+    if requeue_dead:
+        print(f'{libgen_scraper.queue.requeue_dead(download_location)} dead letter(s) put back on the queue')
+    if worker_processes > 1 and download_location in (0, 1):
+        # Every process queues the same books (already queued ones are ignored) and leases from the shared queue file
+        processes = [multiprocessing.Process(target=drain_queue, args=(download_location, engine, priority, window))
+                     for _ in range(worker_processes - 1)]
+        for process in processes:
+            process.start()
+        libgen_scraper.get_files_from_site(download_location, engine=engine, priority=priority, window=window)
+        for process in processes:
+            process.join()
+    else:
+        libgen_scraper.get_files_from_site(download_location, engine=engine, priority=priority, window=window)
+
+
+def run_library_upload_download(download_location, engine='threads', metrics_file=None, priority='fifo',
+                                worker_processes=1, requeue_dead=False, transfer_window=0, inventory_max_age=0):
+    #%%
+    start_time = time.perf_counter()
+    if download_location == 2:
+        # Only the bucket is involved, so the register (and pandas with it) is never loaded
+        from aws_interface import download_from_bucket
+        print('Downloading from bucket to local pc')
+        download_from_bucket(max_workers=transfer_window or 8, max_age=inventory_max_age)
+    else:
+        transfer_from_register(download_location, engine, priority, worker_processes, requeue_dead, transfer_window)
+    METRICS.print_summary()
+    export_metrics(metrics_file)
     end_time = time.perf_counter()
     print(f'script took {end_time - start_time} second(s) to finish')
 
-
 if __name__ == '__main__':
-    FUNCTION_MAP = {'parse_library': run_library_parse, 'download_library': run_library_upload_download}
+    FUNCTION_MAP = {'parse_library': run_library_parse, 'download_library': run_library_upload_download,
+                    'merge_register': run_merge_register}
     parser = argparse.ArgumentParser(description='This script downloads pdf documents from "http://libgen.rs/" '
                                                  'and uploads them to either s3 bucket or your pc depending on option argument')
     parser.add_argument('command', choices=FUNCTION_MAP.keys(), help='The "parse_library" command takes the data '
                                                                      'from libgen url and places it into '
-                                                                     'Book-Register.csv. \n\n'
+                                                                     'Book-Register.sqlite. \n\n'
                                                                      'The "download_library" command takes the url from '
-                                                                     '"Book-Register.csv", from there there are 3 choices:\n'
+                                                                     '"Book-Register.sqlite", from there there are 3 choices:\n'
                                                                      '0=upload pdf to bucket,\n'
                                                                      '1=download pdf to local pc,\n'
-                                                                     '2=download pdfs from bucket to local pc.')
+                                                                     '2=download pdfs from bucket to local pc.\n\n'
+                                                                     'The "merge_register" command adds the register '
+                                                                     'partitions in --shard_dir to the register.')
     parser.add_argument('-sy', '--start_year',
                         default=2018,
                         type=int,
@@ -85,14 +326,134 @@ if __name__ == '__main__':
                              '0=upload pdf to bucket\n'
                              '1=download pdf to local pc PC\n'
                              '2=download pdfs from bucket to local pc')
+    parser.add_argument('-bs', '--batch_size',
+                        default=0,
+                        type=int,
+                        help='Stream each page and process it in batches of this many rows so memory stays flat '
+                             'however large max_limit is. 0 loads the whole page at once-(default: 0)')
+    parser.add_argument('-if', '--in_flight',
+                        default=0,
+                        type=int,
+                        help='Number of json pages fetched ahead across years and offsets while the current page is '
+                             'being processed. 0 fetches one page at a time-(default: 0)')
+    parser.add_argument('-dd', '--dewey_dump',
+                        default=None,
+                        type=str,
+                        help='Path to a csv with isbn and ddc columns to import into the local dewey index before '
+                             'parsing, so those isbns never need a classify lookup-(default: None)')
+    parser.add_argument('-mf', '--metrics_file',
+                        default=None,
+                        type=str,
+                        help='File the per stage timings, row/byte counts and in flight gauges are written to after '
+                             'every page and at the end of the run. A .prom file is written in the prometheus '
+                             'textfile format, anything else gets json lines appended-(default: None)')
+    parser.add_argument('-pg', '--paging',
+                        default='offset',
+                        choices=['offset', 'keyset'],
+                        help='How json.php is paged through-(default: offset):\n'
+                             'offset=limit1 offsets from starting_limit, rescanning the whole window every run\n'
+                             'keyset=after the last id seen, saved per year window so repeat runs only fetch '
+                             'new records (starting_limit is not used)')
+    parser.add_argument('-rm', '--reset_marks',
+                        action='store_true',
+                        help='With keyset paging, forget where each of the years being parsed got to and rescan '
+                             'them from the start')
+    parser.add_argument('-pc', '--page_cache',
+                        default='off',
+                        choices=CACHE_MODES,
+                        help='How json.php pages are cached in Page-Cache.sqlite-(default: off):\n'
+                             'off=every page is fetched\n'
+                             'revalidate=cached pages are used until they are older than --page_max_age, then '
+                             'checked with the server (ETag/Last-Modified) or fetched again\n'
+                             'replay=only cached pages are used and a page missing from the cache is an error')
+    parser.add_argument('-pa', '--page_max_age',
+                        default=DEFAULT_MAX_AGE,
+                        type=float,
+                        help='Seconds a cached json.php page is used before it is revalidated-(default: 86,400)')
+    parser.add_argument('-sc', '--shard_count',
+                        default=1,
+                        type=int,
+                        help='Number of shards parse_library splits the year windows into. Without --shard_index '
+                             'each shard runs in its own process and the partitions are merged at the end-(default: 1)')
+    parser.add_argument('-si', '--shard_index',
+                        default=None,
+                        type=int,
+                        help='Only parse this shard (0 to shard_count - 1), for spreading shards over machines. '
+                             'Run merge_register once every shard has finished-(default: None)')
+    parser.add_argument('-sd', '--shard_dir',
+                        default='shards',
+                        type=str,
+                        help='Directory the register partitions are written to and merged from-(default: shards)')
+    parser.add_argument('-pr', '--priority',
+                        default='fifo',
+                        choices=['fifo', 'ddc', 'newest'],
+                        help='Order download_library works through the queue in-(default: fifo):\n'
+                             'fifo=order the books were queued\n'
+                             'ddc=lowest dewey decimal class first\n'
+                             'newest=most recent publication year first')
+    parser.add_argument('-wp', '--worker_processes',
+                        default=1,
+                        type=int,
+                        help='Processes download_library runs, all leasing from Work-Queue.sqlite-(default: 1)')
+    parser.add_argument('-rq', '--requeue_dead',
+                        action='store_true',
+                        help='Give the books on the dead letter list a fresh set of attempts before starting')
+    parser.add_argument('-tw', '--transfer_window',
+                        default=0,
+                        type=int,
+                        help='Transfers download_library runs at once in each process, 0 for the default of the '
+                             'location (20 uploads, 3 downloads or 8 from the bucket). Send the process SIGUSR1 to '
+                             'double it and the dewey lookups while it runs, or SIGUSR2 to halve them-(default: 0)')
+    parser.add_argument('-ia', '--inventory_max_age',
+                        default=0,
+                        type=float,
+                        help='Seconds the bucket listing in S3-Inventory.sqlite is used before download_library -dl 2 '
+                             'lists the bucket again, 0 to always list it-(default: 0)')
+    parser.add_argument('-e', '--engine',
+                        default='threads',
+                        choices=['threads', 'async'],
+                        help='How dewey lookups are run-(default: threads):\n'
+                             'threads=thread pools of blocking requests\n'
+                             'async=asyncio on one shared connection pool, paced by the same host limiters '
+                             '(needs aiohttp). json.php pages and download_library transfers always run on threads')
     args = parser.parse_args()
+    if args.engine == 'async':
+        from async_fetch import async_engine_available
+        if not async_engine_available():
+            print('aiohttp is not installed, falling back to the threads engine')
+            args.engine = 'threads'
+
+    if args.command in ('parse_library', 'download_library'):
+        from bounded_executor import handle_resize_signals
+        handle_resize_signals()
+
+    if args.dewey_dump:
+        from dewey_cache import get_dewey_cache
+        get_dewey_cache().import_index(args.dewey_dump)
 
     run = FUNCTION_MAP[args.command]
     if args.command == 'parse_library':
-        run(start_year=args.start_year,
-            end_year=args.end_year,
-            language=args.language,
-            starting_limit=args.starting_limit,
-            max_limit=args.max_limit)
+        parse_options = dict(start_year=args.start_year,
+                             end_year=args.end_year,
+                             language=args.language,
+                             starting_limit=args.starting_limit,
+                             max_limit=args.max_limit,
+                             engine=args.engine,
+                             batch_size=args.batch_size,
+                             in_flight=args.in_flight,
+                             metrics_file=args.metrics_file,
+                             paging=args.paging,
+                             page_cache=args.page_cache,
+                             page_max_age=args.page_max_age,
+                             reset_marks=args.reset_marks)
+        if args.shard_count > 1 or args.shard_index is not None:
+            run_library_parse_sharded(args.shard_count, args.shard_index, args.shard_dir, **parse_options)
+        else:
+            run(**parse_options)
+            export_metrics(args.metrics_file)
     elif args.command == 'download_library':
-        run(download_location=args.download_location)
+        run(download_location=args.download_location, engine=args.engine, metrics_file=args.metrics_file,
+            priority=args.priority, worker_processes=args.worker_processes, requeue_dead=args.requeue_dead,
+            transfer_window=args.transfer_window, inventory_max_age=args.inventory_max_age)
+    elif args.command == 'merge_register':
+        run(shard_dir=args.shard_dir)
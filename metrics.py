@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+class Metrics:
+    """
+    Counters, latency histograms and in-flight gauges for each pipeline stage
+    (fetch, parse, filter, url build, dewey, register write, transfer).
+    Everything is keyed by stage name and safe to update from worker threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.rows = {}
+        self.bytes = {}
+        self.errors = {}
+        self.in_flight = {}
+        self.seconds = {}
+        self.histograms = {}
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        """Times one run of a stage. rows is how many records it handled, the yielded dict can update it"""
+        record = {'rows': rows}
+        with self.lock:
+            self.in_flight[name] = self.in_flight.get(name, 0) + 1
+        start_time = time.perf_counter()
+        failed = False
+        try:
+            yield record
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self.lock:
+                self.in_flight[name] -= 1
+            self.observe(name, time.perf_counter() - start_time, record['rows'], failed)
+
+    def observe(self, name, seconds, rows=0, failed=False):
+        """Records one run of a stage that was timed by the caller"""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.rows[name] = self.rows.get(name, 0) + rows
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            histogram = self.histograms.setdefault(name, [0] * len(LATENCY_BUCKETS))
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    histogram[index] += 1
+                    break
+
+    def add_bytes(self, name, byte_count):
+        with self.lock:
+            self.bytes[name] = self.bytes.get(name, 0) + byte_count
+
+    def snapshot(self):
+        with self.lock:
+            stages = set(self.calls) | set(self.bytes) | set(self.in_flight)
+            return {name: {'calls': self.calls.get(name, 0),
+                           'rows': self.rows.get(name, 0),
+                           'bytes': self.bytes.get(name, 0),
+                           'errors': self.errors.get(name, 0),
+                           'in_flight': self.in_flight.get(name, 0),
+                           'seconds': self.seconds.get(name, 0),
+                           'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS],
+                                                       self.histograms.get(name, [0] * len(LATENCY_BUCKETS))))}
+                    for name in sorted(stages)}
+
+    def write_json_lines(self, path):
+        """Appends one json line per stage, so a run leaves a time series behind"""
+        timestamp = time.time()
+        with open(path, 'a', encoding='utf-8') as f:
+            for name, values in self.snapshot().items():
+                f.write(json.dumps({'timestamp': timestamp, 'stage': name, **values}) + '\n')
+
+    def write_prometheus(self, path):
+        """Writes a node_exporter textfile collector file, replacing the previous one atomically"""
+        lines = ['# TYPE book_scraper_stage_calls_total counter',
+                 '# TYPE book_scraper_stage_rows_total counter',
+                 '# TYPE book_scraper_stage_bytes_total counter',
+                 '# TYPE book_scraper_stage_errors_total counter',
+                 '# TYPE book_scraper_stage_in_flight gauge',
+                 '# TYPE book_scraper_stage_seconds histogram']
+        for name, values in self.snapshot().items():
+            label = f'stage="{name}"'
+            lines.append(f'book_scraper_stage_calls_total{{{label}}} {values["calls"]}')
+            lines.append(f'book_scraper_stage_rows_total{{{label}}} {values["rows"]}')
+            lines.append(f'book_scraper_stage_bytes_total{{{label}}} {values["bytes"]}')
+            lines.append(f'book_scraper_stage_errors_total{{{label}}} {values["errors"]}')
+            lines.append(f'book_scraper_stage_in_flight{{{label}}} {values["in_flight"]}')
+            cumulative = 0
+            for bound, count in values['latency_buckets'].items():
+                cumulative += count
+                bound_label = '+Inf' if bound == 'inf' else bound
+                lines.append(f'book_scraper_stage_seconds_bucket{{{label},le="{bound_label}"}} {cumulative}')
+            lines.append(f'book_scraper_stage_seconds_sum{{{label}}} {values["seconds"]}')
+            lines.append(f'book_scraper_stage_seconds_count{{{label}}} {values["calls"]}')
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+
+    def export(self, path):
+        """Writes a prometheus textfile if path ends in .prom, json lines otherwise"""
+        if path.endswith('.prom'):
+            self.write_prometheus(path)
+        else:
+            self.write_json_lines(path)
+
+    def print_summary(self):
+        for name, values in self.snapshot().items():
+            rate = values['rows'] / values['seconds'] if values['seconds'] else 0
+            print(f'{name}: {values["calls"]} call(s), {values["rows"]} row(s), {values["bytes"]} byte(s), '
+                  f'{values["seconds"]:.2f}s, {rate:.1f} rows/s, {values["errors"]} error(s)')
+
+
+METRICS = Metrics()
@@ -0,0 +1,413 @@
+"""
+Local stand-ins for the services the scraper talks to, so it can be run and benchmarked without network access:
+libgen's json.php, classify.oclc.org, the pdf mirror and an s3 compatible bucket (public urls included).
+Everything is served from one port and routed on the path, see RedirectAdapter for pointing the shared
+requests sessions at it. Used by benchmark_pipeline.py.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, unquote_plus, urlsplit
+from xml.sax.saxutils import escape
+from requests.adapters import HTTPAdapter
+
+LANGUAGES = ('English', 'English', 'English', 'English', 'Russian')
+EXTENSIONS = ('pdf', 'pdf', 'pdf', 'pdf', 'pdf', 'pdf', 'pdf', 'pdf', 'epub', 'djvu')
+# Roughly half of these survive the 000/500/600 category filter in main.py
+DDC_CLASSES = ('005.133', '025.04', '150.19', '320.5', '510.76', '530.12', '616.89', '658.4', '823.914', '940.53')
+WORDS = ('data', 'systems', 'theory', 'introduction', 'advanced', 'practical', 'history', 'modern', 'quantum',
+         'analysis', 'design', 'principles', 'handbook', 'clinical', 'networks', 'methods', 'applied', 'guide')
+S3_LIST_PAGE_SIZE = 1000
+
+
+def isbn_check_digit(first_twelve):
+    total = sum(int(digit) * (1 if index % 2 == 0 else 3) for index, digit in enumerate(first_twelve))
+    return str((10 - total % 10) % 10)
+
+
+class ServiceConfig:
+    """
+    What the stand-ins serve. latency (seconds) is added to every response, error_rate is the share answered with 503
+    and bandwidth (bytes/s, 0 for no limit) caps each connection sending a pdf, like a slow mirror.
+    With json_etags json.php pages carry an ETag and answer If-None-Match with a 304, libgen may not do either.
+    """
+    def __init__(self, records_per_year=2000, pdf_size=128 * 1024, latency=0.0, error_rate=0.0, seed=0, bandwidth=0,
+                 json_etags=True):
+        self.records_per_year = records_per_year
+        self.pdf_size = pdf_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.bandwidth = bandwidth
+        self.json_etags = json_etags
+
+
+class OfflineServices:
+    """State shared by the request handler threads: generated books, the bucket contents and served counts"""
+    def __init__(self, config, counters=None):
+        self.config = config
+        self.counters = counters
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        # Every pdf is the same body with the book id appended, so its md5 only needs the tail hashed
+        self.pdf_body = b'%PDF-1.4\n' + bytes(range(256)) * (max(config.pdf_size - 9, 0) // 256 + 1)
+        self.pdf_body = self.pdf_body[:max(config.pdf_size, 9)]
+        self.pdf_hasher = hashlib.md5(self.pdf_body)
+        self.md5_to_id = {}
+        self.objects = {}
+        self.uploads = {}
+
+    def count(self, name, amount):
+        if self.counters is not None:
+            counter = self.counters[name]
+            with counter.get_lock():
+                counter.value += amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.rng.random() < self.config.error_rate
+
+    def pdf_tail(self, book_id):
+        return f'\n%{book_id}\n%%EOF\n'.encode()
+
+    def book_md5(self, book_id):
+        hasher = self.pdf_hasher.copy()
+        hasher.update(self.pdf_tail(book_id))
+        return hasher.hexdigest()
+
+    def make_record(self, year, index):
+        book_id = year * 1000000 + index
+        rng = random.Random(book_id)
+        md5 = self.book_md5(book_id)
+        with self.lock:
+            self.md5_to_id[md5] = book_id
+        identifier = ''
+        if rng.random() < 0.7:
+            first_twelve = '978' + ''.join(rng.choices('0123456789', k=9))
+            identifier = f'{first_twelve}{isbn_check_digit(first_twelve)}'
+            if rng.random() < 0.3:
+                identifier = f'{identifier},{first_twelve[3:]}X'
+        title = ' '.join(rng.choices(WORDS, k=rng.randint(2, 8))).title()
+        author = ' '.join(rng.choices(WORDS, k=2)).title()
+        if rng.random() < 0.2:
+            author = f'{author}; {" ".join(rng.choices(WORDS, k=2)).title()}'
+        return {'id': str(book_id),
+                'author': author,
+                'title': title,
+                'year': str(year),
+                'language': rng.choice(LANGUAGES),
+                'md5': md5.upper(),
+                'coverurl': f'{book_id // 1000 * 1000}/{md5}.jpg',
+                'identifier': identifier,
+                'extension': rng.choice(EXTENSIONS),
+                # One book a minute from the start of the year, so keyset paging has a stable order
+                'timelastmodified': (datetime(year, 1, 1) + timedelta(minutes=index)).strftime('%Y-%m-%d %H:%M:%S')}
+
+    @staticmethod
+    def select_fields(records, query):
+        """Only the fields asked for, like json.php (field names aren't case sensitive)"""
+        if 'fields' not in query:
+            return records
+        fields = [field.lower() for field in query['fields'][0].split(',')]
+        return [{field: record[field] for field in fields if field in record} for record in records]
+
+    def json_page(self, query):
+        """json.php, pages through records_per_year made up books for the year in timefirst"""
+        if query.get('mode', [''])[0] == 'newer':
+            return self.json_newer_page(query)
+        year = int(query['timefirst'][0][:4])
+        limit1 = int(query['limit1'][0])
+        limit2 = int(query['limit2'][0])
+        indexes = range(limit1, min(limit1 + limit2, self.config.records_per_year))
+        records = [self.make_record(year, index) for index in indexes]
+        self.count('records', len(records))
+        return json.dumps(self.select_fields(records, query)).encode()
+
+    def json_newer_page(self, query):
+        """json.php?mode=newer, the limit2 books after (timenewer, idnewer) oldest first"""
+        after_time = query['timenewer'][0]
+        after_id = int(query['idnewer'][0])
+        limit2 = int(query['limit2'][0])
+        after = datetime.strptime(after_time, '%Y-%m-%d %H:%M:%S')
+        year = after.year
+        index = max(int((after - datetime(year, 1, 1)).total_seconds() // 60), 0)
+        records = []
+        # Keyset windows never span more than two years, so there is no need to look further
+        while len(records) < limit2 and year <= after.year + 2:
+            if index >= self.config.records_per_year:
+                year += 1
+                index = 0
+                continue
+            record = self.make_record(year, index)
+            index += 1
+            if (record['timelastmodified'], int(record['id'])) > (after_time, after_id):
+                records.append(record)
+        self.count('records', len(records))
+        return json.dumps(self.select_fields(records, query)).encode()
+
+    def classify(self, query):
+        """classify2/Classify, answers isbn/title lookups with a made up but stable dewey class"""
+        (endpoint_key, values), = [(key, values) for key, values in query.items() if key in ('isbn', 'title', 'owi')]
+        rng = random.Random(f'{endpoint_key}:{values[0]}')
+        roll = rng.random()
+        if endpoint_key != 'owi' and roll < 0.1:
+            body = '<classify><response code="102"/></classify>'
+        elif endpoint_key == 'isbn' and roll < 0.2:
+            body = (f'<classify><response code="4"/><works><work owi="{rng.randint(1, 10 ** 9)}"/>'
+                    f'<work owi="{rng.randint(1, 10 ** 9)}"/></works></classify>')
+        else:
+            body = (f'<classify><response code="2"/><recommendations><ddc>'
+                    f'<mostPopular sfa="{rng.choice(DDC_CLASSES)}"/></ddc></recommendations></classify>')
+        return body.encode()
+
+    def pdf(self, path):
+        """The mirror, /main/{id group}/{md5}/{name}.pdf"""
+        md5 = path.split('/')[3]
+        with self.lock:
+            book_id = self.md5_to_id.get(md5)
+        if book_id is None:
+            return None
+        return self.pdf_body + self.pdf_tail(book_id)
+
+    def list_objects(self, bucket_name, query):
+        prefix = query.get('prefix', [''])[0]
+        start_after = query.get('continuation-token', query.get('start-after', ['']))[0]
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == bucket_name and key.startswith(prefix)
+                          and key > start_after)
+            page = [(key, self.objects[(bucket_name, key)]) for key in keys[:S3_LIST_PAGE_SIZE]]
+        truncated = len(keys) > S3_LIST_PAGE_SIZE
+        contents = ''.join(f'<Contents><Key>{escape(key)}</Key><LastModified>{modified}</LastModified>'
+                           f'<ETag>&quot;{etag}&quot;</ETag><Size>{len(data)}</Size>'
+                           f'<StorageClass>STANDARD</StorageClass></Contents>'
+                           for key, (data, etag, modified) in page)
+        next_token = f'<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>' if truncated else ''
+        return (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{escape(bucket_name)}</Name>'
+                f'<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount><MaxKeys>{S3_LIST_PAGE_SIZE}</MaxKeys>'
+                f'<IsTruncated>{str(truncated).lower()}</IsTruncated>{contents}{next_token}</ListBucketResult>').encode()
+
+    def put_object(self, bucket_name, key, data):
+        etag = hashlib.md5(data).hexdigest()
+        modified = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        with self.lock:
+            self.objects[(bucket_name, key)] = (data, etag, modified)
+        self.count('s3_bytes', len(data))
+        return etag
+
+
+def decode_aws_chunked(body):
+    """Strips the aws-chunked framing botocore uses for streamed bodies with trailing checksums"""
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b'\r\n', position)
+        size = int(body[position:line_end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        position = line_end + 2 + size + 2
+
+
+def make_handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # A client resetting an idle keep-alive connection while it is waited on for another request
+                pass
+
+        def send_body(self, status, body, content_type='application/octet-stream', headers=None, bandwidth=0):
+            try:
+                self.write_body(status, body, content_type, headers, bandwidth)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client hung up part way, as the segmented download does with the first response to a
+                # big book once it knows the size. Nothing more can be sent on this connection
+                self.close_connection = True
+
+        def write_body(self, status, body, content_type, headers, bandwidth):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+            if not bandwidth:
+                self.wfile.write(body)
+                return
+            # Sent in tenths of a second's worth of bytes
+            step = max(bandwidth // 10, 1)
+            for start in range(0, len(body), step):
+                self.wfile.write(body[start:start + step])
+                time.sleep(0.1)
+
+        def s3_error(self, status, code):
+            self.send_body(status, f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code>'
+                                   f'<Message>{code}</Message></Error>'.encode(), 'application/xml')
+
+        def read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+                body = bytes(body)
+            else:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+                body = decode_aws_chunked(body)
+            return body
+
+        def s3_location(self, path):
+            bucket_name, _, key = path.lstrip('/').partition('/')
+            # Signed api calls quote keys with %20, the public bucket urls are built with quote_plus
+            key = unquote(key) if 'Authorization' in self.headers else unquote_plus(key)
+            return bucket_name, key
+
+        def handle_request(self):
+            parts = urlsplit(self.path)
+            query = parse_qs(parts.query, keep_blank_values=True)
+            body = self.read_body() if self.command in ('PUT', 'POST') else b''
+            if services.config.latency:
+                time.sleep(services.config.latency)
+
+            if parts.path == '/json.php':
+                if services.should_fail():
+                    return self.send_body(503, b'Service Unavailable', 'text/plain')
+                page = services.json_page(query)
+                if not services.config.json_etags:
+                    return self.send_body(200, page, 'application/json')
+                etag = f'"{hashlib.md5(page).hexdigest()}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send_body(304, b'', headers={'ETag': etag})
+                return self.send_body(200, page, 'application/json', headers={'ETag': etag})
+
+            if parts.path.startswith('/classify2/'):
+                if services.should_fail():
+                    # classify reports its own failures in the xml, with code 200 meaning an unexpected error
+                    return self.send_body(503, b'<classify><response code="200"/></classify>', 'application/xml')
+                return self.send_body(200, services.classify(query), 'application/xml')
+
+            if parts.path.startswith('/main/'):
+                if services.should_fail():
+                    return self.send_body(503, b'Service Unavailable', 'text/plain')
+                payload = services.pdf(parts.path)
+                if payload is None:
+                    return self.send_body(404, b'Not Found', 'text/plain')
+                return self.send_ranged(payload, 'application/pdf')
+
+            bucket_name, key = self.s3_location(parts.path)
+            if self.command in ('PUT', 'POST') and services.should_fail():
+                return self.s3_error(503, 'SlowDown')
+            if self.command == 'GET' and not key:
+                return self.send_body(200, services.list_objects(bucket_name, query), 'application/xml')
+            if self.command == 'GET':
+                with services.lock:
+                    stored = services.objects.get((bucket_name, key))
+                if stored is None:
+                    return self.s3_error(404, 'NoSuchKey')
+                return self.send_ranged(stored[0], 'application/pdf', {'ETag': f'"{stored[1]}"'})
+            if self.command == 'POST' and 'uploads' in query:
+                upload_id = uuid.uuid4().hex
+                with services.lock:
+                    services.uploads[upload_id] = {}
+                return self.send_body(200, f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                                           f'<Bucket>{escape(bucket_name)}</Bucket><Key>{escape(key)}</Key>'
+                                           f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'.encode(),
+                                      'application/xml')
+            if self.command == 'PUT' and 'uploadId' in query:
+                with services.lock:
+                    parts_uploaded = services.uploads.get(query['uploadId'][0])
+                    if parts_uploaded is not None:
+                        parts_uploaded[int(query['partNumber'][0])] = body
+                if parts_uploaded is None:
+                    return self.s3_error(404, 'NoSuchUpload')
+                return self.send_body(200, b'', headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+            if self.command == 'POST' and 'uploadId' in query:
+                with services.lock:
+                    parts_uploaded = services.uploads.pop(query['uploadId'][0], None)
+                if parts_uploaded is None:
+                    return self.s3_error(404, 'NoSuchUpload')
+                etag = services.put_object(bucket_name, key, b''.join(parts_uploaded[number]
+                                                                      for number in sorted(parts_uploaded)))
+                return self.send_body(200, f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                                           f'<Bucket>{escape(bucket_name)}</Bucket><Key>{escape(key)}</Key>'
+                                           f'<ETag>&quot;{etag}&quot;</ETag></CompleteMultipartUploadResult>'.encode(),
+                                      'application/xml')
+            if self.command == 'DELETE' and 'uploadId' in query:
+                with services.lock:
+                    services.uploads.pop(query['uploadId'][0], None)
+                return self.send_body(204, b'')
+            if self.command == 'PUT':
+                etag = services.put_object(bucket_name, key, body)
+                return self.send_body(200, b'', headers={'ETag': f'"{etag}"'})
+            return self.s3_error(405, 'MethodNotAllowed')
+
+        def send_ranged(self, payload, content_type, headers=None):
+            range_header = self.headers.get('Range', '')
+            if range_header.startswith('bytes='):
+                start, _, end = range_header[6:].partition('-')
+                start = int(start)
+                end = min(int(end), len(payload) - 1) if end else len(payload) - 1
+                headers = {**(headers or {}), 'Content-Range': f'bytes {start}-{end}/{len(payload)}'}
+                body = payload[start:end + 1]
+                status = 206
+            else:
+                body = payload
+                status = 200
+            services.count('pdf_bytes', len(body))
+            self.send_body(status, body, content_type, {**(headers or {}), 'Accept-Ranges': 'bytes'},
+                           bandwidth=services.config.bandwidth)
+
+        do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+    return Handler
+
+
+def serve(config, port_queue, counters=None, host='127.0.0.1'):
+    """Serves the stand-ins until the process is stopped, putting the port it listens on in port_queue"""
+    services = OfflineServices(config, counters)
+    server = ThreadingHTTPServer((host, 0), make_handler(services))
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def service_targets(base_url, bucket_name='BUCKET'):
+    """Maps every host the scraper uses to the stand-in server at base_url"""
+    return {'libgen.rs': base_url,
+            'classify.oclc.org': base_url,
+            '31.42.184.140': base_url,
+            f'{bucket_name}.s3.eu-west-2.amazonaws.com': f'{base_url}/{bucket_name}'}
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Transport adapter that sends requests for the hosts in targets to another base url, keeping path and query"""
+    def __init__(self, targets, **kwargs):
+        # urlsplit lowercases hostnames, so the bucket host has to be matched lowercased too
+        self.targets = {host.lower(): base_url for host, base_url in targets.items()}
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname in self.targets:
+            request.url = f'{self.targets[parts.hostname]}{parts.path}{"?" + parts.query if parts.query else ""}'
+        return super().send(request, **kwargs)
@@ -0,0 +1,135 @@
+"""
+On-disk cache of json.php responses, so reruns and tuning experiments read their pages from Page-Cache.sqlite
+instead of downloading and decoding them again. Bodies are stored zlib compressed and keyed by the normalised query.
+"""
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# off=always fetch, revalidate=use a cached page while it is fresh and ask the server (with its ETag/Last-Modified
+# if it sent them) once it isn't, replay=only ever use cached pages, a page that isn't cached is an error
+CACHE_MODES = ('off', 'revalidate', 'replay')
+# How long a cached page is used without asking the server again
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+class PageNotCachedError(Exception):
+    """Replay mode was asked for a page that isn't in the cache"""
+
+
+def normalize_url(url):
+    """The same page always gets the same key, whatever order the query parameters and fields are in"""
+    parts = urlsplit(url)
+    query = sorted((name, ','.join(sorted(value.split(','))) if name == 'fields' else value)
+                   for name, value in parse_qsl(parts.query, keep_blank_values=True))
+    return f'{parts.netloc.lower()}{parts.path}?{urlencode(query)}'
+
+
+class CachedPage:
+    def __init__(self, body, etag, last_modified, validated):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated = validated
+
+    def validators(self):
+        """Headers for a conditional request, empty if the server gave neither an ETag nor a Last-Modified"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class PageWriter:
+    """Compresses a streamed response as it is read, the page is only stored if commit is called"""
+    def __init__(self, page_cache, url, headers):
+        self.page_cache = page_cache
+        self.url = url
+        self.headers = headers
+        self.compressor = zlib.compressobj(page_cache.compress_level)
+        self.parts = []
+        self.size = 0
+
+    def write(self, chunk):
+        self.parts.append(self.compressor.compress(chunk))
+        self.size += len(chunk)
+
+    def commit(self):
+        self.parts.append(self.compressor.flush())
+        self.page_cache.put_compressed(self.url, b''.join(self.parts), self.size, self.headers)
+
+
+class PageCache:
+    """
+    Persistent cache of json.php response bodies. A page younger than max_age seconds is used as it is.
+    An older one is revalidated, and a 304 marks it fresh again without downloading it. Pages from a server
+    that sends no validators are simply fetched again once they are stale.
+    The prefetch threads and sharded processes share the file, so one connection is used behind a lock.
+    """
+    def __init__(self, path='Page-Cache.sqlite', mode='revalidate', max_age=DEFAULT_MAX_AGE, compress_level=6):
+        if mode not in CACHE_MODES:
+            raise ValueError(f'page cache mode must be one of {", ".join(CACHE_MODES)}')
+        self.path = path
+        self.mode = mode
+        self.max_age = max_age
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pages ('
+                                    'url_key TEXT PRIMARY KEY, '
+                                    'body BLOB NOT NULL, '
+                                    'size INTEGER NOT NULL, '
+                                    'etag TEXT, '
+                                    'last_modified TEXT, '
+                                    'fetched REAL NOT NULL, '
+                                    'validated REAL NOT NULL)')
+
+    def get(self, url):
+        """The cached page for url, None if there isn't one"""
+        with self.lock:
+            row = self.connection.execute('SELECT body, etag, last_modified, validated FROM pages WHERE url_key = ?',
+                                          (normalize_url(url),)).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, validated = row
+        return CachedPage(zlib.decompress(body), etag, last_modified, validated)
+
+    def is_fresh(self, page):
+        return self.mode == 'replay' or time.time() - page.validated < self.max_age
+
+    def put(self, url, body, headers):
+        """Stores a 200 response body with the validators from its headers"""
+        self.put_compressed(url, zlib.compress(body, self.compress_level), len(body), headers)
+
+    def put_compressed(self, url, compressed, size, headers):
+        time_now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO pages '
+                                    '(url_key, body, size, etag, last_modified, fetched, validated) '
+                                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (normalize_url(url), compressed, size, headers.get('ETag'),
+                                     headers.get('Last-Modified'), time_now, time_now))
+
+    def writer(self, url, headers):
+        return PageWriter(self, url, headers)
+
+    def revalidated(self, url):
+        """The server answered 304, so the cached page is fresh for another max_age seconds"""
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE pages SET validated = ? WHERE url_key = ?',
+                                    (time.time(), normalize_url(url)))
+
+    def stats(self):
+        """Returns (pages, bytes before compression, bytes on disk)"""
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                                           'COALESCE(SUM(LENGTH(body)), 0) FROM pages').fetchone()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,56 @@
+import concurrent.futures
+
+
+def iter_pages_prefetched(fetch_page, years, starting_limit, max_limit, in_flight=4):
+    """
+    Fetches json.php pages for several years and offsets at once and yields (year, limit1, records)
+    as each one arrives, so the caller can enrich one page while the next ones are still downloading.
+
+    fetch_page(year, limit1, limit2) must return the list of records for that page.
+    At most in_flight pages are being fetched at any time, plus the pages handed to the caller. Years are scheduled
+    round robin, and a year stops getting new pages once one of its pages comes back short (fewer than
+    max_limit records), which is how run_library_parse knows it has reached the end of a year.
+    """
+    next_limit = {year: starting_limit for year in years}
+    finished_years = set()
+    # Year index for round robin scheduling
+    schedule_order = list(years)
+    schedule_position = 0
+
+    def next_page():
+        nonlocal schedule_position
+        for _ in range(len(schedule_order)):
+            year = schedule_order[schedule_position % len(schedule_order)]
+            schedule_position += 1
+            if year not in finished_years:
+                limit1 = next_limit[year]
+                next_limit[year] += max_limit
+                return year, limit1
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=in_flight) as executor:
+        pending = {}
+
+        def fill():
+            while len(pending) < in_flight:
+                page = next_page()
+                if page is None:
+                    return
+                year, limit1 = page
+                pending[executor.submit(fetch_page, year, limit1, max_limit)] = page
+
+        fill()
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            pages = []
+            for future in done:
+                year, limit1 = pending.pop(future)
+                records = future.result()
+                if len(records) < max_limit:
+                    finished_years.add(year)
+                pages.append((year, limit1, records))
+            # Refill before handing the pages over so fetching overlaps with the caller's enrichment
+            fill()
+            for year, limit1, records in pages:
+                if records:
+                    yield year, limit1, records
@@ -0,0 +1,166 @@
+"""
+Segmented downloads for download_library. A large file from a mirror that takes Range requests is fetched as
+several byte ranges at once, each written straight to its offset in a preallocated .part file, so one slow
+connection doesn't hold up the whole book. The finished segments are listed in a .segments file next to the
+.part file, so an interrupted download only fetches the segments it is missing.
+"""
+import concurrent.futures
+import json
+import os
+import time
+from os.path import exists
+from connection_pool import get_http_session
+from rate_limiter import limited_get, permanent_failure
+from metrics import METRICS
+
+# Tune these to the mirror and your connection. Each segment is one range request on its own connection
+SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_WORKERS = 4
+# Smaller files go down one stream, the extra requests wouldn't pay for themselves
+MIN_SEGMENTED_SIZE = 2 * SEGMENT_SIZE
+# Read size for response bodies, for single stream downloads too
+BUFFER_SIZE = 256 * 1024
+SEGMENT_RETRIES = 5
+
+
+class RangesNotSupportedError(Exception):
+    """The mirror answered a range request with the whole file"""
+
+
+class SegmentError(Exception):
+    pass
+
+
+def segments_path(part_path):
+    return f'{part_path}.segments'
+
+
+def segmentable_size(response):
+    """The file size if the (200) response is for a file worth downloading in segments, otherwise None"""
+    if response.status_code != 200 or response.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    length = response.headers.get('Content-Length', '')
+    if not length.isdigit() or int(length) < MIN_SEGMENTED_SIZE:
+        return None
+    return int(length)
+
+
+def new_segment_map(size):
+    return {'size': size, 'segment_size': SEGMENT_SIZE, 'done': []}
+
+
+def load_segment_map(part_path):
+    """The segment map of an interrupted segmented download, None if the .part file wasn't one"""
+    if not exists(segments_path(part_path)) or not exists(part_path):
+        return None
+    try:
+        with open(segments_path(part_path), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_segment_map(part_path, segment_map):
+    temp_path = f'{segments_path(part_path)}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(segment_map, f)
+    os.replace(temp_path, segments_path(part_path))
+
+
+def discard_segments(part_path):
+    for path in (part_path, segments_path(part_path)):
+        if exists(path):
+            os.remove(path)
+
+
+def bytes_done(segment_map):
+    size = segment_map['size']
+    return sum(min(segment_map['segment_size'], size - start) for start in segment_map['done'])
+
+
+def preallocate(part_path, size):
+    with open(part_path, 'wb') as f:
+        if hasattr(os, 'posix_fallocate'):
+            # Reserves the blocks up front, so the segments don't leave the file fragmented on disk
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+
+
+def write_range(response, part_path, start, length):
+    """Writes the first length bytes of the response body at start in part_path"""
+    remaining = length
+    with open(part_path, 'r+b') as f:
+        f.seek(start)
+        for chunk in response.iter_content(chunk_size=BUFFER_SIZE):
+            chunk = chunk[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+            METRICS.add_bytes('transfer', len(chunk))
+            if not remaining:
+                return
+    raise SegmentError(f'connection closed {remaining} byte(s) short')
+
+
+def fetch_segment(url, part_path, start, end, first_response=None):
+    """Downloads bytes start to end (inclusive) of url into the same place in part_path"""
+    error = None
+    for attempt in range(SEGMENT_RETRIES):
+        if first_response is not None and attempt == 0:
+            # The response that found the file's size is already at byte 0, so it is used for the first segment
+            response = first_response
+        else:
+            response = limited_get(get_http_session(), url, stream=True, headers={'Range': f'bytes={start}-{end}'})
+        with response:
+            if response is not first_response:
+                if response.status_code == 200:
+                    raise RangesNotSupportedError(f'{url} ignored the range request')
+                if permanent_failure(response.status_code):
+                    raise SegmentError(f'bytes {start}-{end} failed: status code {response.status_code}')
+                if response.status_code != 206 or \
+                        not response.headers.get('Content-Range', '').startswith(f'bytes {start}-'):
+                    error = f'status code {response.status_code}'
+                    time.sleep(min(2 ** attempt, 30))
+                    continue
+            try:
+                write_range(response, part_path, start, end - start + 1)
+                return start
+            except Exception as err:
+                error = str(err)
+        time.sleep(min(2 ** attempt, 30))
+    raise SegmentError(f'bytes {start}-{end} failed after {SEGMENT_RETRIES} attempt(s): {error}')
+
+
+def download_segments(url, part_path, segment_map, first_response=None, workers=SEGMENT_WORKERS, progress=None):
+    """
+    Fetches every segment of segment_map not already done into part_path, recording each one as it finishes.
+    first_response is an open 200 response for url, used for the segment at byte 0 if it is still needed.
+    progress() is called after each finished segment, anything it raises stops the download.
+    Raises RangesNotSupportedError if the mirror stops honouring ranges, or SegmentError if a segment keeps failing.
+    """
+    size = segment_map['size']
+    segment_size = segment_map['segment_size']
+    if not segment_map['done']:
+        preallocate(part_path, size)
+        save_segment_map(part_path, segment_map)
+    done = set(segment_map['done'])
+    pending = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)
+               if start not in done]
+    if first_response is not None and (not pending or pending[0][0] != 0):
+        first_response.close()
+        first_response = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_segment, url, part_path, start, end,
+                                   first_response if start == 0 else None)
+                   for start, end in pending]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                start = future.result()
+                segment_map['done'].append(start)
+                save_segment_map(part_path, segment_map)
+                if progress is not None:
+                    progress()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
@@ -0,0 +1,128 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# Starting point for each host. rate is requests per second, burst is how many tokens can build up,
+# max_concurrency is the most requests allowed in flight. The limiter adapts below these as the host pushes back.
+HOST_LIMITS = {'libgen.rs': {'rate': 2, 'burst': 4, 'max_concurrency': 4},
+               '31.42.184.140': {'rate': 10, 'burst': 20, 'max_concurrency': 20},
+               'classify.oclc.org': {'rate': 20, 'burst': 40, 'max_concurrency': 20},
+               's3': {'rate': 100, 'burst': 200, 'max_concurrency': 32}}
+DEFAULT_LIMITS = {'rate': 10, 'burst': 20, 'max_concurrency': 10}
+# Responses that mean the host wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+
+def permanent_failure(status_code):
+    """A 4xx other than 429: asking again straight away gets the same answer, and the limiter doesn't slow down for it"""
+    return 400 <= status_code < 500 and status_code not in THROTTLE_STATUSES
+
+
+class CircuitOpenError(Exception):
+    """Raised by HostLimiter.acquire(block=False) while a host's circuit breaker is open"""
+
+
+class HostLimiter:
+    """
+    Token bucket and adaptive concurrency limit for one remote host, with a circuit breaker.
+    Throttling responses, 5xx errors and connection errors halve the rate and the concurrency limit,
+    successes add them back a little at a time (AIMD), and slow responses gently reduce concurrency.
+    After failure_threshold failures in a row the breaker opens and no requests are sent for reset_timeout
+    seconds, then a single trial request decides whether it closes again.
+    """
+    def __init__(self, host, rate, burst, max_concurrency, target_latency=10.0, failure_threshold=5, reset_timeout=30.0):
+        self.host = host
+        self.condition = threading.Condition()
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 32
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = None
+        self.half_open = False
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, block=True):
+        """Waits for a token and a free slot, returns the start time to pass to release"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.open_until is not None:
+                    if now < self.open_until:
+                        if not block:
+                            raise CircuitOpenError(f'circuit open for {self.host} for another {self.open_until - now:.0f}s')
+                        self.condition.wait(self.open_until - now)
+                        continue
+                    print(f'{self.host}: circuit half open, sending a trial request')
+                    self.open_until = None
+                    self.half_open = True
+                    self.concurrency = 1.0
+
+                self.refill(now)
+                if self.in_flight < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                wait_time = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+                self.condition.wait(wait_time)
+
+    def release(self, start, throttled=False):
+        """Records how the request went and frees its slot"""
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if throttled:
+                self.failures += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if self.half_open or self.failures >= self.failure_threshold:
+                    print(f'{self.host}: {self.failures} failure(s) in a row, circuit open for {self.reset_timeout}s')
+                    self.open_until = now + self.reset_timeout
+                    self.half_open = False
+            else:
+                if self.half_open:
+                    print(f'{self.host}: trial request succeeded, circuit closed')
+                self.failures = 0
+                self.half_open = False
+                if now - start > self.target_latency:
+                    self.concurrency = max(1.0, self.concurrency * 0.9)
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.condition.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, **HOST_LIMITS.get(host, DEFAULT_LIMITS))
+        return _limiters[host]
+
+
+def limited_get(session, url, block=True, **kwargs):
+    """session.get(url) paced by the url's host limiter"""
+    limiter = get_limiter(urlsplit(url).hostname)
+    start = limiter.acquire(block)
+    try:
+        response = session.get(url, **kwargs)
+    except Exception:
+        limiter.release(start, throttled=True)
+        raise
+    limiter.release(start, throttled=response.status_code in THROTTLE_STATUSES or response.status_code >= 500)
+    return response
@@ -0,0 +1,182 @@
+"""
+The compact record layout scraped rows use from parsing to the register, and a columnar file format for it.
+Language is categorical, year and dewey class are small nullable ints, the md5 is its 16 raw bytes and the
+transfer status is a bool with its message and timestamp in their own columns (instead of a [status, message] list).
+"""
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+YEAR_DTYPE = 'Int16'
+DDC_DTYPE = 'Int16'
+STATUS_COLUMNS = ('uploaded', 'upload message', 'status time')
+COLUMNAR_FORMAT_VERSION = 1
+
+
+def md5_to_bytes(value):
+    """32 character hex md5 -> 16 raw bytes, None for anything that isn't an md5"""
+    if isinstance(value, bytes):
+        return value if len(value) == 16 else None
+    try:
+        md5 = bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return None
+    return md5 if len(md5) == 16 else None
+
+
+def md5_hex(value):
+    """Lowercase hex md5 from either form, '' when there is none"""
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, str):
+        return value.lower()
+    return ''
+
+
+def to_small_int(values, dtype, upper_bound):
+    """Numbers (or numeric strings) rounded down into a nullable int column, out of range values become NA"""
+    numbers = np.floor(pd.to_numeric(values, errors='coerce'))
+    return numbers.where(numbers.between(0, upper_bound)).astype(dtype)
+
+
+def compact_dataframe(df):
+    """Converts a page or register dataframe to the compact layout, in place, and returns it"""
+    if 'id' in df.columns:
+        df['id'] = pd.to_numeric(df['id'], errors='coerce').astype('Int64')
+    if 'year' in df.columns:
+        df['year'] = to_small_int(df['year'], YEAR_DTYPE, 9999)
+    if 'language' in df.columns:
+        df['language'] = df['language'].astype(object).str.lower().astype('category')
+    if 'extension' in df.columns:
+        df['extension'] = df['extension'].astype(object).str.lower().astype('category')
+    if 'md5' in df.columns:
+        df['md5'] = df['md5'].map(md5_to_bytes).astype(object)
+    if 'dewey decimal category' in df.columns:
+        df['dewey decimal category'] = to_small_int(df['dewey decimal category'], DDC_DTYPE, 999)
+    if 'file uploaded' in df.columns:
+        # The [status, message] list older registers and csv files have
+        file_uploaded = df.pop('file uploaded')
+        df['uploaded'] = [bool(status[0]) for status in file_uploaded]
+        df['upload message'] = [status[1] for status in file_uploaded]
+    if 'uploaded' in df.columns:
+        df['uploaded'] = df['uploaded'].fillna(False).astype(bool)
+    if 'status time' in df.columns:
+        status_time = df['status time']
+        status_time = pd.to_datetime(status_time, unit='s') if pd.api.types.is_numeric_dtype(status_time) \
+            else pd.to_datetime(status_time)
+        df['status time'] = status_time.astype('datetime64[ns]')
+    return df
+
+
+def now():
+    """Status times are kept as naive UTC, the same as the epoch seconds the register stores"""
+    return pd.Timestamp(time.time(), unit='s')
+
+
+def encode_column(name, values):
+    """Returns (header, {suffix: array}) for one column"""
+    mask = values.isna().to_numpy()
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories_header, categories_arrays = encode_column('categories', pd.Series(values.cat.categories.astype(str)))
+        return ({'name': name, 'kind': 'category', 'categories': categories_header},
+                {'codes': values.cat.codes.to_numpy(), **{f'categories.{suffix}': array
+                                                          for suffix, array in categories_arrays.items()}})
+    if pd.api.types.is_bool_dtype(values.dtype):
+        return {'name': name, 'kind': 'bool'}, {'values': values.fillna(False).to_numpy(dtype=bool)}
+    if pd.api.types.is_integer_dtype(values.dtype):
+        numpy_dtype = values.dtype.numpy_dtype if hasattr(values.dtype, 'numpy_dtype') else values.dtype
+        return ({'name': name, 'kind': 'int', 'dtype': str(values.dtype)},
+                {'values': values.fillna(0).to_numpy(dtype=numpy_dtype), 'mask': mask})
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return ({'name': name, 'kind': 'datetime'},
+                {'values': values.to_numpy(dtype='datetime64[ns]').view('int64'), 'mask': mask})
+    non_null = values[~mask]
+    if len(non_null) and all(isinstance(value, bytes) for value in non_null):
+        # A row of width bytes per value plus its length, numpy's own S dtype would drop trailing zero bytes
+        width = max(len(value) for value in non_null)
+        padded = b''.join((b'' if missing else value).ljust(width, b'\0') for value, missing in zip(values, mask))
+        return ({'name': name, 'kind': 'binary', 'width': width},
+                {'values': np.frombuffer(padded, dtype=np.uint8),
+                 'lengths': np.array([0 if missing else len(value) for value, missing in zip(values, mask)],
+                                     dtype=np.int32),
+                 'mask': mask})
+    strings = ['' if missing else str(value) for value, missing in zip(values, mask)]
+    # Arrow style: one utf-8 blob and the character offset each value starts at
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return ({'name': name, 'kind': 'string'},
+            {'text': np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8), 'offsets': offsets, 'mask': mask})
+
+
+def decode_column(header, arrays):
+    kind = header['kind']
+    if kind == 'category':
+        categories = decode_column(header['categories'], {suffix[len('categories.'):]: array
+                                                          for suffix, array in arrays.items()
+                                                          if suffix.startswith('categories.')})
+        return pd.Categorical.from_codes(arrays['codes'], categories=categories)
+    if kind == 'bool':
+        return arrays['values']
+    if kind == 'int':
+        values = pd.array(arrays['values'], dtype=header['dtype'])
+        if arrays['mask'].any():
+            values[arrays['mask']] = pd.NA
+        return values
+    if kind == 'datetime':
+        values = arrays['values'].view('datetime64[ns]').copy()
+        values[arrays['mask']] = np.datetime64('NaT')
+        return values
+    if kind == 'binary':
+        data = arrays['values'].tobytes()
+        width = header['width']
+        values = np.array([data[index * width:index * width + length]
+                           for index, length in enumerate(arrays['lengths'].tolist())], dtype=object)
+        values[arrays['mask']] = None
+        return values
+    text = arrays['text'].tobytes().decode('utf-8')
+    offsets = arrays['offsets'].tolist()
+    values = np.array([text[start:end] for start, end in zip(offsets[:-1], offsets[1:])], dtype=object)
+    values[arrays['mask']] = None
+    return values
+
+
+def write_columns(df, path, metadata=None):
+    """
+    Saves df as one numpy array per column in an uncompressed .npz file, replacing path atomically.
+    No pickling is involved, so it can be loaded back safely and without parsing every row.
+    """
+    headers = []
+    arrays = {}
+    for index, name in enumerate(df.columns):
+        header, column_arrays = encode_column(name, df[name])
+        headers.append(header)
+        arrays.update({f'{index}.{suffix}': array for suffix, array in column_arrays.items()})
+    header = json.dumps({'format': COLUMNAR_FORMAT_VERSION, 'rows': df.shape[0], 'columns': headers,
+                         'metadata': metadata or {}})
+    arrays['header'] = np.frombuffer(header.encode('utf-8'), dtype=np.uint8)
+    # Every process has its own temp file, download_library worker processes can rebuild the copy at the same time
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def read_header(path):
+    with np.load(path, allow_pickle=False) as npz:
+        return json.loads(npz['header'].tobytes().decode('utf-8'))
+
+
+def read_columns(path):
+    """Loads a file written by write_columns, returns (dataframe, metadata)"""
+    with np.load(path, allow_pickle=False) as npz:
+        header = json.loads(npz['header'].tobytes().decode('utf-8'))
+        if header['format'] != COLUMNAR_FORMAT_VERSION:
+            raise ValueError(f'{path} is columnar format {header["format"]}, expected {COLUMNAR_FORMAT_VERSION}')
+        columns = {}
+        for index, column_header in enumerate(header['columns']):
+            prefix = f'{index}.'
+            arrays = {key[len(prefix):]: npz[key] for key in npz.files if key.startswith(prefix)}
+            columns[column_header['name']] = decode_column(column_header, arrays)
+    return pd.DataFrame(columns, index=pd.RangeIndex(header['rows'])), header['metadata']
@@ -0,0 +1,54 @@
+"""
+Splits parse_library into shards of year windows so it can run in several processes, or on several machines
+sharing a directory. Each shard writes its own register partition and merge_partitions joins them into the register.
+"""
+import glob
+import os
+from book_register import BookRegister
+
+PARTITION_PATTERN = 'Book-Register.shard-*.sqlite'
+
+
+def plan_shards(start_year, end_year, shard_count):
+    """
+    Deals the year windows out round robin and returns a list of years for each shard.
+    Later years have more books, so dealing them out keeps the shards closer in size than contiguous ranges would.
+    """
+    years = list(range(start_year, end_year))
+    shard_count = max(1, min(shard_count, len(years)))
+    return [years[index::shard_count] for index in range(shard_count)]
+
+
+def partition_path(shard_dir, shard_index, shard_count):
+    return os.path.join(shard_dir, f'Book-Register.shard-{shard_index}-of-{shard_count}.sqlite')
+
+
+def open_partition(shard_dir, shard_index, shard_count):
+    """Creates the shard's partition if needed and returns its path"""
+    os.makedirs(shard_dir, exist_ok=True)
+    path = partition_path(shard_dir, shard_index, shard_count)
+    # Opened here without csv_path so the old Book-Register.csv is only ever migrated into the main register
+    BookRegister(path, csv_path=None).close()
+    return path
+
+
+def merge_partitions(shard_dir, register_path='Book-Register.sqlite'):
+    """
+    Adds every partition in shard_dir to the register. Rows already in the register keep their upload status,
+    so merging the same partitions again is harmless. Returns the number of rows added.
+    """
+    paths = sorted(glob.glob(os.path.join(shard_dir, PARTITION_PATTERN)))
+    if not paths:
+        print(f'No register partitions found in {shard_dir}')
+        return 0
+    register = BookRegister(register_path)
+    total = 0
+    try:
+        for path in paths:
+            added = register.merge_from(path)
+            print(f'{added} new row(s) merged from {path}')
+            total += added
+    finally:
+        register.close()
+    print(f'{total} new row(s) merged into {register_path} from {len(paths)} partition(s)')
+    return total
@@ -0,0 +1,91 @@
+import sqlite3
+import threading
+import time
+
+
+class S3Inventory:
+    """
+    Local index of the keys, sizes and ETags under a bucket prefix.
+    The bucket is listed once per refresh with a prefix scoped, paginated listing (rather than filtering
+    bucket.objects.all() on the client), and the ETag of every object downloaded to this machine is kept
+    so later runs only fetch objects that are new or have changed.
+    """
+    def __init__(self, path='S3-Inventory.sqlite'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS objects ('
+                                    'bucket TEXT NOT NULL, '
+                                    'key TEXT NOT NULL, '
+                                    'size INTEGER, '
+                                    'etag TEXT, '
+                                    'last_modified TEXT, '
+                                    'local_etag TEXT, '
+                                    'listed REAL NOT NULL, '
+                                    'PRIMARY KEY (bucket, key))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS listings ('
+                                    'bucket TEXT NOT NULL, '
+                                    'prefix TEXT NOT NULL, '
+                                    'refreshed REAL NOT NULL, '
+                                    'PRIMARY KEY (bucket, prefix))')
+
+    def last_refreshed(self, bucket_name, prefix):
+        with self.lock:
+            row = self.connection.execute('SELECT refreshed FROM listings WHERE bucket = ? AND prefix = ?',
+                                          (bucket_name, prefix)).fetchone()
+        return row[0] if row else None
+
+    def refresh(self, s3_client, bucket_name, prefix='ScrapedBooks/', max_age=0):
+        """
+        Lists the prefix and updates the index, dropping keys that are no longer in the bucket.
+        The listing is skipped if the index was refreshed less than max_age seconds ago.
+        """
+        last_refreshed = self.last_refreshed(bucket_name, prefix)
+        if last_refreshed is not None and time.time() - last_refreshed < max_age:
+            return 0
+        listed = time.time()
+        count = 0
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            rows = [(bucket_name, item['Key'], item['Size'], item['ETag'].strip('"'), str(item['LastModified']), listed)
+                    for item in page.get('Contents', [])]
+            count += len(rows)
+            with self.lock:
+                with self.connection:
+                    self.connection.executemany('INSERT INTO objects (bucket, key, size, etag, last_modified, listed) '
+                                                'VALUES (?, ?, ?, ?, ?, ?) '
+                                                'ON CONFLICT(bucket, key) DO UPDATE SET size = excluded.size, '
+                                                'etag = excluded.etag, last_modified = excluded.last_modified, '
+                                                'listed = excluded.listed', rows)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM objects WHERE bucket = ? AND substr(key, 1, ?) = ? AND listed < ?',
+                                        (bucket_name, len(prefix), prefix, listed))
+                self.connection.execute('INSERT OR REPLACE INTO listings (bucket, prefix, refreshed) VALUES (?, ?, ?)',
+                                        (bucket_name, prefix, listed))
+        print(f'Listed {count} object(s) under {bucket_name}/{prefix}')
+        return count
+
+    def keys(self, bucket_name, prefix='ScrapedBooks/'):
+        with self.lock:
+            rows = self.connection.execute('SELECT key FROM objects WHERE bucket = ? AND substr(key, 1, ?) = ? '
+                                           'ORDER BY key', (bucket_name, len(prefix), prefix)).fetchall()
+        return [row[0] for row in rows]
+
+    def objects(self, bucket_name, prefix='ScrapedBooks/'):
+        """Returns (key, size, etag, local_etag) for every object under the prefix"""
+        with self.lock:
+            return self.connection.execute('SELECT key, size, etag, local_etag FROM objects WHERE bucket = ? '
+                                           'AND substr(key, 1, ?) = ? ORDER BY key',
+                                           (bucket_name, len(prefix), prefix)).fetchall()
+
+    def mark_downloaded(self, bucket_name, key, etag):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('UPDATE objects SET local_etag = ? WHERE bucket = ? AND key = ?',
+                                        (etag, bucket_name, key))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+import time
+
+
+class TransferJournal:
+    """
+    Durable per-item record of the download_library transfers, written as each transfer finishes
+    (and every few MB for downloads in progress), so an interrupted run can skip what is done and
+    resume partial files with a Range request.
+    Items are keyed by the libgen id and the download_location the transfer was for.
+    """
+    def __init__(self, path='Transfer-Journal.sqlite'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS journal ('
+                                    'book_id TEXT NOT NULL, '
+                                    'location INTEGER NOT NULL, '
+                                    'status TEXT NOT NULL, '
+                                    'bytes_done INTEGER NOT NULL DEFAULT 0, '
+                                    'file_path TEXT, '
+                                    'message TEXT, '
+                                    'updated REAL NOT NULL, '
+                                    'PRIMARY KEY (book_id, location))')
+
+    def record(self, book_id, location, status, bytes_done=0, file_path=None, message=None):
+        """status is one of 'done', 'partial' or 'failed'"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO journal '
+                                        '(book_id, location, status, bytes_done, file_path, message, updated) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (str(book_id), location, status, bytes_done, file_path, message, time.time()))
+
+    def get(self, book_id, location):
+        """Returns (status, bytes_done, file_path) for the item, or None if it has never been started"""
+        with self.lock:
+            return self.connection.execute('SELECT status, bytes_done, file_path FROM journal '
+                                           'WHERE book_id = ? AND location = ?', (str(book_id), location)).fetchone()
+
+    def completed_ids(self, location):
+        with self.lock:
+            rows = self.connection.execute('SELECT book_id FROM journal WHERE location = ? AND status = ?',
+                                           (location, 'done')).fetchall()
+        return {row[0] for row in rows}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,195 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+# Ways to order the download_library queue, each maps register rows to priorities (higher goes first)
+PRIORITIES = {'fifo': lambda df: [0] * df.shape[0],
+              'ddc': lambda df: (1000 - df['dewey decimal category'].fillna(999).astype(int)).tolist(),
+              'newest': lambda df: df['year'].fillna(0).astype(int).tolist()}
+
+
+class LeaseLostError(Exception):
+    """A transfer's lease ran out and another worker has the item now"""
+
+
+def lease_owner():
+    """Identifies a worker thread across machines and processes sharing the queue"""
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def owner_alive(owner):
+    """
+    False if owner was a process on this machine that has since exited. Other machines are assumed alive, and so is
+    everything on windows, where signal 0 is CTRL_C_EVENT rather than a probe, those leases just run out
+    """
+    host, pid, _ = owner.split(':')
+    if host != socket.gethostname() or os.name != 'posix':
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WorkQueue:
+    """
+    Persistent queue of download_library transfers that workers lease items from, keyed by libgen id and location.
+    A leased item is invisible to other workers until its lease runs out (visibility_timeout seconds). Transfers renew
+    their lease as they make progress, so only a stalled or dead worker loses its item, and items leased by a
+    process on this machine that has exited are taken back straight away. Failed items go back on the queue after a backoff,
+    and after max_attempts they are moved to the dead letter list instead.
+    Any number of threads and processes can share one queue file. Leases are taken in an immediate transaction
+    so two workers never get the same item.
+    """
+    def __init__(self, path='Work-Queue.sqlite', visibility_timeout=600, max_attempts=5, retry_backoff=30):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lock = threading.Lock()
+        # isolation_level=None so the lease transaction can be started with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS items ('
+                                'book_id TEXT NOT NULL, '
+                                'location INTEGER NOT NULL, '
+                                'priority INTEGER NOT NULL DEFAULT 0, '
+                                'state TEXT NOT NULL, '
+                                'attempts INTEGER NOT NULL DEFAULT 0, '
+                                'available_at REAL NOT NULL, '
+                                'lease_owner TEXT, '
+                                'lease_expires REAL, '
+                                'last_error TEXT, '
+                                'enqueued REAL NOT NULL, '
+                                'updated REAL NOT NULL, '
+                                'PRIMARY KEY (book_id, location))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS items_ready ON items (location, state, priority, enqueued)')
+
+    def transaction(self, sql_calls):
+        """Runs sql_calls(connection) in one immediate transaction and returns what it returns"""
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = sql_calls(self.connection)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+            return result
+
+    def enqueue_many(self, location, items):
+        """
+        Adds (book_id, priority) pairs. Items already queued keep their state, so finished and dead items
+        aren't started again, but waiting items pick up the new priority. Returns how many were new.
+        """
+        now = time.time()
+        rows = [(str(book_id), location, int(priority), now, now, now) for book_id, priority in items]
+
+        def enqueue(connection):
+            before = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO items '
+                                   '(book_id, location, priority, state, available_at, enqueued, updated) '
+                                   "VALUES (?, ?, ?, 'ready', ?, ?, ?)", rows)
+            added = connection.total_changes - before
+            connection.executemany("UPDATE items SET priority = ? WHERE book_id = ? AND location = ? AND state = 'ready'",
+                                   [(priority, book_id, location) for book_id, location, priority, *_ in rows])
+            return added
+        return self.transaction(enqueue)
+
+    def lease(self, location, owner, count=1):
+        """
+        Leases up to count items, highest priority first, and returns their book ids.
+        Items whose lease ran out count as a failed attempt, and go to the dead letter list if that was the last one.
+        """
+        def take(connection):
+            now = time.time()
+            # A worker restarted after a crash picks up its old items without waiting for their leases to run out
+            owners = connection.execute("SELECT DISTINCT lease_owner FROM items WHERE location = ? AND state = 'leased' "
+                                        'AND lease_expires >= ?', (location, now)).fetchall()
+            dead_owners = [(row[0],) for row in owners if not owner_alive(row[0])]
+            if dead_owners:
+                print(f'Taking back the leases of {len(dead_owners)} exited worker(s)')
+                connection.executemany("UPDATE items SET lease_expires = 0 WHERE state = 'leased' AND lease_owner = ?",
+                                       dead_owners)
+            connection.execute("UPDATE items SET state = 'dead', last_error = 'lease expired', updated = ? "
+                               "WHERE location = ? AND state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                               (now, location, now, self.max_attempts))
+            rows = connection.execute("SELECT book_id FROM items WHERE location = ? AND "
+                                      "((state = 'ready' AND available_at <= ?) OR "
+                                      "(state = 'leased' AND lease_expires < ?)) "
+                                      'ORDER BY priority DESC, enqueued, rowid LIMIT ?',
+                                      (location, now, now, count)).fetchall()
+            connection.executemany("UPDATE items SET state = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                                   'lease_expires = ?, updated = ? WHERE book_id = ? AND location = ?',
+                                   [(owner, now + self.visibility_timeout, now, row[0], location) for row in rows])
+            return [row[0] for row in rows]
+        return self.transaction(take)
+
+    def renew(self, book_id, location, owner):
+        """Pushes the lease back out to visibility_timeout from now. False if owner no longer holds it"""
+        def extend(connection):
+            return connection.execute("UPDATE items SET lease_expires = ?, updated = ? "
+                                      "WHERE book_id = ? AND location = ? AND state = 'leased' AND lease_owner = ?",
+                                      (time.time() + self.visibility_timeout, time.time(), str(book_id), location,
+                                       owner)).rowcount
+        return self.transaction(extend) > 0
+
+    def finish(self, book_id, location, owner, set_sql, params):
+        def update(connection):
+            return connection.execute(f'UPDATE items SET {set_sql}, updated = ? '
+                                      "WHERE book_id = ? AND location = ? AND state = 'leased' AND lease_owner = ?",
+                                      (*params, time.time(), str(book_id), location, owner)).rowcount
+        if not self.transaction(update):
+            # The lease ran out and another worker has the item now, its result is the one that counts
+            print(f'Lease on {book_id} was lost before it finished')
+            return False
+        return True
+
+    def complete(self, book_id, location, owner):
+        return self.finish(book_id, location, owner, "state = 'done', lease_owner = NULL, last_error = NULL", ())
+
+    def fail(self, book_id, location, owner, error):
+        """Puts the item back after a backoff that doubles with each attempt, or on the dead letter list"""
+        with self.lock:
+            row = self.connection.execute('SELECT attempts FROM items WHERE book_id = ? AND location = ?',
+                                          (str(book_id), location)).fetchone()
+        attempts = row[0] if row else self.max_attempts
+        if attempts >= self.max_attempts:
+            print(f'{book_id} failed {attempts} time(s), moved to the dead letter list: {error}')
+            return self.finish(book_id, location, owner, "state = 'dead', lease_owner = NULL, last_error = ?",
+                               (str(error),))
+        available_at = time.time() + self.retry_backoff * 2 ** (attempts - 1)
+        return self.finish(book_id, location, owner,
+                           "state = 'ready', lease_owner = NULL, last_error = ?, available_at = ?",
+                           (str(error), available_at))
+
+    def dead_letters(self, location):
+        """Returns (book_id, attempts, last_error) for every item that ran out of attempts"""
+        with self.lock:
+            return self.connection.execute("SELECT book_id, attempts, last_error FROM items "
+                                           "WHERE location = ? AND state = 'dead' ORDER BY updated",
+                                           (location,)).fetchall()
+
+    def requeue_dead(self, location):
+        """Gives every dead letter a fresh set of attempts. Returns how many were requeued"""
+        def requeue(connection):
+            return connection.execute("UPDATE items SET state = 'ready', attempts = 0, available_at = ?, updated = ? "
+                                      "WHERE location = ? AND state = 'dead'",
+                                      (time.time(), time.time(), location)).rowcount
+        return self.transaction(requeue)
+
+    def stats(self, location):
+        """Returns {state: number of items}"""
+        with self.lock:
+            rows = self.connection.execute('SELECT state, COUNT(*) FROM items WHERE location = ? GROUP BY state',
+                                           (location,)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()